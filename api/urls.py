@@ -1,7 +1,19 @@
 from django.urls import path
+from . import views
 
 app_name = 'api'
 
 urlpatterns = [
-    # path()
+    path('soap/pool/', views.soap_pool_stats,
+         name='soap_pool_stats'),
+    path('soap/clients/', views.soap_clients,
+         name='soap_clients'),
+    path('soap/breakers/', views.soap_breakers,
+         name='soap_breakers'),
+    path('soap/admission/', views.soap_admission,
+         name='soap_admission'),
+    path('cache/', views.cache_counters,
+         name='cache_counters'),
+    path('metrics/', views.prometheus_metrics,
+         name='metrics'),
 ]
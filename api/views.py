@@ -1,3 +1,88 @@
-from django.shortcuts import render
+from django.http import HttpResponse, JsonResponse
 
-# Create your views here.
+from base import metrics
+from base.admission import admission_stats
+from base.cache import cache_stats
+from base.soap import client_stats, transport_stats
+from base.upstream import breaker_stats
+
+
+def soap_pool_stats(request):
+    """
+    Возвращает счетчики пула соединений к Avibus.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        JsonResponse: JSON-ответ с числом запросов, новых соединений и попаданий в пул.
+    """
+    return JsonResponse(transport_stats())
+
+
+def soap_clients(request):
+    """
+    Возвращает сведения о созданных клиентах SOAP: источник WSDL и время его разбора при старте.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        JsonResponse: JSON-ответ со сведениями о клиентах.
+    """
+    return JsonResponse(client_stats())
+
+
+def cache_counters(request):
+    """
+    Возвращает счетчики попаданий, промахов и объединенных запросов всех кэшей процесса.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        JsonResponse: JSON-ответ со счетчиками по имени кэша.
+    """
+    return JsonResponse(cache_stats())
+
+
+def soap_breakers(request):
+    """
+    Возвращает состояние автоматов отключения портов Avibus: закрыт, открыт или пробный вызов.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        JsonResponse: JSON-ответ с состоянием, долей сбоев и числом отклоненных вызовов по каждому порту.
+    """
+    return JsonResponse(breaker_stats())
+
+
+def soap_admission(request):
+    """
+    Возвращает состояние ограничителя вызовов Avibus этого процесса: занятые места и по каждому классу
+    приоритета доступные места, длину очереди, число допущенных и отклоненных вызовов.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        JsonResponse: JSON-ответ с состоянием ограничителя.
+    """
+    return JsonResponse(admission_stats())
+
+
+def prometheus_metrics(request):
+    """
+    Возвращает метрики процесса в текстовом формате Prometheus: время и размер вызовов Avibus
+    по операциям, ошибки и повторы, время представлений с разбивкой на Avibus, JSON и остальное,
+    счетчики кэшей, пула соединений, автоматов отключения и ограничителя вызовов.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        HttpResponse: Метрики в формате text/plain; version=0.0.4.
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
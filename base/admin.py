@@ -1,3 +1,53 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import BusStop, Destination, Job, Order, ReturnOrder, Ticket
+
+
+@admin.register(BusStop)
+class BusStopAdmin(admin.ModelAdmin):
+    list_display = ('name', 'id', 'automated', 'updated_at')
+    list_filter = ('automated',)
+    search_fields = ('name', 'id')
+
+
+@admin.register(Destination)
+class DestinationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'destination_id', 'departure_id', 'updated_at')
+    search_fields = ('name', 'departure_id', 'destination_id')
+
+
+class TicketInline(admin.TabularInline):
+    model = Ticket
+    fk_name = 'order'
+    extra = 0
+    fields = ('number', 'seat_num', 'fare_name', 'parent_seat_num', 'status', 'return_order')
+    readonly_fields = fields
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('number', 'status', 'avibus_status', 'trip_id', 'customer_email', 'created_at', 'paid_at')
+    list_filter = ('status',)
+    search_fields = ('number', 'trip_id', 'customer_email')
+    inlines = (TicketInline,)
+
+
+@admin.register(ReturnOrder)
+class ReturnOrderAdmin(admin.ModelAdmin):
+    list_display = ('number', 'status', 'avibus_status', 'created_at', 'paid_at')
+    list_filter = ('status',)
+    search_fields = ('number',)
+
+
+@admin.register(Ticket)
+class TicketAdmin(admin.ModelAdmin):
+    list_display = ('number', 'order', 'return_order', 'seat_num', 'fare_name', 'status', 'updated_at')
+    search_fields = ('number', 'trip_id', 'order__number', 'return_order__number')
+    raw_id_fields = ('order', 'return_order')
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'operation', 'key', 'status', 'attempts', 'run_after', 'deadline', 'finished_at')
+    list_filter = ('status', 'operation')
+    search_fields = ('key',)
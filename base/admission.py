@@ -0,0 +1,337 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from . import metrics
+
+# Классы приоритета вызовов Avibus от высшего к низшему.
+PAYMENT = 'payment'
+BOOKING = 'booking'
+SEARCH = 'search'
+DIRECTORY = 'directory'
+PRIORITIES = (PAYMENT, BOOKING, SEARCH, DIRECTORY)
+
+# Класс приоритета операции. Оплата и возврат ограничены по времени (CancelPayment — 10 минут после Payment),
+# поэтому идут первыми; операции, которых здесь нет, считаются поиском.
+OPERATION_PRIORITIES = {
+    'Payment': PAYMENT,
+    'CancelPayment': PAYMENT,
+    'ReturnPayment': PAYMENT,
+    'CancelReturnPayment': PAYMENT,
+    'AddTicketReturn': PAYMENT,
+    'DelTicketReturn': PAYMENT,
+    'StartSaleSession': BOOKING,
+    'AddTickets': BOOKING,
+    'DelTickets': BOOKING,
+    'SetTicketData': BOOKING,
+    'ReserveOrder': BOOKING,
+    'GetTrips': SEARCH,
+    'GetTripSegment': SEARCH,
+    'GetOccupiedSeats': SEARCH,
+    'GetTicketStatus': SEARCH,
+    'GetBusStops': DIRECTORY,
+    'GetDestinations': DIRECTORY,
+}
+# Retry-After ответа 503 на отклоненный вызов: очередь освобождается быстро, клиенту стоит повторить скоро.
+RETRY_AFTER_SECONDS = 1
+
+controller = None
+_controller_lock = threading.Lock()
+
+
+class AdmissionRejectedError(Exception):
+    """
+    Вызов Avibus не допущен: воркер перегружен, а очередь класса приоритета заполнена
+    или время ожидания в ней истекло; запрос не отправлялся.
+    """
+
+    def __init__(self, priority, reason):
+        super().__init__(f'Сервис перегружен, запрос класса {priority} отклонен')
+        self.priority = priority
+        self.reason = reason
+        self.retry_after = RETRY_AFTER_SECONDS
+
+
+def operation_priority(operation):
+    return OPERATION_PRIORITIES.get(operation, SEARCH)
+
+
+class _Waiter:
+    """
+    Вызов в очереди допуска. Поток ждет на Event, корутина — на Future своего цикла событий;
+    место освобождается из любого потока, поэтому Future завершается через call_soon_threadsafe.
+    """
+    __slots__ = ('granted', '_event', '_loop', 'future')
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(_resolve, self.future)
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class AdmissionController:
+    """
+    Ограничитель одновременных вызовов Avibus в процессе с классами приоритета.
+    Класс может занять не больше своей доли лимита (SOAP_ADMISSION_SHARES), поэтому всплеск поиска
+    оставляет места бронированию и оплате. Когда мест нет, вызов ждет в очереди своего класса;
+    освободившееся место отдается ожидающему из самого важного класса, новые вызовы не обгоняют
+    ожидающих того же или более важного класса. Переполненная очередь и истекшее ожидание
+    дают AdmissionRejectedError.
+    """
+
+    def __init__(self, limit, shares, queue_timeouts, queue_max):
+        self.limit = limit
+        self.capacity = {priority: max(1, int(limit * shares.get(priority, 1.0))) for priority in PRIORITIES}
+        self.queue_timeouts = queue_timeouts
+        self.queue_max = queue_max
+        self.in_flight = 0
+        self.admitted = dict.fromkeys(PRIORITIES, 0)
+        self.rejected = {}
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._lock = threading.Lock()
+
+    def _try_admit(self, priority):
+        if self.in_flight >= self.capacity[priority]:
+            return False
+        if any(self._queues[ahead] for ahead in PRIORITIES[:PRIORITIES.index(priority) + 1]):
+            return False
+        self.in_flight += 1
+        self.admitted[priority] += 1
+        return True
+
+    def _enqueue(self, priority, waiter):
+        queue = self._queues[priority]
+        if len(queue) >= self.queue_max.get(priority, 0):
+            self._reject(priority, 'queue_full')
+        queue.append(waiter)
+
+    def _reject(self, priority, reason):
+        key = (priority, reason)
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+        raise AdmissionRejectedError(priority, reason)
+
+    def _give_up(self, priority, waiter):
+        """
+        Убирает ожидающий вызов из очереди. Если место успели выдать, вызов считается допущенным.
+
+        Returns:
+            bool: True, если место было выдано.
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._queues[priority].remove(waiter)
+            return False
+
+    def queue_timeout(self, priority, deadline):
+        return min(self.queue_timeouts.get(priority, 0), deadline - time.monotonic())
+
+    def acquire(self, priority, deadline):
+        """
+        Занимает место для вызова, при необходимости ожидая в очереди.
+
+        Args:
+            priority (str): Класс приоритета.
+            deadline (float): Момент time.monotonic(), после которого ждать бессмысленно (бюджет операции).
+
+        Raises:
+            AdmissionRejectedError: Если очередь класса заполнена или ожидание истекло.
+        """
+        with self._lock:
+            if self._try_admit(priority):
+                return
+            waiter = _Waiter()
+            self._enqueue(priority, waiter)
+
+        started = time.perf_counter()
+        if not waiter.wait(max(self.queue_timeout(priority, deadline), 0)) and not self._give_up(priority, waiter):
+            with self._lock:
+                self._reject(priority, 'timeout')
+        metrics.admission_wait_seconds.observe(time.perf_counter() - started, priority=priority)
+
+    async def aacquire(self, priority, deadline):
+        """
+        Асинхронная версия acquire: ожидание в очереди не блокирует цикл событий.
+
+        Args:
+            priority (str): Класс приоритета.
+            deadline (float): Момент time.monotonic(), после которого ждать бессмысленно.
+
+        Raises:
+            AdmissionRejectedError: Если очередь класса заполнена или ожидание истекло.
+        """
+        with self._lock:
+            if self._try_admit(priority):
+                return
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._enqueue(priority, waiter)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter.future, max(self.queue_timeout(priority, deadline), 0))
+        except asyncio.TimeoutError:
+            if not self._give_up(priority, waiter):
+                with self._lock:
+                    self._reject(priority, 'timeout')
+        except asyncio.CancelledError:
+            if self._give_up(priority, waiter):
+                self.release()
+            raise
+        metrics.admission_wait_seconds.observe(time.perf_counter() - started, priority=priority)
+
+    def release(self):
+        """
+        Освобождает место и отдает его ожидающим, начиная с самого важного класса.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            for priority in PRIORITIES:
+                queue = self._queues[priority]
+                while queue and self.in_flight < self.capacity[priority]:
+                    waiter = queue.popleft()
+                    waiter.granted = True
+                    self.in_flight += 1
+                    self.admitted[priority] += 1
+                    waiter.wake()
+                if queue:
+                    break
+
+    def stats(self):
+        """
+        Возвращает состояние ограничителя.
+
+        Returns:
+            dict: Лимит, занятые места и по каждому классу: доступные места, длина очереди, число допущенных
+                и отклоненных вызовов.
+        """
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'priorities': {
+                    priority: {
+                        'capacity': self.capacity[priority],
+                        'queued': len(self._queues[priority]),
+                        'admitted': self.admitted[priority],
+                        'rejected': {reason: count for (rejected, reason), count in self.rejected.items()
+                                     if rejected == priority},
+                    }
+                    for priority in PRIORITIES
+                },
+            }
+
+
+def get_controller():
+    global controller
+    if controller is None:
+        with _controller_lock:
+            if controller is None:
+                controller = AdmissionController(settings.SOAP_ADMISSION_LIMIT, settings.SOAP_ADMISSION_SHARES,
+                                                 settings.SOAP_ADMISSION_QUEUE_TIMEOUTS,
+                                                 settings.SOAP_ADMISSION_QUEUE_MAX)
+    return controller
+
+
+def admission_stats():
+    """
+    Возвращает состояние ограничителя вызовов Avibus этого процесса.
+
+    Returns:
+        dict: Состояние ограничителя или {'enabled': False}, если SOAP_ADMISSION_LIMIT равен 0.
+    """
+    if not settings.SOAP_ADMISSION_LIMIT:
+        return {'enabled': False}
+    return {'enabled': True, **get_controller().stats()}
+
+
+@contextmanager
+def admitted(operation, deadline):
+    """
+    Допускает вызов операции Avibus через ограничитель процесса и освобождает место после вызова.
+    При SOAP_ADMISSION_LIMIT = 0 ограничение выключено.
+
+    Args:
+        operation (str): Имя операции.
+        deadline (float): Момент time.monotonic(), до которого имеет смысл ждать места.
+
+    Raises:
+        AdmissionRejectedError: Если вызов не допущен.
+    """
+    if not settings.SOAP_ADMISSION_LIMIT:
+        yield
+        return
+    limiter = get_controller()
+    limiter.acquire(operation_priority(operation), deadline)
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+@asynccontextmanager
+async def aadmitted(operation, deadline):
+    """
+    Асинхронная версия admitted.
+
+    Args:
+        operation (str): Имя операции.
+        deadline (float): Момент time.monotonic(), до которого имеет смысл ждать места.
+
+    Raises:
+        AdmissionRejectedError: Если вызов не допущен.
+    """
+    if not settings.SOAP_ADMISSION_LIMIT:
+        yield
+        return
+    limiter = get_controller()
+    await limiter.aacquire(operation_priority(operation), deadline)
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+def _collect(field):
+    if controller is None:
+        return []
+    stats = controller.stats()
+    return [({'priority': priority}, values[field]) for priority, values in stats['priorities'].items()]
+
+
+def _collect_rejected():
+    if controller is None:
+        return []
+    return [({'priority': priority, 'reason': reason}, count)
+            for (priority, reason), count in list(controller.rejected.items())]
+
+
+metrics.Gauge('avibus_admission_in_flight', 'Вызовы Avibus, допущенные ограничителем и еще не завершенные.',
+              collect=lambda: [({}, controller.in_flight)] if controller is not None else [])
+metrics.Gauge('avibus_admission_queued', 'Вызовы Avibus в очереди ограничителя по классу приоритета.',
+              ('priority',), collect=lambda: _collect('queued'))
+metrics.Counter('avibus_admission_admitted_total', 'Вызовы Avibus, допущенные ограничителем.',
+                ('priority',), collect=lambda: _collect('admitted'))
+metrics.Counter('avibus_admission_rejected_total',
+                'Вызовы Avibus, отклоненные ограничителем: очередь заполнена (queue_full) или ожидание истекло (timeout).',
+                ('priority', 'reason'), collect=_collect_rejected)
@@ -0,0 +1,151 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+
+from .directory import bus_stops, destinations
+from .http import conditional_json
+from .orders import record_ticket_status
+from .seats import SeatMap, seats_cache, trip_key
+from .serializers import elements_mapping, json_response, stream_response
+from .soap import WSDL_SALE
+from .upstream import acall
+from .views import (SEGMENT_FIELD_PRESETS, TRIP_FIELD_PRESETS, is_streaming, response_fields, ticket_status_cache,
+                    trips_cache)
+
+
+@conditional_json(max_age=settings.DIRECTIONS_MAX_AGE)
+async def get_directions(request):
+    """
+    Асинхронно получает список доступных направлений из локального справочника остановок Avibus.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметр stream=1 включает потоковый ответ.
+
+    Returns:
+        HttpResponse: JSON-ответ с направлениями.
+    """
+    travel_directions = await sync_to_async(bus_stops.travel_directions)()
+    if is_streaming(request):
+        return stream_response({'travel_directions': travel_directions}, 'travel_directions')
+    return json_response({'travel_directions': travel_directions})
+
+
+@conditional_json(max_age=settings.DESTINATIONS_MAX_AGE)
+async def get_destinations(request):
+    """
+    Асинхронно получает список пунктов назначения для выбранного направления
+    из локального индекса, а при его отсутствии из системы Avibus.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметры departure и substring (подстрока названия).
+
+    Returns:
+        HttpResponse: JSON-ответ с пунктами назначения.
+    """
+    departure_id = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    substring = request.GET.get('substring', '')
+
+    end_directions = await sync_to_async(destinations.destinations)(departure_id, substring)
+    if end_directions is None:
+        found = await acall(WSDL_SALE, 'GetDestinations', Departure=departure_id, Substring=substring)
+        end_directions = [{'id': dis.Id, 'name': dis.Name} for dis in found] if found else None
+
+    return json_response({'end_directions': end_directions or None, 'departure': departure_id})
+
+
+async def search_trips(request):
+    """
+    Асинхронно выполняет поиск поездок по направлению и пункту назначения в системе Avibus,
+    используя тот же кэш поиска поездок, что и синхронное представление.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметры departure, destination, date, fields
+            (список полей через запятую или набор list/detail) и stream=1 для потокового ответа.
+
+    Returns:
+        HttpResponse: JSON-ответ с результатами поиска.
+    """
+    departure = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    destination = request.GET.get('destination', 'cb654d84-f487-11ed-83c7-d00da3a6c886')
+    date = request.GET.get('date', '2023-06-09')
+    fields = response_fields(request, TRIP_FIELD_PRESETS)
+
+    async def load():
+        return await acall(WSDL_SALE, 'GetTrips', Departure=departure, Destination=destination, TripsDate=date)
+
+    bus_results = elements_mapping(await trips_cache.aget_or_load((departure, destination, date), load))
+
+    if is_streaming(request):
+        return stream_response(bus_results, 'Elements', fields=fields)
+    return json_response(bus_results, fields=fields)
+
+
+async def search_trip_segment(request):
+    """
+    Асинхронно получает информацию о выбранной поездке и сегментах поездки из системы Avibus.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметр fields (список полей через запятую или набор list/detail).
+
+    Returns:
+        HttpResponse: JSON-ответ с информацией о поездке и сегментах.
+    """
+    departure = '862fd93e-e633-11e7-80e7-00175d776a07'
+    destination = 'cb654d84-f487-11ed-83c7-d00da3a6c886'
+    trip_id = '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041'
+    fields = response_fields(request, SEGMENT_FIELD_PRESETS)
+
+    bus_results = await acall(WSDL_SALE, 'GetTripSegment', TripId=trip_id, Departure=departure, Destination=destination)
+
+    return json_response(bus_results, fields=fields)
+
+
+async def get_occupied_seats(request):
+    """
+    Асинхронно получает информацию о занятых и свободных местах на выбранной поездке в системе Avibus.
+    Карта мест без привязки к заказу берется из того же кэша, что и в синхронном представлении.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметры trip_id, departure, destination и order_id.
+
+    Returns:
+        HttpResponse: JSON-ответ с информацией о местах.
+    """
+    departure = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    destination = request.GET.get('destination', 'cb654d84-f487-11ed-83c7-d00da3a6c886')
+    trip_id = request.GET.get('trip_id', '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041')
+    order_id = request.GET.get('order_id', '')
+
+    async def load():
+        bus_results = await acall(WSDL_SALE, 'GetOccupiedSeats', TripId=trip_id, Departure=departure,
+                                  Destination=destination, OrderId=order_id)
+        return SeatMap.from_result(bus_results)
+
+    if order_id:
+        seat_map = await load()
+    else:
+        seat_map = await seats_cache.aget_or_load(trip_key(trip_id, departure, destination), load)
+
+    return HttpResponse(seat_map.payload, content_type='application/json')
+
+
+async def get_ticket_status(request):
+    """
+    Асинхронно получает статус билета из системы Avibus, обновляя кэш статусов и локальное хранилище.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        HttpResponse: JSON-ответ с информацией о статусе билета.
+    """
+    departure_id = '862fd93e-e633-11e7-80e7-00175d776a07'
+    ticket_id = '00000005334018'
+    vendor_id = ''
+
+    bus_results = await acall(WSDL_SALE, 'GetTicketStatus', DepartureId=departure_id, TicketId=ticket_id,
+                              VendorId=vendor_id)
+    ticket_status_cache.set((departure_id, ticket_id), bus_results)
+    await sync_to_async(record_ticket_status)(ticket_id, departure_id, bus_results)
+
+    return json_response(bus_results)
@@ -0,0 +1,160 @@
+import time
+
+from .models import Order
+from .orders import order_tickets, record_order_status, record_sale_session, record_tickets
+from .seats import invalidate_trip, remember_order, trip_key
+from .serializers import get_field
+from .soap import WSDL_SALE
+from .admission import AdmissionRejectedError
+from .upstream import CircuitOpenError, call
+
+# Обязательные и необязательные строковые поля запроса бронирования.
+REQUIRED_FIELDS = ('trip_id', 'departure', 'destination')
+OPTIONAL_STRING_FIELDS = ('order_id', 'reserve_kind')
+
+
+class BookingError(Exception):
+    """
+    Ошибка шага бронирования. Хранит уже выполненные шаги, чтобы клиент мог продолжить или отменить заказ.
+    retry_after задан, если шаг отклонен без обращения к Avibus (автомат отключения или ограничитель вызовов).
+    """
+
+    def __init__(self, step, error, order_id, steps, retry_after=None):
+        super().__init__(f'{step}: {error}')
+        self.step = step
+        self.error = error
+        self.order_id = order_id
+        self.steps = steps
+        self.retry_after = retry_after
+
+
+def validate_booking(booking):
+    """
+    Проверяет запрос бронирования целиком до первого вызова Avibus, чтобы некорректные данные
+    не оставляли начатый заказ.
+
+    Args:
+        booking (dict): Запрос бронирования (см. BookingPipeline.run).
+
+    Returns:
+        list[str]: Описания ошибок; пустой список, если запрос корректен.
+    """
+    errors = []
+    missing = [key for key in REQUIRED_FIELDS if not booking.get(key)]
+    if missing:
+        errors.append('Не указаны поля: ' + ', '.join(missing))
+    for key in REQUIRED_FIELDS + OPTIONAL_STRING_FIELDS:
+        if booking.get(key) is not None and not isinstance(booking[key], str):
+            errors.append(f'Поле {key} должно быть строкой')
+    for key in ('ticket_seats', 'tickets'):
+        items = booking.get(key)
+        if items is not None and (not isinstance(items, list)
+                                  or not all(isinstance(item, dict) for item in items)):
+            errors.append(f'Поле {key} должно быть списком объектов')
+    for key in ('customer', 'cheque_settings'):
+        if booking.get(key) is not None and not isinstance(booking[key], dict):
+            errors.append(f'Поле {key} должно быть объектом')
+    return errors
+
+
+class BookingPipeline:
+    """
+    Выполняет бронирование одним запросом: StartSaleSession → AddTickets → SetTicketData → ReserveOrder
+    через один клиент SOAP и одно keep-alive соединение, замеряя время каждого шага.
+    """
+
+    def __init__(self, wsdl=WSDL_SALE):
+        self.wsdl = wsdl
+        self.steps = []
+        self.order_id = None
+
+    def run(self, booking):
+        """
+        Бронирует заказ.
+
+        Args:
+            booking (dict): trip_id, departure, destination, ticket_seats (элементы TicketSeats для AddTickets,
+                включая багажные), tickets (элементы Tickets для SetTicketData с PersonalData; Number можно
+                не указывать, он подставится по SeatNum и FareName), customer, reserve_kind и cheque_settings.
+
+        Returns:
+            dict: Номер заказа, результат ReserveOrder и время каждого шага.
+
+        Raises:
+            BookingError: Если один из шагов завершился ошибкой или был отклонен после создания заказа.
+            CircuitOpenError: Если автомат отключения Avibus разомкнут до создания заказа.
+            AdmissionRejectedError: Если воркер перегружен и StartSaleSession не допущен.
+        """
+        key = trip_key(booking['trip_id'], booking['departure'], booking['destination'])
+
+        order = self.step('StartSaleSession', TripId=booking['trip_id'], Departure=booking['departure'],
+                          Destination=booking['destination'], OrderId=booking.get('order_id', ''))
+        invalidate_trip(key)
+        self.order_id = get_field(order, 'Number')
+        remember_order(self.order_id, key)
+        record_sale_session(order, booking['trip_id'], booking['departure'], booking['destination'])
+
+        if booking.get('ticket_seats'):
+            order = self.step('AddTickets', OrderId=self.order_id,
+                              TicketSeats={'Elements': booking['ticket_seats']})
+            invalidate_trip(key)
+            record_tickets(self.order_id, order)
+
+        tickets = self.fill_ticket_numbers(booking.get('tickets') or [], order_tickets(order))
+        if tickets:
+            record_tickets(self.order_id, self.step('SetTicketData', OrderId=self.order_id,
+                                                    Tickets={'Elements': tickets}))
+
+        reserved = self.step('ReserveOrder', OrderId=self.order_id, Customer=booking.get('customer'),
+                             ReserveKind=booking.get('reserve_kind'),
+                             ChequeSettings=booking.get('cheque_settings', {'ChequeWidth': '48'}))
+        record_order_status(self.order_id, Order.STATUS_RESERVED, reserved,
+                            customer_email=get_field(booking.get('customer'), 'Email') or '')
+
+        return {
+            'order_id': self.order_id,
+            'order': reserved,
+            'steps': self.steps,
+            'total_seconds': round(sum(step['seconds'] for step in self.steps), 4),
+        }
+
+    def step(self, operation, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = call(self.wsdl, operation, **kwargs)
+        except Exception as exc:
+            self.steps.append({'step': operation, 'seconds': round(time.perf_counter() - started, 4), 'ok': False})
+            rejected = isinstance(exc, (CircuitOpenError, AdmissionRejectedError))
+            # Отказ без обращения к Avibus до создания заказа — не ошибка шага: UpstreamErrorMiddleware отвечает 503
+            # с Retry-After. После StartSaleSession клиенту нужны номер заказа и шаги, чтобы продолжить или отменить его.
+            if rejected and self.order_id is None:
+                raise
+            raise BookingError(operation, str(exc), self.order_id, self.steps,
+                               retry_after=exc.retry_after if rejected else None) from exc
+        self.steps.append({'step': operation, 'seconds': round(time.perf_counter() - started, 4), 'ok': True})
+        return result
+
+    @staticmethod
+    def fill_ticket_numbers(tickets, added):
+        """
+        Подставляет номера билетов из ответа AddTickets в данные для SetTicketData по месту и тарифу.
+
+        Args:
+            tickets (list[dict]): Элементы Tickets из запроса.
+            added (list): Билеты заказа из ответа Avibus.
+
+        Returns:
+            list[dict]: Элементы Tickets с заполненным Number.
+        """
+        numbers = {}
+        for ticket in added:
+            numbers.setdefault((str(get_field(ticket, 'SeatNum')), get_field(ticket, 'FareName')),
+                               get_field(ticket, 'Number'))
+        filled = []
+        for ticket in tickets:
+            if not ticket.get('Number'):
+                number = numbers.get((str(ticket.get('SeatNum')), ticket.get('FareName')))
+                if number:
+                    ticket = {**ticket, 'Number': number}
+            filled.append(ticket)
+        return filled
@@ -0,0 +1,205 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from . import metrics
+
+# Все именованные кэши процесса, для вывода счетчиков.
+caches = {}
+
+
+class TTLCache:
+    """
+    Кэш в памяти процесса с временем жизни записей и объединением одинаковых промахов (single-flight):
+    если несколько потоков одновременно запрашивают отсутствующий ключ, загрузку выполняет
+    только первый, а остальные ждут его результат. Загрузка, начатая до invalidate, не записывает
+    устаревший результат в кэш. При переполнении maxsize вытесняются записи,
+    к которым дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, name, ttl, maxsize=1000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        caches[name] = self
+
+    def get(self, key):
+        """
+        Возвращает значение по ключу, если оно есть и не устарело.
+
+        Args:
+            key (Hashable): Ключ.
+
+        Returns:
+            object | None: Значение или None.
+        """
+        entry = self._lookup(key)
+        return entry[1] if entry is not None else None
+
+    def _lookup(self, key):
+        # Попадание переносит запись в конец очереди вытеснения.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _begin(self, key):
+        """
+        Возвращает загрузку ключа, которую нужно ждать, или начинает новую.
+
+        Returns:
+            tuple[Future, bool]: Загрузка и признак того, что ее выполняет вызывающий.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Future()
+            self.misses += 1
+            return flight, True
+
+    def _finish(self, key, flight, value):
+        # Загрузка, начатая до invalidate/clear, отдает значение своим ожидающим, но не кладет его в кэш:
+        # invalidate отвязывает ее от ключа, и данные могли устареть.
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+                self._store(key, value)
+        flight.set_result(value)
+
+    def _fail(self, key, flight, exc):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.set_exception(exc)
+
+    def get_or_load(self, key, loader):
+        """
+        Возвращает значение из кэша или загружает его, объединяя одновременные загрузки одного ключа.
+
+        Args:
+            key (Hashable): Ключ.
+            loader (Callable[[], object]): Функция загрузки значения при промахе.
+
+        Returns:
+            object: Значение.
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        flight, leader = self._begin(key)
+        if not leader:
+            return flight.result()
+
+        try:
+            value = loader()
+        except BaseException as exc:
+            self._fail(key, flight, exc)
+            raise
+        self._finish(key, flight, value)
+        return value
+
+    async def aget_or_load(self, key, loader):
+        """
+        Асинхронная версия get_or_load для представлений под ASGI. Загрузки объединяются
+        и с корутинами, и с потоками, которые запрашивают тот же ключ через get_or_load.
+
+        Args:
+            key (Hashable): Ключ.
+            loader (Callable[[], Awaitable]): Корутинная функция загрузки значения при промахе.
+
+        Returns:
+            object: Значение.
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        flight, leader = self._begin(key)
+        if not leader:
+            return await asyncio.wrap_future(flight)
+
+        try:
+            value = await loader()
+        except BaseException as exc:
+            self._fail(key, flight, exc)
+            raise
+        self._finish(key, flight, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        Удаляет запись и отвязывает идущую загрузку ключа: ее результат не попадет в кэш,
+        а следующий промах начнет новую загрузку.
+
+        Args:
+            key (Hashable): Ключ.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._flights.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._flights.clear()
+
+    def stats(self):
+        """
+        Возвращает счетчики кэша.
+
+        Returns:
+            dict: Попадания, промахи, объединенные промахи и размер кэша.
+        """
+        return {
+            'ttl': self.ttl,
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+
+def cache_stats():
+    """
+    Возвращает счетчики всех кэшей процесса.
+
+    Returns:
+        dict: Счетчики по имени кэша.
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def _cache_counter(field):
+    return lambda: [({'cache': name}, cache.stats()[field]) for name, cache in list(caches.items())]
+
+
+metrics.Counter('cache_hits_total', 'Попадания в кэши процесса.', ('cache',), collect=_cache_counter('hits'))
+metrics.Counter('cache_misses_total', 'Промахи кэшей процесса.', ('cache',), collect=_cache_counter('misses'))
+metrics.Counter('cache_coalesced_total', 'Промахи, объединенные с уже идущей загрузкой.', ('cache',),
+                collect=_cache_counter('coalesced'))
+metrics.Gauge('cache_entries', 'Записей в кэше.', ('cache',), collect=_cache_counter('size'))
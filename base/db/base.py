@@ -0,0 +1,32 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite, в котором transaction.atomic() начинает транзакцию в режиме OPTIONS['transaction_mode']
+    (DEFERRED, IMMEDIATE или EXCLUSIVE), как в Django 5.1. Отложенная транзакция, которая сначала читает,
+    а потом пишет, при занятой другим соединением блокировке записи получает database is locked сразу,
+    не дожидаясь timeout; транзакция IMMEDIATE берет блокировку записи в BEGIN и ждет ее до timeout.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transaction_mode = self.settings_dict['OPTIONS'].get('transaction_mode')
+        if self.transaction_mode is not None:
+            self.transaction_mode = self.transaction_mode.upper()
+            if self.transaction_mode not in TRANSACTION_MODES:
+                raise ImproperlyConfigured(f"transaction_mode должен быть одним из {', '.join(TRANSACTION_MODES)}")
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('transaction_mode', None)
+        return params
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
@@ -0,0 +1,319 @@
+import logging
+import threading
+import time
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import BusStop, Destination
+from .soap import WSDL_SALE, WSDL_SCHEDULE
+from .upstream import call
+
+logger = logging.getLogger(__name__)
+
+# Длина n-грамм в индексе пунктов назначения.
+NGRAM_SIZE = 3
+
+
+class LocalDirectory:
+    """
+    Справочник Avibus, сохраненный в БД, с копией в памяти процесса.
+
+    Пока копия свежее TTL, она отдается без обращений к БД и SOAP. Устаревшая копия
+    тоже отдается сразу, а обновление запускается в фоновом потоке (stale-while-revalidate).
+    После неудачного обновления следующее запускается не раньше чем через DIRECTORY_REFRESH_BACKOFF секунд.
+    """
+    ttl_setting = None
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._data = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._failed_at = None
+
+    def get_ttl(self):
+        return self.ttl if self.ttl is not None else getattr(settings, self.ttl_setting)
+
+    def data(self):
+        """
+        Возвращает копию справочника в памяти, при необходимости загружая ее из БД.
+
+        Returns:
+            object | None: Данные справочника или None, если он еще не построен.
+        """
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._load()
+        elif self.is_stale():
+            self.refresh_in_background()
+        return self._data
+
+    def is_stale(self):
+        return time.time() - self._loaded_at > self.get_ttl()
+
+    def refresh_in_background(self):
+        """
+        Запускает обновление справочника в фоновом потоке, если оно еще не идет
+        и после последней неудачи прошло DIRECTORY_REFRESH_BACKOFF секунд.
+        """
+        with self._lock:
+            if self._refreshing or self.is_backing_off():
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name=f'{type(self).__name__}-refresh',
+                         daemon=True).start()
+
+    def is_backing_off(self):
+        return (self._failed_at is not None
+                and time.monotonic() - self._failed_at < settings.DIRECTORY_REFRESH_BACKOFF)
+
+    def refresh(self):
+        """
+        Загружает справочник из Avibus и сохраняет его в БД и в память.
+        """
+        raise NotImplementedError
+
+    def _load(self):
+        """
+        Загружает копию в память из БД. Вызывается под блокировкой.
+        """
+        raise NotImplementedError
+
+    def _set(self, data, loaded_at):
+        self._data = data
+        self._loaded_at = loaded_at
+
+    def _background_refresh(self):
+        try:
+            # Сначала пробуем БД: ее мог уже обновить другой воркер.
+            self._load()
+            if self._data is None or self.is_stale():
+                self.refresh()
+        except Exception:
+            self._failed_at = time.monotonic()
+            logger.exception('Failed to refresh %s, next attempt in %ss', type(self).__name__,
+                             settings.DIRECTORY_REFRESH_BACKOFF)
+        else:
+            self._failed_at = None
+        finally:
+            self._refreshing = False
+            connection.close()
+
+
+class BusStopDirectory(LocalDirectory):
+    """
+    Справочник остановок Avibus (GetBusStops): таблица BusStop плюс копия в памяти.
+    """
+    ttl_setting = 'BUS_STOPS_TTL'
+
+    def travel_directions(self):
+        """
+        Возвращает автоматизированные остановки в формате представления get_directions.
+
+        Returns:
+            list[dict]: Остановки с ключами id и name.
+        """
+        return self.data()
+
+    def refresh(self):
+        """
+        Загружает остановки из Avibus (GetBusStops) и сохраняет их в БД и в память.
+
+        Returns:
+            int: Количество сохраненных остановок.
+        """
+        stops = call(WSDL_SCHEDULE, 'GetBusStops') or []
+        now = timezone.now()
+        rows = [BusStop(id=bs.Id, name=bs.Name, automated=bool(bs.Automated), updated_at=now) for bs in stops]
+        rows.sort(key=lambda row: row.name)
+
+        with transaction.atomic():
+            BusStop.objects.all().delete()
+            BusStop.objects.bulk_create(rows)
+
+        self._set([{'id': row.id, 'name': row.name} for row in rows if row.automated], now.timestamp())
+        return len(rows)
+
+    def _load(self):
+        # Пустой справочник загружаем из SOAP сразу: без него главной странице нечего показать.
+        updated_at = BusStop.objects.aggregate(updated_at=Max('updated_at'))['updated_at']
+        if updated_at is None:
+            self.refresh()
+            return
+        stops = BusStop.objects.filter(automated=True).values_list('id', 'name')
+        self._set([{'id': stop_id, 'name': name} for stop_id, name in stops], updated_at.timestamp())
+
+
+def ngrams(text):
+    """
+    Возвращает множество n-грамм строки для индекса поиска по подстроке.
+
+    Args:
+        text (str): Строка в нижнем регистре.
+
+    Returns:
+        set[str]: N-граммы длины NGRAM_SIZE.
+    """
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+class DestinationGraph:
+    """
+    Граф «пункт отправления → пункты назначения» с n-граммным индексом названий.
+
+    Каждый пункт назначения хранится один раз, а для пунктов отправления хранятся
+    только массивы номеров пунктов назначения, отсортированные по названию.
+    """
+
+    def __init__(self, edges):
+        """
+        Args:
+            edges (Iterable[tuple[str, str, str]]): Тройки (пункт отправления, id пункта назначения, название).
+        """
+        self._ids = []
+        self._names = []
+        self._folded = []
+        positions = {}
+        by_departure = defaultdict(set)
+        for departure_id, destination_id, name in edges:
+            position = positions.get(destination_id)
+            if position is None:
+                position = positions[destination_id] = len(self._ids)
+                self._ids.append(destination_id)
+                self._names.append(name)
+                self._folded.append(name.casefold())
+            by_departure[departure_id].add(position)
+
+        self._departures = {
+            departure_id: array('I', sorted(destinations, key=self._folded.__getitem__))
+            for departure_id, destinations in by_departure.items()
+        }
+
+        grams = defaultdict(list)
+        for position, name in enumerate(self._folded):
+            for gram in ngrams(name):
+                grams[gram].append(position)
+        self._grams = {gram: array('I', postings) for gram, postings in grams.items()}
+
+    def __contains__(self, departure_id):
+        return departure_id in self._departures
+
+    def departures(self):
+        return self._departures.keys()
+
+    def destinations(self, departure_id, substring=''):
+        """
+        Возвращает пункты назначения для пункта отправления, название которых содержит подстроку.
+        Совпадения с начала названия идут первыми.
+
+        Args:
+            departure_id (str): Идентификатор пункта отправления.
+            substring (str): Подстрока названия, как в параметре Substring у GetDestinations.
+
+        Returns:
+            list[dict] | None: Пункты назначения с ключами id и name, None для неизвестного пункта отправления.
+        """
+        positions = self._departures.get(departure_id)
+        if positions is None:
+            return None
+
+        needle = substring.strip().casefold()
+        if needle:
+            if len(needle) >= NGRAM_SIZE:
+                postings = sorted((self._grams.get(gram, ()) for gram in ngrams(needle)), key=len)
+                candidates = set(postings[0])
+                for posting in postings[1:]:
+                    candidates.intersection_update(posting)
+                positions = [p for p in positions if p in candidates and needle in self._folded[p]]
+            else:
+                positions = [p for p in positions if needle in self._folded[p]]
+            positions.sort(key=lambda p: not self._folded[p].startswith(needle))
+
+        return [{'id': self._ids[p], 'name': self._names[p]} for p in positions]
+
+
+class DestinationIndex(LocalDirectory):
+    """
+    Пункты назначения для всех автоматизированных остановок (GetDestinations): таблица Destination
+    плюс DestinationGraph в памяти. Перестраивается целиком раз в DESTINATIONS_TTL.
+    """
+    ttl_setting = 'DESTINATIONS_TTL'
+
+    def destinations(self, departure_id, substring=''):
+        """
+        Ищет пункты назначения в локальном индексе.
+
+        Args:
+            departure_id (str): Идентификатор пункта отправления.
+            substring (str): Подстрока названия пункта назначения.
+
+        Returns:
+            list[dict] | None: Пункты назначения или None, если индекс еще не построен или не знает пункт отправления.
+        """
+        graph = self.data()
+        if graph is None:
+            self.refresh_in_background()
+            return None
+        return graph.destinations(departure_id, substring)
+
+    def refresh(self):
+        """
+        Перестраивает индекс, параллельно запрашивая GetDestinations для каждой автоматизированной остановки.
+        Если для части остановок запрос не удался, для них остаются прежние строки индекса, а остановки
+        пишутся в лог; если не удался ни один запрос, индекс не меняется.
+
+        Returns:
+            int: Количество сохраненных пар «отправление — назначение».
+
+        Raises:
+            Exception: Ошибка GetDestinations, если не удался ни один запрос.
+        """
+        departures = [stop['id'] for stop in bus_stops.travel_directions()]
+
+        def fetch(departure_id):
+            try:
+                return departure_id, call(WSDL_SALE, 'GetDestinations', Departure=departure_id, Substring='') or [], None
+            except Exception as exc:
+                return departure_id, None, exc
+
+        with ThreadPoolExecutor(max_workers=settings.DESTINATIONS_REBUILD_WORKERS) as pool:
+            results = list(pool.map(fetch, departures))
+
+        failed = {departure_id: exc for departure_id, _, exc in results if exc is not None}
+        if failed:
+            logger.warning('GetDestinations failed for %s of %s stops, keeping their previous destinations: %s',
+                           len(failed), len(departures),
+                           ', '.join(f'{departure_id} ({exc})' for departure_id, exc in failed.items()))
+            if len(failed) == len(departures):
+                raise next(iter(failed.values()))
+
+        now = timezone.now()
+        rows = [Destination(departure_id=departure_id, destination_id=dis.Id, name=dis.Name, updated_at=now)
+                for departure_id, destinations, exc in results if exc is None for dis in destinations]
+
+        with transaction.atomic():
+            Destination.objects.exclude(departure_id__in=failed).delete()
+            Destination.objects.bulk_create(rows, batch_size=1000)
+            edges = list(Destination.objects.values_list('departure_id', 'destination_id', 'name'))
+
+        self._set(DestinationGraph(edges), now.timestamp())
+        return len(rows)
+
+    def _load(self):
+        updated_at = Destination.objects.aggregate(updated_at=Max('updated_at'))['updated_at']
+        if updated_at is None:
+            return
+        edges = Destination.objects.values_list('departure_id', 'destination_id', 'name').iterator()
+        self._set(DestinationGraph(edges), updated_at.timestamp())
+
+
+bus_stops = BusStopDirectory()
+destinations = DestinationIndex()
@@ -0,0 +1,166 @@
+import asyncio
+import gzip
+import hashlib
+import re
+from functools import wraps
+
+import brotli
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+
+from .cache import TTLCache
+
+re_quality = re.compile(r'^[0-9.]+$')
+
+# Кодировки сжатия в порядке предпочтения при равном весе q.
+ENCODINGS = ('br', 'gzip')
+
+# Сжатые тела ответов по (ETag, кодировка): одинаковые справочники не сжимаются повторно.
+compressed_bodies = TTLCache('compressed_bodies', ttl=60 * 60, maxsize=256)
+
+
+def make_etag(content):
+    return '"%s"' % hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def etag_matches(request, etag):
+    """
+    Проверяет заголовок If-None-Match слабым сравнением, как требует RFC 7232.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+        etag (str): ETag ответа.
+
+    Returns:
+        bool: True, если у клиента уже есть эта версия ответа.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in etags)
+
+
+def parse_accept_encoding(header):
+    """
+    Разбирает заголовок Accept-Encoding (RFC 9110, 12.5.3).
+
+    Args:
+        header (str): Значение заголовка.
+
+    Returns:
+        dict: Вес q по кодировке в нижнем регистре; кодировки с некорректным q получают вес 0.
+    """
+    qualities = {}
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() != 'q':
+                continue
+            try:
+                quality = min(float(value.strip()), 1.0) if re_quality.match(value.strip()) else 0.0
+            except ValueError:
+                quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def choose_encoding(request):
+    """
+    Выбирает сжатие ответа по Accept-Encoding: кодировку с наибольшим весом q, при равном весе br.
+    Кодировки с q=0 клиент явно не принимает; '*' задает вес кодировок, не названных явно.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+
+    Returns:
+        str | None: 'br', 'gzip' или None, если сжимать не нужно.
+    """
+    qualities = parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    default = qualities.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, default)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=settings.RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+def finalize_conditional(request, response, max_age):
+    """
+    Добавляет к ответу ETag, Cache-Control и сжатие или заменяет его на 304 (см. conditional_json).
+
+    Args:
+        request (HttpRequest): Запрос Django.
+        response (HttpResponse): Ответ представления.
+        max_age (int): Сколько секунд клиент может использовать ответ без проверки.
+
+    Returns:
+        HttpResponse: Итоговый ответ.
+    """
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+        return response
+
+    patch_cache_control(response, public=True, max_age=max_age)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if response.streaming:
+        return response
+
+    etag = make_etag(response.content)
+    if etag_matches(request, etag):
+        not_modified = HttpResponseNotModified()
+        for header in ('Cache-Control', 'Vary'):
+            not_modified[header] = response[header]
+        not_modified['ETag'] = etag
+        return not_modified
+
+    encoding = choose_encoding(request)
+    if encoding is None or len(response.content) < settings.RESPONSE_COMPRESS_MIN_SIZE:
+        response['ETag'] = etag
+        return response
+
+    body = compressed_bodies.get_or_load((etag, encoding), lambda: compress(response.content, encoding))
+    response.content = body
+    response['Content-Length'] = str(len(body))
+    response['Content-Encoding'] = encoding
+    # Сжатое представление отличается побайтно, поэтому ETag слабый, как у GZipMiddleware.
+    response['ETag'] = 'W/' + etag
+    return response
+
+
+def conditional_json(max_age):
+    """
+    Декоратор для редко меняющихся JSON-ответов: добавляет ETag по содержимому, отвечает 304
+    на совпадающий If-None-Match, выставляет Cache-Control и сжимает большие ответы br или gzip.
+    Потоковые ответы получают только Cache-Control. Подходит и для асинхронных представлений.
+
+    Args:
+        max_age (int): Сколько секунд клиент может использовать ответ без проверки.
+
+    Returns:
+        Callable: Декоратор представления.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                return finalize_conditional(request, await view(request, *args, **kwargs), max_age)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return finalize_conditional(request, view(request, *args, **kwargs), max_age)
+        return wrapper
+    return decorator
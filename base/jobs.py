@@ -0,0 +1,368 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+import orjson
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job, Order, ReturnOrder
+from .orders import record_order_status, record_return_status
+from .serializers import dumps
+from .soap import WSDL_SALE
+from .admission import AdmissionRejectedError
+from .upstream import CircuitOpenError, call
+
+logger = logging.getLogger(__name__)
+
+# CancelPayment можно вызвать только в течение 10 минут после Payment.
+CANCEL_PAYMENT_WINDOW = datetime.timedelta(minutes=10)
+# Заказ на возврат актуален 30 минут после создания.
+RETURN_ORDER_LIFETIME = datetime.timedelta(minutes=30)
+
+# Будит воркеры этого процесса, когда в очередь ставится задача.
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def cancel_payment_deadline(order_id):
+    order = Order.objects.filter(number=order_id).only('paid_at').first()
+    if order is None or order.paid_at is None:
+        return None
+    return order.paid_at + CANCEL_PAYMENT_WINDOW
+
+
+def return_order_deadline(return_order_id):
+    return_order = ReturnOrder.objects.filter(number=return_order_id).only('created_at').first()
+    if return_order is None:
+        return None
+    return return_order.created_at + RETURN_ORDER_LIFETIME
+
+
+class JobOperation:
+    """
+    Операция Avibus, выполняемая через очередь: метод SOAP, параметр с номером заказа,
+    сохранение результата в локальные модели и срок, после которого вызывать ее бессмысленно.
+    """
+
+    def __init__(self, soap_operation, key_param, record, deadline=None):
+        self.soap_operation = soap_operation
+        self.key_param = key_param
+        self.record = record
+        self.deadline = deadline
+
+    def get_deadline(self, key):
+        return self.deadline(key) if self.deadline else None
+
+    def run(self, params):
+        result = call(WSDL_SALE, self.soap_operation, **params)
+        self.record(params[self.key_param], result)
+        return result
+
+
+OPERATIONS = {
+    'payment': JobOperation(
+        'Payment', 'OrderId',
+        lambda order_id, result: record_order_status(order_id, Order.STATUS_PAID, result)),
+    'cancel_payment': JobOperation(
+        'CancelPayment', 'OrderId',
+        lambda order_id, result: record_order_status(order_id, Order.STATUS_PAYMENT_CANCELLED, result),
+        deadline=cancel_payment_deadline),
+    'return_payment': JobOperation(
+        'ReturnPayment', 'ReturnOrderId',
+        lambda return_order_id, result: record_return_status(return_order_id, ReturnOrder.STATUS_PAID, result),
+        deadline=return_order_deadline),
+    'cancel_return_payment': JobOperation(
+        'CancelReturnPayment', 'ReturnOrderId',
+        lambda return_order_id, result: record_return_status(return_order_id, ReturnOrder.STATUS_CANCELLED,
+                                                             result),
+        deadline=return_order_deadline),
+}
+
+
+def enqueue(operation, params):
+    """
+    Ставит операцию в очередь. Если такая же операция по этому заказу уже выполнена, еще не завершена
+    или ждет сверки, возвращает ее задачу вместо новой, чтобы повторный запрос клиента не оплатил заказ дважды.
+    Новая задача ставится только после неудачной или просроченной.
+    Одновременные запросы из разных процессов разводит условный уникальный индекс по (operation, key).
+
+    Args:
+        operation (str): Имя операции из OPERATIONS.
+        params (dict): Параметры метода SOAP.
+
+    Returns:
+        Job: Задача.
+    """
+    spec = OPERATIONS[operation]
+    key = params[spec.key_param]
+    existing = Job.objects.filter(operation=operation, key=key,
+                                  status__in=Job.UNRESOLVED_STATUSES + (Job.STATUS_DONE,))
+    job = existing.first()
+    if job is None:
+        try:
+            with transaction.atomic():
+                job = Job.objects.create(operation=operation, key=key, params=params, run_after=timezone.now(),
+                                         max_attempts=settings.JOBS_MAX_ATTEMPTS, deadline=spec.get_deadline(key))
+        except IntegrityError:
+            # Такую же задачу только что поставил другой запрос.
+            job = existing.first()
+            if job is None:
+                raise
+    _wakeup.set()
+    return job
+
+
+def is_retryable(exc):
+    """
+    Проверяет, можно ли повторить операцию после ошибки. Оплата и возврат не идемпотентны,
+    поэтому повторяются только ошибки, при которых запрос точно не ушел в Avibus: таймаут или отказ
+    при установке соединения, отказ автомата отключения порта и ограничителя вызовов.
+    Обрыв соединения, таймаут чтения и ответы 5xx возможны после того, как Avibus уже выполнил операцию.
+
+    Args:
+        exc (Exception): Ошибка вызова.
+
+    Returns:
+        bool: True, если запрос можно отправить еще раз.
+    """
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(exc, (requests.ConnectTimeout, CircuitOpenError, AdmissionRejectedError)):
+        return True
+    if not isinstance(exc, requests.ConnectionError):
+        return False
+    # requests оборачивает ошибку urllib3: NewConnectionError лежит в reason у MaxRetryError.
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, NewConnectionError):
+            return True
+        seen.add(id(exc))
+        reason = exc.args[0] if exc.args and isinstance(exc.args[0], BaseException) else None
+        exc = getattr(exc, 'reason', None) or reason or exc.__cause__ or exc.__context__
+    return False
+
+
+def is_declined(exc):
+    """
+    Проверяет, отказал ли Avibus в операции ответом SOAP Fault: операция не выполнена, и ее можно
+    считать завершенной с ошибкой.
+
+    Args:
+        exc (Exception): Ошибка вызова.
+
+    Returns:
+        bool: True для SOAP Fault.
+    """
+    from zeep.exceptions import Fault
+
+    return isinstance(exc, Fault)
+
+
+def claim_job(worker):
+    """
+    Забирает из очереди первую готовую к запуску задачу. Захват выполняется условным UPDATE,
+    поэтому одну задачу не возьмут два воркера, даже из разных процессов.
+
+    Args:
+        worker (str): Имя воркера.
+
+    Returns:
+        Job | None: Захваченная задача или None, если очередь пуста.
+    """
+    now = timezone.now()
+    candidates = Job.objects.filter(status=Job.STATUS_QUEUED, run_after__lte=now).order_by('run_after')
+    for job_id in candidates.values_list('pk', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=job_id, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_RUNNING, worker=worker, started_at=now, attempts=F('attempts') + 1)
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+def finish(job, status, result=None, error=''):
+    job.status = status
+    job.result = result
+    job.error = error
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+
+
+def run_job(job):
+    """
+    Выполняет захваченную задачу. Если запрос точно не ушел в Avibus, задача возвращается в очередь
+    с экспоненциальной задержкой, пока остаются попытки и повтор успевает до срока операции.
+    Отказ Avibus (SOAP Fault) завершает задачу с ошибкой, а любой другой сбой переводит ее в статус reconcile:
+    операция могла выполниться в Avibus, и повторять ее до сверки нельзя.
+
+    Args:
+        job (Job): Задача в статусе running.
+    """
+    spec = OPERATIONS[job.operation]
+    now = timezone.now()
+    if job.deadline and now >= job.deadline:
+        finish(job, Job.STATUS_EXPIRED, error=f'Срок операции истек в {job.deadline.isoformat()}')
+        return
+
+    try:
+        result = spec.run(job.params)
+    except Exception as exc:
+        logger.warning('Job %s %s attempt %s failed: %s', job.pk, job.operation, job.attempts, exc)
+        if is_retryable(exc):
+            run_after = now + datetime.timedelta(seconds=settings.JOBS_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+            if job.attempts < job.max_attempts and (job.deadline is None or run_after < job.deadline):
+                job.status = Job.STATUS_QUEUED
+                job.run_after = run_after
+                job.error = str(exc)
+                job.save(update_fields=['status', 'run_after', 'error'])
+                return
+            finish(job, Job.STATUS_FAILED, error=str(exc))
+        elif is_declined(exc):
+            finish(job, Job.STATUS_FAILED, error=str(exc))
+        else:
+            logger.error('Job %s %s needs reconciliation after %r', job.pk, job.operation, exc)
+            finish(job, Job.STATUS_RECONCILE, error=f'Исход операции неизвестен, нужна сверка с Avibus: {exc}')
+    else:
+        finish(job, Job.STATUS_DONE, result=orjson.loads(dumps(result)))
+
+
+def reconcile_stale():
+    """
+    Разбирает задачи, зависшие в статусе running после падения воркера. Все операции очереди
+    (оплата, возврат и их отмена) не идемпотентны и могли выполниться в Avibus, поэтому не повторяются,
+    а переводятся в статус reconcile до сверки с Avibus. Без зависших задач выполняется только чтение,
+    и блокировка записи SQLite не берется.
+
+    Returns:
+        int: Сколько задач переведено на сверку.
+    """
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.STATUS_RUNNING,
+                               started_at__lt=now - datetime.timedelta(seconds=settings.JOBS_STALE_AFTER))
+    if not stale.exists():
+        return 0
+    reconcile = stale.update(
+        status=Job.STATUS_RECONCILE, finished_at=now,
+        error='Воркер не завершил задачу, Avibus мог ее выполнить: нужна сверка, повтор не выполняется')
+    if reconcile:
+        logger.error('%s stale jobs need reconciliation', reconcile)
+    return reconcile
+
+
+def run_next(worker):
+    """
+    Захватывает и выполняет одну задачу.
+
+    Args:
+        worker (str): Имя воркера.
+
+    Returns:
+        bool: True, если задача была выполнена.
+    """
+    job = claim_job(worker)
+    if job is None:
+        return False
+    run_job(job)
+    return True
+
+
+class JobWorker(threading.Thread):
+    """
+    Поток, выполняющий задачи очереди. Без задач ждет постановки новой в этом процессе
+    или JOBS_POLL_INTERVAL секунд, чтобы увидеть задачи, поставленные другими процессами.
+    Зависшие задачи разбирает только первый воркер процесса и не чаще раза в JOBS_STALE_AFTER / 2 секунд.
+    """
+
+    def __init__(self, index=0):
+        super().__init__(name=f'jobs-{os.getpid()}-{index}', daemon=True)
+        self.stopping = threading.Event()
+        self.sweeps = index == 0
+        self.next_sweep = 0.0
+
+    def sweep_if_due(self):
+        if not self.sweeps or time.monotonic() < self.next_sweep:
+            return
+        self.next_sweep = time.monotonic() + settings.JOBS_STALE_AFTER / 2
+        reconcile_stale()
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                try:
+                    self.sweep_if_due()
+                    processed = run_next(self.name)
+                except Exception:
+                    logger.exception('Job worker %s failed', self.name)
+                    processed = False
+                if not processed:
+                    _wakeup.wait(settings.JOBS_POLL_INTERVAL)
+                    _wakeup.clear()
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopping.set()
+        _wakeup.set()
+
+
+def start_workers(count=None):
+    """
+    Запускает потоки-воркеры в текущем процессе, если они еще не запущены.
+
+    Args:
+        count (int | None): Количество потоков; по умолчанию JOBS_WORKERS.
+
+    Returns:
+        list[JobWorker]: Запущенные воркеры.
+    """
+    count = settings.JOBS_WORKERS if count is None else count
+    with _workers_lock:
+        while len(_workers) < count:
+            worker = JobWorker(len(_workers))
+            worker.start()
+            _workers.append(worker)
+    return list(_workers)
+
+
+def wait_for_job(job_id, timeout):
+    """
+    Ждет завершения задачи не дольше timeout секунд (long-poll).
+
+    Args:
+        job_id (int): Идентификатор задачи.
+        timeout (float): Сколько секунд ждать.
+
+    Returns:
+        Job | None: Задача в последнем известном состоянии или None, если ее нет.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = Job.objects.filter(pk=job_id).first()
+        if job is None or job.status not in Job.ACTIVE_STATUSES or time.monotonic() >= deadline:
+            return job
+        time.sleep(min(settings.JOBS_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+
+def job_to_dict(job):
+    return {
+        'job_id': job.pk,
+        'operation': job.operation,
+        'key': job.key,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'run_after': job.run_after,
+        'deadline': job.deadline,
+        'result': job.result,
+        'error': job.error,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from base.soap import WSDL_SALE, WSDL_SCHEDULE, download_wsdl
+from base.standin import AvibusStandin, make_standin_server, parse_operation_latency, standin_url
+
+
+class Command(BaseCommand):
+    help = ('Запускает подменный сервис Avibus, который отдает WSDL и записанные ответы операций '
+            'с заданной задержкой и долей ошибок, для нагрузочных тестов без dev.avibus.pro.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес прослушивания.')
+        parser.add_argument('--port', type=int, default=8765, help='Порт.')
+        parser.add_argument('--dir', default=None,
+                            help='Каталог с WSDL и записями ответов, по умолчанию AVIBUS_RECORDINGS_DIR.')
+        parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа в секундах.')
+        parser.add_argument('--jitter', type=float, default=0.0,
+                            help='Случайная добавка к задержке, от 0 до указанного числа секунд.')
+        parser.add_argument('--op-latency', nargs='*', default=[], metavar='OPERATION=SECONDS',
+                            help='Задержка отдельных операций, например GetTrips=0.8 Payment=2.')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Доля вызовов, на которые отвечается 503.')
+        parser.add_argument('--fault-rate', type=float, default=0.0,
+                            help='Доля вызовов, на которые отвечается SOAP Fault.')
+        parser.add_argument('--seed', type=int, default=None, help='Начальное значение генератора случайных чисел.')
+        parser.add_argument('--download', action='store_true',
+                            help='Сохранить в каталог записей WSDL и XSD с сервера Avibus перед запуском.')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.AVIBUS_RECORDINGS_DIR
+        try:
+            operation_latency = parse_operation_latency(options['op_latency'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if options['download']:
+            for wsdl in (WSDL_SCHEDULE, WSDL_SALE):
+                for path in download_wsdl(wsdl, directory):
+                    self.stdout.write(f'Сохранен {path}')
+
+        app = AvibusStandin(directory, latency=options['latency'], jitter=options['jitter'],
+                            operation_latency=operation_latency, error_rate=options['error_rate'],
+                            fault_rate=options['fault_rate'], seed=options['seed'])
+        server = make_standin_server(app, options['host'], options['port'])
+        self.stdout.write(self.style.SUCCESS(f'Подменный сервис Avibus запущен: AVIBUS_URL={standin_url(server)}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for operation, outcomes in app.stats().items():
+                self.stdout.write(f'{operation}: ' + ', '.join(f'{name}={count}' for name, count in outcomes.items()))
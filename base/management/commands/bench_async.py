@@ -0,0 +1,72 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+
+def count_errors(statuses):
+    return sum(1 for status in statuses if not 200 <= status < 300)
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает пропускную способность синхронного (WSGI, пул потоков) '
+            'и асинхронного (ASGI) представления при одинаковом числе одновременных запросов. '
+            'Ответы не из диапазона 2xx считаются ошибками.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='search_trips/',
+                            help='Путь представления без ведущего слеша, асинхронная версия берется из async/<path>.')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Сколько запросов отправить для каждого уровня параллельности.')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200],
+                            help='Уровни параллельности (потоков WSGI и одновременных корутин ASGI).')
+        parser.add_argument('--wsgi-threads', type=int, default=None,
+                            help='Ограничение потоков WSGI-воркера, по умолчанию равно уровню параллельности.')
+
+    def handle(self, *args, **options):
+        sync_path = '/' + options['path']
+        async_path = '/async/' + options['path']
+        total = options['requests']
+
+        with override_settings(ALLOWED_HOSTS=['*']):
+            self.stdout.write(f"{'concurrency':>11} {'wsgi rps':>10} {'asgi rps':>10} {'wsgi s':>8} {'asgi s':>8} "
+                              f"{'wsgi err':>9} {'asgi err':>9}")
+            for concurrency in options['concurrency']:
+                threads = min(concurrency, options['wsgi_threads'] or concurrency)
+                wsgi_seconds, wsgi_errors = self.run_wsgi(sync_path, total, threads)
+                asgi_seconds, asgi_errors = asyncio.run(self.run_asgi(async_path, total, concurrency))
+                # Пропускная способность считается только по успешным ответам.
+                self.stdout.write(f'{concurrency:>11} {(total - wsgi_errors) / wsgi_seconds:>10.1f} '
+                                  f'{(total - asgi_errors) / asgi_seconds:>10.1f} '
+                                  f'{wsgi_seconds:>8.2f} {asgi_seconds:>8.2f} {wsgi_errors:>9} {asgi_errors:>9}')
+                if wsgi_errors or asgi_errors:
+                    self.stdout.write(self.style.WARNING(
+                        f'Ошибки при параллельности {concurrency}: WSGI {wsgi_errors}, ASGI {asgi_errors}'))
+
+    @staticmethod
+    def run_wsgi(path, total, threads):
+        client = Client(raise_request_exception=False)
+
+        def call(_):
+            return client.get(path).status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            statuses = list(pool.map(call, range(total)))
+        return time.perf_counter() - started, count_errors(statuses)
+
+    @staticmethod
+    async def run_asgi(path, total, concurrency):
+        client = AsyncClient(raise_request_exception=False)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call():
+            async with semaphore:
+                return (await client.get(path)).status_code
+
+        started = time.perf_counter()
+        statuses = await asyncio.gather(*(call() for _ in range(total)))
+        return time.perf_counter() - started, count_errors(statuses)
@@ -0,0 +1,56 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import JsonResponse
+from requests import Response
+from zeep.helpers import serialize_object
+
+from base.serializers import json_response
+from base.soap import WSDL_SALE, WSDL_SCHEDULE, get_client
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает serialize_object + JsonResponse с быстрым json_response '
+            'на записанных ответах Avibus (XML-конверты SOAP).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('responses', nargs='+',
+                            help='Файлы с записанными ответами; имя файла начинается с имени операции, '
+                                 'например GetTrips.xml или GetTrips-2023-06-09.xml.')
+        parser.add_argument('--port', choices=['sale', 'schedule'], default='sale',
+                            help='Порт Avibus, WSDL которого описывает операции.')
+        parser.add_argument('--repeat', type=int, default=200,
+                            help='Сколько раз кодировать каждый ответ.')
+
+    def handle(self, *args, **options):
+        client = get_client(WSDL_SALE if options['port'] == 'sale' else WSDL_SCHEDULE)
+        binding = client.service._binding
+        repeat = options['repeat']
+
+        self.stdout.write(f"{'response':<40} {'bytes':>9} {'current ms':>11} {'fast ms':>9} {'speedup':>8}")
+        for path in map(Path, options['responses']):
+            operation = path.stem.split('-', 1)[0]
+            try:
+                operation_obj = binding.get(operation)
+            except ValueError:
+                raise CommandError(f'Операция {operation} не найдена в WSDL')
+
+            response = Response()
+            response.status_code = 200
+            response._content = path.read_bytes()
+            response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+            bus_results = binding.process_reply(client, operation_obj, response)
+
+            current = self.measure(repeat, lambda: JsonResponse(serialize_object(bus_results), safe=False))
+            fast = self.measure(repeat, lambda: json_response(bus_results))
+            size = len(json_response(bus_results).content)
+            self.stdout.write(f'{path.name:<40} {size:>9} {current * 1000:>11.3f} {fast * 1000:>9.3f} '
+                              f'{current / fast:>7.1f}x')
+
+    @staticmethod
+    def measure(repeat, func):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - started) / repeat
@@ -0,0 +1,406 @@
+import asyncio
+import datetime
+import math
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import orjson
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from base import standin, urls
+from base.soap import AVIBUS_URL
+
+# Представления, которым нужны параметры или тело запроса; остальные вызываются GET без параметров
+# и берут значения по умолчанию из самого представления.
+BENCH_REQUESTS = {
+    'job_status': ('GET', {'job_id': '1'}),
+    'bulk_ticket_status': ('POST', {'tickets': [
+        {'departure': '862fd93e-e633-11e7-80e7-00175d776a07', 'ticket': f'0000000533{number:04}'}
+        for number in range(4018, 4038)
+    ]}),
+    'book_order': ('POST', {
+        'trip_id': '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041',
+        'departure': '862fd93e-e633-11e7-80e7-00175d776a07',
+        'destination': 'cb654d84-f487-11ed-83c7-d00da3a6c886',
+        'ticket_seats': [{'FareName': 'Пассажирский', 'SeatNum': '1'}],
+        'tickets': [{'SeatNum': '1', 'FareName': 'Пассажирский', 'PersonalData': [
+            {'Name': 'ФИО', 'Value': 'Дроздов Щегол Филинович'},
+            {'Name': 'Удостоверение', 'Value': '98 76 543210', 'ValueKind': 'Паспорт гражданина РФ'},
+        ]}],
+        'customer': {'Email': 'example@mail.com'},
+    }),
+}
+ORDER_KEYS = {'keys': ('Number', 'Status')}
+JOB_KEYS = {'keys': ('job_id', 'status')}
+# Проверка тела ответа: keys — обязательные поля объекта, items — списки, которые должны быть непустыми
+# и у каждого элемента которых есть перечисленные поля, empty — поля, которые должны быть пустыми
+# (ошибки по дням или пунктам назначения). Асинхронные представления проверяются как синхронные.
+BENCH_CHECKS = {
+    'get_directions': {'items': {'travel_directions': ('id', 'name')}},
+    'get_destinations': {'items': {'end_directions': ('id', 'name')}},
+    'search_trips': {'items': {'Elements': ('Id', 'DepartureTime', 'Departure', 'Destination')}},
+    'search_trips_range': {'items': {'trips': ('date', 'Id')}, 'empty': ('errors',)},
+    'search_anywhere': {'items': {'destinations': ('id', 'name', 'trips', 'min_price')}, 'empty': ('errors',)},
+    'search_trip_segment': {'keys': ('Id', 'Departure', 'Destination')},
+    'get_occupied_seats': {'items': {'Elements': ('SeatNum',)}},
+    'start_sale_session': ORDER_KEYS,
+    'add_tickets': ORDER_KEYS,
+    'add_tickets_baggage': ORDER_KEYS,
+    'del_tickets': ORDER_KEYS,
+    'change_fare_name': ORDER_KEYS,
+    'set_ticket_data': ORDER_KEYS,
+    'reserve_order': ORDER_KEYS,
+    'book_order': {'keys': ('order_id', 'order', 'steps')},
+    'make_payment': JOB_KEYS,
+    'cancel_payment': JOB_KEYS,
+    'create_return_order': ORDER_KEYS,
+    'add_ticket_return': ORDER_KEYS,
+    'delete_ticket_return': ORDER_KEYS,
+    'return_payment': JOB_KEYS,
+    'cancel_return_payment': JOB_KEYS,
+    'get_ticket_status': ORDER_KEYS,
+    'bulk_ticket_status': {'items': {'tickets': ('status',)}},
+    'job_status': JOB_KEYS,
+    'order_status': {'keys': ('number', 'status'), 'items': {'tickets': ('number',)}},
+    'ticket_info': {'keys': ('number', 'status')},
+    'trip_tickets': {'items': {'tickets': ('number',)}},
+}
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, q):
+    """
+    Перцентиль по методу ближайшего ранга.
+
+    Args:
+        values (list[float]): Отсортированные значения.
+        q (float): Перцентиль от 0 до 100.
+
+    Returns:
+        float: Значение перцентиля или 0 для пустого списка.
+    """
+    if not values:
+        return 0.0
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def parse_server_timing(header):
+    """
+    Разбирает заголовок Server-Timing от MetricsMiddleware.
+
+    Args:
+        header (str | None): Значение заголовка.
+
+    Returns:
+        dict: Длительность в миллисекундах по имени метрики (upstream, serialize, local, total)
+            и число вызовов Avibus в upstream_calls.
+    """
+    result = {}
+    for metric in (header or '').split(','):
+        name, *params = [part.strip() for part in metric.split(';')]
+        for param in params:
+            key, _, value = param.partition('=')
+            if key == 'dur':
+                result[name] = float(value)
+            elif key == 'desc' and name == 'upstream':
+                result['upstream_calls'] = int(value.strip('"') or 0)
+    return result
+
+
+def check_body(name, status, content):
+    """
+    Проверяет ответ представления: код 2xx, JSON и поля из BENCH_CHECKS. Ответ 200 с пустым
+    или неполным телом (например, без поездок) считается ошибкой, как и ответ 5xx.
+
+    Args:
+        name (str): Имя представления в base/urls.py.
+        status (int): Код ответа.
+        content (bytes): Тело ответа.
+
+    Returns:
+        str | None: Описание проблемы или None, если ответ корректен.
+    """
+    if not 200 <= status < 300:
+        return f'HTTP {status}'
+    try:
+        body = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return 'тело не JSON'
+    check = BENCH_CHECKS.get(name.removeprefix('async_'), {})
+    if check and not isinstance(body, dict):
+        return f'ожидался объект, получено {type(body).__name__}'
+    missing = [key for key in check.get('keys', ()) if body.get(key) is None]
+    if missing:
+        return 'нет полей ' + ', '.join(missing)
+    for key, item_keys in check.get('items', {}).items():
+        items = body.get(key)
+        if not isinstance(items, list) or not items:
+            return f'пустой список {key}'
+        for item in items:
+            if not isinstance(item, dict) or any(item.get(item_key) is None for item_key in item_keys):
+                return f'в {key} элемент без полей {", ".join(item_keys)}: {str(item)[:100]}'
+    filled = [key for key in check.get('empty', ()) if body.get(key)]
+    if filled:
+        return f"непустое поле {filled[0]}: {str(body[filled[0]])[:100]}"
+    return None
+
+
+def summarize_ms(values):
+    values = sorted(values)
+    summary = {f'p{q}': round(percentile(values, q), 2) for q in PERCENTILES}
+    summary['mean'] = round(sum(values) / len(values), 2) if values else 0.0
+    summary['max'] = round(values[-1], 2) if values else 0.0
+    return summary
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return ''
+    return result.stdout.strip()
+
+
+class Command(BaseCommand):
+    help = ('Нагружает каждое представление base/urls.py через подменный сервис Avibus и выводит '
+            'пропускную способность и задержки p50/p95/p99 с разбивкой на ожидание Avibus и локальное время. '
+            'Результаты сохраняются в JSON для сравнения между коммитами.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--views', nargs='*', default=[],
+                            help='Имена представлений (name в base/urls.py); по умолчанию все.')
+        parser.add_argument('--skip', nargs='*', default=[], help='Имена представлений, которые не нагружать.')
+        parser.add_argument('--requests', type=int, default=200, help='Запросов к каждому представлению.')
+        parser.add_argument('--concurrency', type=int, default=10, help='Одновременных запросов.')
+        parser.add_argument('--warmup', type=int, default=1,
+                            help='Запросов к представлению перед замером (не учитываются).')
+        parser.add_argument('--standin', choices=['inprocess', 'server', 'none'], default='inprocess',
+                            help='inprocess — подменный сервис в транспорте процесса (асинхронные представления '
+                                 'пропускаются); server — HTTP-сервер на адресе AVIBUS_URL; none — '
+                                 'использовать AVIBUS_URL как есть (внешний подменный сервис).')
+        parser.add_argument('--latency', type=float, default=0.05, help='Задержка ответа подменного сервиса.')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Случайная добавка к задержке.')
+        parser.add_argument('--op-latency', nargs='*', default=[], metavar='OPERATION=SECONDS',
+                            help='Задержка отдельных операций, например GetTrips=0.8.')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 503.')
+        parser.add_argument('--fault-rate', type=float, default=0.0, help='Доля ответов SOAP Fault.')
+        parser.add_argument('--seed', type=int, default=None, help='Начальное значение генератора случайных чисел.')
+        parser.add_argument('--no-test-db', action='store_true',
+                            help='Писать в базу из настроек вместо временной тестовой базы.')
+        parser.add_argument('--output', default=None,
+                            help='Файл результатов JSON, по умолчанию bench/views-<коммит>-<время>.json.')
+        parser.add_argument('--compare', default=None, help='JSON прошлого прогона для сравнения.')
+
+    def handle(self, *args, **options):
+        cases = self.select_cases(options['views'], options['skip'])
+        try:
+            operation_latency = standin.parse_operation_latency(options['op_latency'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        app = standin.AvibusStandin(latency=options['latency'], jitter=options['jitter'],
+                                    operation_latency=operation_latency, error_rate=options['error_rate'],
+                                    fault_rate=options['fault_rate'], seed=options['seed'])
+
+        server = None
+        if options['standin'] == 'inprocess':
+            standin.install(app)
+            skipped = [case['name'] for case in cases if case['async']]
+            cases = [case for case in cases if not case['async']]
+            if skipped:
+                self.stdout.write(f"Асинхронные представления пропущены (нужен --standin server): {', '.join(skipped)}")
+        elif options['standin'] == 'server':
+            address = urlsplit(AVIBUS_URL)
+            if address.hostname not in ('127.0.0.1', 'localhost'):
+                raise CommandError(f'AVIBUS_URL={AVIBUS_URL} не локальный адрес; '
+                                   f'укажите, например, AVIBUS_URL=http://127.0.0.1:8765/UEEDev/ws/')
+            server = standin.start_standin_server(app, address.hostname, address.port or 80)
+
+        old_db_name = None
+        if not options['no_test_db']:
+            old_db_name = connection.settings_dict['NAME']
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = str(
+                Path(tempfile.gettempdir()) / 'poezdka_bench.sqlite3')
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        try:
+            with override_settings(ALLOWED_HOSTS=['*'], SERVER_TIMING_HEADER=True):
+                results = {}
+                self.stdout.write(f"{'view':<28} {'n':>5} {'err':>4} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} "
+                                  f"{'p99 ms':>8} {'upstr ms':>9} {'local ms':>9}")
+                for case in cases:
+                    results[case['name']] = result = self.run_case(case, options)
+                    self.stdout.write(
+                        f"{case['name']:<28} {result['requests']:>5} {result['errors']:>4} {result['rps']:>8.1f} "
+                        f"{result['latency_ms']['p50']:>8.1f} {result['latency_ms']['p95']:>8.1f} "
+                        f"{result['latency_ms']['p99']:>8.1f} {result['upstream_ms']['mean']:>9.1f} "
+                        f"{result['local_ms']['mean']:>9.1f}")
+                    for problem, count in result['problems'].items():
+                        self.stdout.write(self.style.WARNING(f'    {count} × {problem}'))
+        finally:
+            if options['standin'] == 'inprocess':
+                standin.uninstall()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if old_db_name is not None:
+                connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+        commit = git_commit()
+        report = {
+            'commit': commit,
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'options': {key: options[key] for key in ('requests', 'concurrency', 'warmup', 'standin', 'latency',
+                                                      'jitter', 'error_rate', 'fault_rate', 'seed')},
+            'operation_latency': operation_latency,
+            'views': results,
+            'standin_calls': app.stats(),
+        }
+        output = Path(options['output'] or Path(settings.BASE_DIR) / 'bench' / (
+            f"views-{commit or 'nogit'}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {output}'))
+
+        if options['compare']:
+            self.compare(Path(options['compare']), results)
+
+    @staticmethod
+    def select_cases(names, skip):
+        cases = []
+        for pattern in urls.urlpatterns:
+            name = pattern.name
+            if (names and name not in names) or name in skip:
+                continue
+            method, payload = BENCH_REQUESTS.get(name, ('GET', None))
+            cases.append({
+                'name': name,
+                'path': '/' + str(pattern.pattern),
+                'method': method,
+                'payload': payload,
+                'async': asyncio.iscoroutinefunction(pattern.callback),
+            })
+        unknown = set(names) - {case['name'] for case in cases} - set(skip)
+        if unknown:
+            raise CommandError(f"Нет представлений: {', '.join(sorted(unknown))}")
+        return cases
+
+    def run_case(self, case, options):
+        """
+        Отправляет запросы к представлению и собирает задержки: общую, измеренную клиентом,
+        и разбивку из заголовка Server-Timing.
+
+        Args:
+            case (dict): Представление: name, path, method, payload, async.
+            options (dict): Параметры команды.
+
+        Returns:
+            dict: Сводка по представлению.
+        """
+        total = options['requests']
+        if case['async']:
+            samples, seconds = asyncio.run(self.run_async(case, options['warmup'], total, options['concurrency']))
+        else:
+            samples, seconds = self.run_sync(case, options['warmup'], total, options['concurrency'])
+
+        statuses = {}
+        problems = {}
+        for sample in samples:
+            statuses[str(sample['status'])] = statuses.get(str(sample['status']), 0) + 1
+            if sample['problem']:
+                problems[sample['problem']] = problems.get(sample['problem'], 0) + 1
+        timed = [sample for sample in samples if 'total' in sample['timing']]
+        return {
+            'path': case['path'],
+            'method': case['method'],
+            'requests': len(samples),
+            'errors': sum(problems.values()),
+            'statuses': statuses,
+            'problems': problems,
+            'seconds': round(seconds, 3),
+            'rps': round(len(samples) / seconds, 1) if seconds else 0.0,
+            'latency_ms': summarize_ms([sample['ms'] for sample in samples]),
+            'upstream_ms': summarize_ms([sample['timing'].get('upstream', 0.0) for sample in timed]),
+            'serialize_ms': summarize_ms([sample['timing'].get('serialize', 0.0) for sample in timed]),
+            'local_ms': summarize_ms([sample['timing'].get('local', 0.0) for sample in timed]),
+            'upstream_calls': round(sum(sample['timing'].get('upstream_calls', 0) for sample in timed)
+                                    / len(timed), 2) if timed else 0.0,
+        }
+
+    @staticmethod
+    def request_kwargs(case):
+        if case['method'] == 'POST':
+            return {'data': orjson.dumps(case['payload']), 'content_type': 'application/json'}
+        return {'data': case['payload'] or {}}
+
+    @staticmethod
+    def sample(case, response, started):
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return {
+            'status': response.status_code,
+            'ms': (time.perf_counter() - started) * 1000,
+            'timing': parse_server_timing(response.get('Server-Timing')),
+            'problem': check_body(case['name'], response.status_code, content),
+        }
+
+    def run_sync(self, case, warmup, total, concurrency):
+        client = Client(raise_request_exception=False)
+        send = getattr(client, case['method'].lower())
+        kwargs = self.request_kwargs(case)
+
+        def call(_):
+            started = time.perf_counter()
+            return self.sample(case, send(case['path'], **kwargs), started)
+
+        for index in range(warmup):
+            call(index)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(call, range(total)))
+        return samples, time.perf_counter() - started
+
+    async def run_async(self, case, warmup, total, concurrency):
+        client = AsyncClient(raise_request_exception=False)
+        send = getattr(client, case['method'].lower())
+        kwargs = self.request_kwargs(case)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call():
+            async with semaphore:
+                started = time.perf_counter()
+                return self.sample(case, await send(case['path'], **kwargs), started)
+
+        for _ in range(warmup):
+            await call()
+        started = time.perf_counter()
+        samples = await asyncio.gather(*(call() for _ in range(total)))
+        return samples, time.perf_counter() - started
+
+    def compare(self, path, results):
+        """
+        Выводит изменение p95 и пропускной способности относительно прошлого прогона.
+
+        Args:
+            path (Path): JSON прошлого прогона.
+            results (dict): Результаты текущего прогона.
+        """
+        previous = orjson.loads(path.read_bytes())
+        self.stdout.write(f"Сравнение с {path.name} (коммит {previous.get('commit') or '?'}):")
+        self.stdout.write(f"{'view':<28} {'p95 было':>9} {'p95 стало':>10} {'p95 %':>7} {'rps %':>7}")
+        for name, result in results.items():
+            before = previous.get('views', {}).get(name)
+            if not before:
+                continue
+            p95_before, p95_after = before['latency_ms']['p95'], result['latency_ms']['p95']
+            p95_change = (p95_after - p95_before) / p95_before * 100 if p95_before else 0.0
+            rps_change = (result['rps'] - before['rps']) / before['rps'] * 100 if before['rps'] else 0.0
+            line = f'{name:<28} {p95_before:>9.1f} {p95_after:>10.1f} {p95_change:>+7.1f} {rps_change:>+7.1f}'
+            self.stdout.write(self.style.WARNING(line) if p95_change > 10 else line)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from base.directory import destinations
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает локальный индекс пунктов назначения для всех автоматизированных остановок.'
+
+    def handle(self, *args, **options):
+        count = destinations.refresh()
+        self.stdout.write(self.style.SUCCESS(f'Сохранено направлений: {count}'))
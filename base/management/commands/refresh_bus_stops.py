@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from base.directory import bus_stops
+
+
+class Command(BaseCommand):
+    help = 'Загружает справочник остановок из Avibus (GetBusStops) в локальную БД.'
+
+    def handle(self, *args, **options):
+        count = bus_stops.refresh()
+        self.stdout.write(self.style.SUCCESS(f'Сохранено остановок: {count}'))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from base.jobs import JobWorker, reconcile_stale, run_next
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задачи фоновой очереди оплат и возвратов (base.jobs).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2,
+                            help='Сколько потоков-воркеров запустить.')
+        parser.add_argument('--once', action='store_true',
+                            help='Выполнить готовые задачи и выйти.')
+
+    def handle(self, *args, **options):
+        reconciled = reconcile_stale()
+        if reconciled:
+            self.stdout.write(f'Зависших задач переведено на сверку: {reconciled}')
+
+        if options['once']:
+            processed = 0
+            while run_next('run_jobs'):
+                processed += 1
+            self.stdout.write(self.style.SUCCESS(f'Выполнено задач: {processed}'))
+            return
+
+        workers = [JobWorker(index) for index in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(self.style.SUCCESS(f'Запущено воркеров: {len(workers)}'))
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1)
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.stop()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,113 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+import orjson
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Модули стека SOAP, которые не должны загружаться при запуске воркера (base.soap импортирует их лениво).
+SOAP_STACK = ('zeep', 'lxml', 'requests', 'httpx', 'urllib3')
+
+# Запуск воркера в отдельном процессе: Django, URLconf и WSGI-приложение, затем по желанию прогрев SOAP.
+# Время этапов печатается в stdout как JSON, python -X importtime пишет время импортов в stderr.
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+phases = {'django_setup': time.perf_counter() - started}
+from django.conf import settings
+from importlib import import_module
+mark = time.perf_counter()
+import_module(settings.ROOT_URLCONF)
+phases['urlconf'] = time.perf_counter() - mark
+mark = time.perf_counter()
+import_module(settings.WSGI_APPLICATION.rsplit('.', 1)[0])
+phases['wsgi_application'] = time.perf_counter() - mark
+loaded = sorted(name for name in sys.modules if name.split('.')[0] in %(soap_stack)r and '.' not in name)
+if %(warm)r:
+    mark = time.perf_counter()
+    from base.soap import warm_clients
+    warm_clients()
+    phases['soap_warmup'] = time.perf_counter() - mark
+phases['total'] = time.perf_counter() - started
+print(json.dumps({'phases': phases, 'soap_stack_at_boot': loaded}))
+'''
+
+
+def parse_importtime(output):
+    """
+    Разбирает вывод python -X importtime.
+
+    Args:
+        output (str): stderr процесса.
+
+    Returns:
+        list[tuple]: (модуль, собственное время, время с вложенными импортами, глубина) в микросекундах.
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = ('Измеряет запуск воркера в отдельном процессе: время этапов (django.setup, URLconf, '
+            'WSGI-приложение, прогрев SOAP) и самые медленные импорты по python -X importtime.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15, help='Сколько самых медленных пакетов и модулей вывести.')
+        parser.add_argument('--warm', action='store_true',
+                            help='Дополнительно измерить прогрев клиентов SOAP (загрузка стека и WSDL).')
+        parser.add_argument('--production', action='store_true', help='Запустить с DJANGO_ENV=production.')
+        parser.add_argument('--json', default=None, help='Сохранить отчет в JSON-файл.')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'poezdka.settings'),
+                   SOAP_WARM_ON_STARTUP='0', JOBS_WORKERS='0')
+        if options['production']:
+            env['DJANGO_ENV'] = 'production'
+        script = STARTUP_SCRIPT % {'soap_stack': SOAP_STACK, 'warm': options['warm']}
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=settings.BASE_DIR,
+                                env=env, capture_output=True, text=True)
+        if result.returncode:
+            raise CommandError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'Процесс упал')
+
+        report = orjson.loads(result.stdout.strip().splitlines()[-1])
+        modules = parse_importtime(result.stderr)
+        packages = defaultdict(int)
+        for name, self_us, _, _ in modules:
+            packages[name.split('.')[0]] += self_us
+        report['import_seconds'] = round(sum(self_us for _, self_us, _, _ in modules) / 1e6, 4)
+        report['packages'] = {name: round(us / 1e6, 4)
+                              for name, us in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]}
+        # Импорты верхнего уровня: их время с вложенными импортами складывается в общее время запуска.
+        roots = sorted((module for module in modules if module[3] == 0), key=lambda module: -module[2])
+        report['modules'] = {name: round(cumulative_us / 1e6, 4)
+                             for name, _, cumulative_us, _ in roots[:options['top']]}
+
+        self.stdout.write('Этапы запуска:')
+        for phase, seconds in report['phases'].items():
+            self.stdout.write(f'  {phase:<20} {seconds * 1000:>9.1f} ms')
+        self.stdout.write(f"Импорты всего: {report['import_seconds'] * 1000:.1f} ms")
+        self.stdout.write('Пакеты по собственному времени импорта:')
+        for name, seconds in report['packages'].items():
+            self.stdout.write(f'  {name:<30} {seconds * 1000:>9.1f} ms')
+        self.stdout.write('Импорты верхнего уровня по времени с вложенными импортами:')
+        for name, seconds in report['modules'].items():
+            self.stdout.write(f'  {name:<30} {seconds * 1000:>9.1f} ms')
+        if report['soap_stack_at_boot']:
+            self.stdout.write(self.style.WARNING(
+                f"Стек SOAP загружен при запуске: {', '.join(report['soap_stack_at_boot'])}"))
+        else:
+            self.stdout.write(self.style.SUCCESS('Стек SOAP при запуске не загружается'))
+
+        if options['json']:
+            with open(options['json'], 'wb') as file:
+                file.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
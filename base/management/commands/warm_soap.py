@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.soap import WSDL_SALE, WSDL_SCHEDULE, download_wsdl, invalidate_client, warm_clients
+
+
+class Command(BaseCommand):
+    help = 'Создает клиенты SOAP Avibus и прогревает кэш WSDL/XSD, показывая время загрузки.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--download', action='store_true',
+                            help='Сохранить WSDL и XSD с сервера Avibus в SOAP_WSDL_DIR.')
+        parser.add_argument('--invalidate', action='store_true',
+                            help='Сбросить закэшированные документы WSDL/XSD перед прогревом.')
+
+    def handle(self, *args, **options):
+        if options['invalidate']:
+            invalidate_client()
+            self.stdout.write('Кэш WSDL/XSD сброшен')
+
+        if options['download']:
+            for wsdl in (WSDL_SCHEDULE, WSDL_SALE):
+                for path in download_wsdl(wsdl):
+                    self.stdout.write(f'Сохранен {path}')
+
+        started = time.perf_counter()
+        stats = warm_clients()
+        for wsdl, info in stats.items():
+            self.stdout.write(f"{wsdl}: {info['build_seconds']:.3f}s ({info['source']})")
+        self.stdout.write(self.style.SUCCESS(f'Клиенты готовы за {time.perf_counter() - started:.3f}s'))
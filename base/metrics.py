@@ -0,0 +1,188 @@
+import contextvars
+import threading
+
+# Все метрики процесса по имени, в порядке регистрации.
+registry = {}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """
+    Метрика в памяти процесса с набором меток. Значения не переживают перезапуск
+    и считаются отдельно в каждом процессе, как у prometheus_client без multiprocess-режима.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Функция, возвращающая пары (метки, значение) в момент выдачи метрик, для счетчиков,
+        # которые уже ведутся в другом месте (кэши, пул соединений, автоматы отключения).
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        if self.collect is not None:
+            return [f'{self.name}{_format_labels(self.labelnames, self._key(labels))} {_format_value(value)}'
+                    for labels, value in self.collect()]
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in values]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+def render():
+    """
+    Возвращает все метрики процесса в текстовом формате Prometheus.
+
+    Returns:
+        str: Текст для /metrics.
+    """
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+upstream_seconds = Histogram('avibus_call_seconds', 'Время вызова операции Avibus, включая повторы.',
+                             ('port', 'operation', 'outcome'))
+upstream_errors = Counter('avibus_errors_total', 'Ошибки вызовов Avibus по типу исключения.',
+                          ('port', 'operation', 'error'))
+upstream_retries = Counter('avibus_retries_total', 'Повторы операций чтения Avibus.', ('port', 'operation'))
+admission_wait_seconds = Histogram('avibus_admission_wait_seconds',
+                                   'Ожидание места в ограничителе вызовов Avibus по классу приоритета.',
+                                   ('priority',))
+upstream_request_bytes = Histogram('avibus_request_bytes', 'Размер SOAP-запроса к Avibus.',
+                                   ('operation',), buckets=SIZE_BUCKETS)
+upstream_response_bytes = Histogram('avibus_response_bytes', 'Размер SOAP-ответа Avibus.',
+                                    ('operation',), buckets=SIZE_BUCKETS)
+view_seconds = Histogram('view_seconds', 'Полное время обработки запроса Django.', ('view', 'status'))
+view_upstream_seconds = Histogram('view_upstream_seconds', 'Время ожидания Avibus внутри запроса.', ('view',))
+view_serialize_seconds = Histogram('view_serialize_seconds', 'Время кодирования JSON-ответа.', ('view',))
+view_local_seconds = Histogram('view_local_seconds',
+                               'Время запроса без ожидания Avibus и кодирования JSON (Django, БД, кэши).', ('view',))
+view_response_bytes = Histogram('view_response_bytes', 'Размер тела ответа.', ('view',), buckets=SIZE_BUCKETS)
+
+
+class RequestTimings:
+    """
+    Время, потраченное внутри одного запроса на ожидание Avibus и на кодирование JSON.
+    """
+    __slots__ = ('upstream', 'serialize', 'upstream_calls', 'operations')
+
+    def __init__(self):
+        self.upstream = 0.0
+        self.serialize = 0.0
+        self.upstream_calls = 0
+        self.operations = []
+
+
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request():
+    timings = RequestTimings()
+    return timings, _request_timings.set(timings)
+
+
+def end_request(token):
+    _request_timings.reset(token)
+
+
+def current_timings():
+    return _request_timings.get()
+
+
+def add_upstream(operation, seconds):
+    """
+    Учитывает вызов Avibus во времени текущего запроса. Вызовы из потоков общего пула
+    (поиск по диапазону дат и т.п.) выполняются вне контекста запроса и сюда не попадают.
+
+    Args:
+        operation (str): Имя операции.
+        seconds (float): Длительность вызова.
+    """
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.upstream += seconds
+        timings.upstream_calls += 1
+        timings.operations.append(operation)
+
+
+def add_serialize(seconds):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.serialize += seconds
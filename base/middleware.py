@@ -0,0 +1,156 @@
+import asyncio
+import cProfile
+import hmac
+import math
+import random
+import time
+
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+
+from . import metrics, profiling
+from .admission import AdmissionRejectedError
+from .serializers import json_response
+from .upstream import CircuitOpenError
+
+
+class UpstreamErrorMiddleware(MiddlewareMixin):
+    """
+    Отвечает 503 с Retry-After, когда вызов Avibus отклонен автоматом отключения порта
+    или ограничителем вызовов перегруженного воркера, чтобы клиент сразу получил ответ, а не ждал таймаута.
+    """
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, CircuitOpenError):
+            response = json_response({'error': str(exception), 'port': exception.port}, status=503)
+        elif isinstance(exception, AdmissionRejectedError):
+            response = json_response({'error': str(exception), 'priority': exception.priority}, status=503)
+        else:
+            return None
+        response['Retry-After'] = str(math.ceil(exception.retry_after))
+        return response
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Записывает время каждого запроса, разделяя его на ожидание Avibus, кодирование JSON
+    и все остальное (Django, БД, кэши), и размер ответа. Должен стоять первым в MIDDLEWARE,
+    чтобы время остальных middleware попало в общее время запроса. Под ASGI работает асинхронно
+    и не занимает поток на время запроса.
+    """
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        timings, token = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.record(request, response, timings, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        timings, token = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.record(request, response, timings, time.perf_counter() - started)
+
+    @staticmethod
+    def record(request, response, timings, elapsed):
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        local = max(elapsed - timings.upstream - timings.serialize, 0)
+        metrics.view_seconds.observe(elapsed, view=view, status=response.status_code)
+        metrics.view_upstream_seconds.observe(timings.upstream, view=view)
+        metrics.view_serialize_seconds.observe(timings.serialize, view=view)
+        metrics.view_local_seconds.observe(local, view=view)
+        if not response.streaming:
+            metrics.view_response_bytes.observe(len(response.content), view=view)
+
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = (f'upstream;dur={timings.upstream * 1000:.1f};desc="{timings.upstream_calls}", '
+                                         f'serialize;dur={timings.serialize * 1000:.1f}, '
+                                         f'local;dur={local * 1000:.1f}, total;dur={elapsed * 1000:.1f}')
+        return response
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Профилирует отдельные запросы cProfile: запросы с заголовком X-Profile, равным PROFILING_TOKEN,
+    и случайную долю PROFILING_SAMPLE_RATE остальных. Отчет с именем представления и операциями Avibus
+    запроса пишется в PROFILING_DIR (base.profiling), имя отчета возвращается в заголовке X-Profile-Id.
+    Должен стоять сразу после MetricsMiddleware, чтобы видеть время и операции Avibus запроса.
+    Под ASGI профайлер видит поток цикла событий, поэтому в отчет могут попасть корутины других запросов,
+    а синхронные представления, выполняемые в отдельном потоке, в него не попадают.
+    """
+    header = 'X-Profile'
+
+    def trigger(self, request):
+        token = request.headers.get(self.header)
+        if token and settings.PROFILING_TOKEN and hmac.compare_digest(token, settings.PROFILING_TOKEN):
+            return 'header'
+        if settings.PROFILING_SAMPLE_RATE and random.random() < settings.PROFILING_SAMPLE_RATE:
+            return 'sample'
+        return None
+
+    @staticmethod
+    def start_profiler():
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # В этом потоке уже работает другой профайлер.
+            return None
+        return profiler
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        trigger = self.trigger(request)
+        profiler = self.start_profiler() if trigger else None
+        if profiler is None:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.report(request, response, profiler, trigger, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        trigger = self.trigger(request)
+        profiler = self.start_profiler() if trigger else None
+        if profiler is None:
+            return await self.get_response(request)
+
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.report(request, response, profiler, trigger, time.perf_counter() - started)
+
+    @staticmethod
+    def report(request, response, profiler, trigger, elapsed):
+        timings = metrics.current_timings() or metrics.RequestTimings()
+        match = request.resolver_match
+        name = profiling.write_report(profiler, {
+            'view': match.view_name if match else 'unmatched',
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'trigger': trigger,
+            'total_ms': elapsed * 1000,
+            'upstream_ms': timings.upstream * 1000,
+            'upstream_calls': timings.upstream_calls,
+            'serialize_ms': timings.serialize * 1000,
+            'operations': timings.operations,
+        })
+        if name:
+            response['X-Profile-Id'] = name
+        return response
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.19 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Destination',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('departure_id', models.CharField(db_index=True, max_length=64)),
+                ('destination_id', models.CharField(max_length=64)),
+                ('name', models.CharField(max_length=255)),
+                ('updated_at', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('departure_id', 'destination_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.2.19 on 2026-10-18 08:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_destination'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=32, unique=True)),
+                ('trip_id', models.CharField(blank=True, db_index=True, max_length=128)),
+                ('departure_id', models.CharField(blank=True, max_length=64)),
+                ('destination_id', models.CharField(blank=True, max_length=64)),
+                ('status', models.CharField(choices=[('session', 'Сессия продажи'), ('reserved', 'Забронирован'), ('paid', 'Оплачен'), ('payment_cancelled', 'Оплата отменена')], default='session', max_length=32)),
+                ('avibus_status', models.CharField(blank=True, max_length=64)),
+                ('customer_email', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('paid_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReturnOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=32, unique=True)),
+                ('status', models.CharField(choices=[('created', 'Создан'), ('paid', 'Возврат выплачен'), ('cancelled', 'Возврат отменен')], default='created', max_length=32)),
+                ('avibus_status', models.CharField(blank=True, max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('paid_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Ticket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=32, unique=True)),
+                ('trip_id', models.CharField(blank=True, db_index=True, max_length=128)),
+                ('departure_id', models.CharField(blank=True, max_length=64)),
+                ('seat_num', models.CharField(blank=True, max_length=16)),
+                ('fare_name', models.CharField(blank=True, max_length=64)),
+                ('parent_seat_num', models.CharField(blank=True, max_length=16)),
+                ('status', models.CharField(blank=True, max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tickets', to='base.order')),
+                ('return_order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tickets', to='base.returnorder')),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.19 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='status',
+            field=models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('done', 'Выполнена'), ('failed', 'Ошибка'), ('expired', 'Срок истек'), ('reconcile', 'Требует сверки')], default='queued', max_length=16),
+        ),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running', 'reconcile'])), fields=('operation', 'key'), name='base_job_unresolved_operation_key'),
+        ),
+    ]
@@ -1,3 +1,164 @@
 from django.db import models
 
-# Create your models here.
+
+class BusStop(models.Model):
+    """
+    Остановка из справочника Avibus (GetBusStops), сохраненная локально.
+    """
+    id = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255)
+    automated = models.BooleanField(default=False, db_index=True)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class Destination(models.Model):
+    """
+    Пункт назначения, доступный из пункта отправления (GetDestinations), сохраненный локально.
+    """
+    departure_id = models.CharField(max_length=64, db_index=True)
+    destination_id = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('departure_id', 'destination_id')
+
+    def __str__(self):
+        return self.name
+
+
+class Order(models.Model):
+    """
+    Заказ Avibus, сохраненный по ответам StartSaleSession, AddTickets, ReserveOrder и Payment.
+    """
+    STATUS_SESSION = 'session'
+    STATUS_RESERVED = 'reserved'
+    STATUS_PAID = 'paid'
+    STATUS_PAYMENT_CANCELLED = 'payment_cancelled'
+    STATUS_CHOICES = [
+        (STATUS_SESSION, 'Сессия продажи'),
+        (STATUS_RESERVED, 'Забронирован'),
+        (STATUS_PAID, 'Оплачен'),
+        (STATUS_PAYMENT_CANCELLED, 'Оплата отменена'),
+    ]
+
+    number = models.CharField(max_length=32, unique=True)
+    trip_id = models.CharField(max_length=128, blank=True, db_index=True)
+    departure_id = models.CharField(max_length=64, blank=True)
+    destination_id = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=STATUS_SESSION)
+    avibus_status = models.CharField(max_length=64, blank=True)
+    customer_email = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    paid_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.number
+
+
+class ReturnOrder(models.Model):
+    """
+    Заказ на возврат билетов Avibus (AddTicketReturn, ReturnPayment).
+    """
+    STATUS_CREATED = 'created'
+    STATUS_PAID = 'paid'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_CREATED, 'Создан'),
+        (STATUS_PAID, 'Возврат выплачен'),
+        (STATUS_CANCELLED, 'Возврат отменен'),
+    ]
+
+    number = models.CharField(max_length=32, unique=True)
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=STATUS_CREATED)
+    avibus_status = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    paid_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.number
+
+
+class Ticket(models.Model):
+    """
+    Билет заказа Avibus. Билет, проданный не через этот сервис, может появиться только при возврате (без заказа).
+    """
+    number = models.CharField(max_length=32, unique=True)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='tickets', null=True, blank=True)
+    return_order = models.ForeignKey(ReturnOrder, on_delete=models.SET_NULL, related_name='tickets',
+                                     null=True, blank=True)
+    trip_id = models.CharField(max_length=128, blank=True, db_index=True)
+    departure_id = models.CharField(max_length=64, blank=True)
+    seat_num = models.CharField(max_length=16, blank=True)
+    fare_name = models.CharField(max_length=64, blank=True)
+    parent_seat_num = models.CharField(max_length=16, blank=True)
+    status = models.CharField(max_length=64, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.number
+
+
+class Job(models.Model):
+    """
+    Фоновая операция Avibus (оплата, возврат и их отмена), которую выполняет воркер очереди вместо веб-запроса.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_EXPIRED = 'expired'
+    # Исход неидемпотентной операции неизвестен (упал воркер или оборвался ответ Avibus): Avibus мог ее выполнить,
+    # повторять нельзя до сверки.
+    STATUS_RECONCILE = 'reconcile'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Выполнена'),
+        (STATUS_FAILED, 'Ошибка'),
+        (STATUS_EXPIRED, 'Срок истек'),
+        (STATUS_RECONCILE, 'Требует сверки'),
+    ]
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+    # Задача в одном из этих статусов еще не разрешена; пока она такая или выполнена (done),
+    # вторая такая же операция по заказу не ставится.
+    UNRESOLVED_STATUSES = ACTIVE_STATUSES + (STATUS_RECONCILE,)
+
+    operation = models.CharField(max_length=64)
+    # Номер заказа или заказа на возврат: по нему не ставится вторая такая же операция, пока первая не завершена.
+    key = models.CharField(max_length=64, blank=True)
+    params = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField()
+    deadline = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=128, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+            models.Index(fields=['operation', 'key']),
+        ]
+        constraints = [
+            # Условие повторяет UNRESOLVED_STATUSES: атрибуты класса недоступны внутри Meta.
+            models.UniqueConstraint(fields=['operation', 'key'],
+                                    condition=models.Q(status__in=['queued', 'running', 'reconcile']),
+                                    name='base_job_unresolved_operation_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.operation} {self.key} ({self.status})'
@@ -0,0 +1,269 @@
+import logging
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import DatabaseError, OperationalError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import Order, ReturnOrder, Ticket
+from .serializers import elements, get_field
+
+logger = logging.getLogger(__name__)
+
+write_retries = metrics.Counter('orders_write_retries_total',
+                                'Повторы записи в хранилище заказов после database is locked.', ('function',))
+lost_writes = metrics.Counter('orders_lost_writes_total',
+                              'Записи в хранилище заказов, потерянные из-за ошибки БД.', ('function',))
+
+
+def _text(value):
+    return '' if value is None else str(value)
+
+
+def _avibus_status(result):
+    if isinstance(result, str):
+        return result
+    return _text(get_field(result, 'Status'))
+
+
+def order_tickets(order):
+    """
+    Возвращает билеты заказа из ответа AddTickets/StartSaleSession.
+
+    Args:
+        order (object): Заказ Avibus.
+
+    Returns:
+        list: Билеты заказа.
+    """
+    return elements(get_field(order, 'Tickets'))
+
+
+def is_locked(exc):
+    return isinstance(exc, OperationalError) and 'locked' in str(exc)
+
+
+def recorder(func):
+    """
+    Декоратор функций сохранения: пишет в БД в транзакции, а ошибку БД только логирует,
+    чтобы сбой локального хранилища не ломал ответ уже выполненной операции Avibus.
+    Если SQLite занят записью другого потока дольше своего timeout (database is locked), транзакция
+    повторяется до ORDERS_WRITE_RETRIES раз с растущей паузой; потерянные записи считаются
+    в orders_lost_writes_total.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Внутри чужой транзакции повтор бесполезен: блокировку держит внешняя транзакция.
+        retries = 0 if transaction.get_connection().in_atomic_block else settings.ORDERS_WRITE_RETRIES
+        for attempt in range(retries + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except DatabaseError as exc:
+                if attempt < retries and is_locked(exc):
+                    write_retries.inc(function=func.__name__)
+                    time.sleep(settings.ORDERS_WRITE_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+                    continue
+                lost_writes.inc(function=func.__name__)
+                logger.exception('Failed to store %s', func.__name__)
+                return None
+    return wrapper
+
+
+@recorder
+def record_sale_session(order, trip_id, departure_id, destination_id):
+    """
+    Сохраняет заказ из ответа StartSaleSession.
+
+    Args:
+        order (object): Ответ StartSaleSession.
+        trip_id (str): Идентификатор поездки.
+        departure_id (str): Идентификатор пункта отправления.
+        destination_id (str): Идентификатор пункта назначения.
+    """
+    number = get_field(order, 'Number')
+    if not number:
+        return
+    Order.objects.update_or_create(number=number, defaults={
+        'trip_id': trip_id,
+        'departure_id': departure_id,
+        'destination_id': destination_id,
+        'status': Order.STATUS_SESSION,
+        'avibus_status': _avibus_status(order),
+    })
+    _store_tickets(number, order)
+
+
+@recorder
+def record_tickets(order_id, order):
+    """
+    Сохраняет билеты заказа из ответа AddTickets, DelTickets или SetTicketData.
+    Билеты, которых больше нет в заказе, удаляются.
+
+    Args:
+        order_id (str): Номер заказа.
+        order (object): Ответ Avibus с заказом.
+    """
+    _store_tickets(get_field(order, 'Number') or order_id, order)
+
+
+def _store_tickets(order_id, order):
+    if get_field(order, 'Tickets') is None:
+        return
+    order_obj, _ = Order.objects.get_or_create(number=order_id)
+    numbers = []
+    for ticket in order_tickets(order):
+        number = get_field(ticket, 'Number')
+        if not number:
+            continue
+        numbers.append(number)
+        Ticket.objects.update_or_create(number=number, defaults={
+            'order': order_obj,
+            'trip_id': order_obj.trip_id,
+            'departure_id': order_obj.departure_id,
+            'seat_num': _text(get_field(ticket, 'SeatNum')),
+            'fare_name': _text(get_field(ticket, 'FareName')),
+            'parent_seat_num': _text(get_field(ticket, 'ParentTicketSeatNum')),
+            'status': _avibus_status(ticket),
+        })
+    order_obj.tickets.exclude(number__in=numbers).delete()
+
+
+@recorder
+def record_order_status(order_id, status, result=None, customer_email=''):
+    """
+    Сохраняет новый статус заказа после ReserveOrder, Payment или CancelPayment.
+
+    Args:
+        order_id (str): Номер заказа.
+        status (str): Статус из Order.STATUS_CHOICES.
+        result (object): Ответ Avibus.
+        customer_email (str): Email покупателя из ReserveOrder.
+    """
+    defaults = {'status': status, 'avibus_status': _avibus_status(result)}
+    if customer_email:
+        defaults['customer_email'] = customer_email
+    if status == Order.STATUS_PAID:
+        defaults['paid_at'] = timezone.now()
+    Order.objects.update_or_create(number=order_id, defaults=defaults)
+    if result is not None:
+        _store_tickets(order_id, result)
+
+
+@recorder
+def record_ticket_return(return_order, ticket_number, departure_id=''):
+    """
+    Сохраняет заказ на возврат из ответа AddTicketReturn и привязывает к нему билет.
+
+    Args:
+        return_order (object): Ответ AddTicketReturn.
+        ticket_number (str): Номер возвращаемого билета.
+        departure_id (str): Идентификатор пункта отправления билета.
+    """
+    number = get_field(return_order, 'Number')
+    if not number:
+        return
+    return_order_obj, _ = ReturnOrder.objects.update_or_create(number=number, defaults={
+        'avibus_status': _avibus_status(return_order),
+    })
+    ticket, created = Ticket.objects.get_or_create(number=ticket_number, defaults={
+        'departure_id': departure_id,
+        'return_order': return_order_obj,
+    })
+    if not created:
+        ticket.return_order = return_order_obj
+        ticket.save(update_fields=['return_order', 'updated_at'])
+
+
+@recorder
+def remove_ticket_return(return_order_id, ticket_number):
+    """
+    Отвязывает билет от заказа на возврат после DelTicketReturn.
+
+    Args:
+        return_order_id (str): Номер заказа на возврат.
+        ticket_number (str): Номер билета.
+    """
+    Ticket.objects.filter(number=ticket_number, return_order__number=return_order_id).update(
+        return_order=None, updated_at=timezone.now())
+
+
+@recorder
+def record_return_status(return_order_id, status, result=None):
+    """
+    Сохраняет статус заказа на возврат после ReturnPayment или CancelReturnPayment.
+
+    Args:
+        return_order_id (str): Номер заказа на возврат.
+        status (str): Статус из ReturnOrder.STATUS_CHOICES.
+        result (object): Ответ Avibus.
+    """
+    defaults = {'status': status, 'avibus_status': _avibus_status(result)}
+    if status == ReturnOrder.STATUS_PAID:
+        defaults['paid_at'] = timezone.now()
+    ReturnOrder.objects.update_or_create(number=return_order_id, defaults=defaults)
+
+
+@recorder
+def record_ticket_status(ticket_number, departure_id, result):
+    """
+    Сохраняет статус билета из ответа GetTicketStatus.
+
+    Args:
+        ticket_number (str): Номер билета.
+        departure_id (str): Идентификатор пункта отправления.
+        result (object): Ответ GetTicketStatus.
+    """
+    Ticket.objects.update_or_create(number=ticket_number, defaults={
+        'departure_id': departure_id,
+        'status': _avibus_status(result),
+    })
+
+
+@recorder
+def record_ticket_statuses(statuses):
+    """
+    Сохраняет статусы нескольких билетов в одной транзакции.
+
+    Args:
+        statuses (list[tuple]): Тройки (departure_id, ticket_number, ответ GetTicketStatus).
+    """
+    for departure_id, ticket_number, result in statuses:
+        Ticket.objects.update_or_create(number=ticket_number, defaults={
+            'departure_id': departure_id,
+            'status': _avibus_status(result),
+        })
+
+
+def ticket_to_dict(ticket):
+    return {
+        'number': ticket.number,
+        'order_id': ticket.order.number if ticket.order_id else None,
+        'return_order_id': ticket.return_order.number if ticket.return_order_id else None,
+        'trip_id': ticket.trip_id,
+        'departure_id': ticket.departure_id,
+        'seat_num': ticket.seat_num,
+        'fare_name': ticket.fare_name,
+        'parent_seat_num': ticket.parent_seat_num,
+        'status': ticket.status,
+        'updated_at': ticket.updated_at,
+    }
+
+
+def order_to_dict(order):
+    return {
+        'number': order.number,
+        'trip_id': order.trip_id,
+        'departure_id': order.departure_id,
+        'destination_id': order.destination_id,
+        'status': order.status,
+        'avibus_status': order.avibus_status,
+        'customer_email': order.customer_email,
+        'created_at': order.created_at,
+        'updated_at': order.updated_at,
+        'paid_at': order.paid_at,
+        'tickets': [ticket_to_dict(ticket) for ticket in order.tickets.all()],
+    }
@@ -0,0 +1,72 @@
+import datetime
+import io
+import itertools
+import logging
+import os
+import pstats
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Сколько самых дорогих функций (по cumulative) попадает в текстовый отчет.
+REPORT_FUNCTIONS = 60
+
+_sequence = itertools.count()
+_prune_lock = threading.Lock()
+
+
+def write_report(profiler, info):
+    """
+    Сохраняет профиль запроса в PROFILING_DIR: <имя>.prof для snakeviz/pstats и <имя>.txt со сведениями
+    о запросе и самыми дорогими функциями. Старые отчеты сверх PROFILING_MAX_FILES удаляются.
+
+    Args:
+        profiler (cProfile.Profile): Остановленный профайлер.
+        info (dict): Сведения о запросе: view, method, path, status, trigger, total_ms, upstream_ms,
+            upstream_calls, serialize_ms и operations.
+
+    Returns:
+        str | None: Имя отчета без расширения или None, если записать не удалось.
+    """
+    directory = Path(settings.PROFILING_DIR)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    name = f"{now:%Y%m%dT%H%M%S%f}-{os.getpid()}-{next(_sequence)}-{info['view'].replace(':', '.')}"
+
+    stream = io.StringIO()
+    for key in ('view', 'method', 'path', 'status', 'trigger'):
+        stream.write(f'{key}: {info[key]}\n')
+    stream.write(f"total_ms: {info['total_ms']:.1f}\n")
+    stream.write(f"upstream_ms: {info['upstream_ms']:.1f} ({info['upstream_calls']} calls)\n")
+    stream.write(f"serialize_ms: {info['serialize_ms']:.1f}\n")
+    stream.write(f"operations: {', '.join(info['operations']) or '-'}\n")
+    stream.write(f'created_at: {now.isoformat()}\n\n')
+    pstats.Stats(profiler, stream=stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_FUNCTIONS)
+
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(directory / f'{name}.prof')
+        (directory / f'{name}.txt').write_text(stream.getvalue(), encoding='utf-8')
+        prune(directory, settings.PROFILING_MAX_FILES)
+    except OSError:
+        logger.exception('Failed to write profile %s', name)
+        return None
+    return name
+
+
+def prune(directory, keep):
+    """
+    Удаляет самые старые отчеты, оставляя не больше keep. Имена начинаются со времени,
+    поэтому порядок имен совпадает с порядком записи.
+
+    Args:
+        directory (Path): Каталог отчетов.
+        keep (int): Сколько отчетов оставить.
+    """
+    with _prune_lock:
+        reports = sorted(directory.glob('*.prof'))
+        for path in reports[:max(len(reports) - keep, 0)]:
+            path.unlink(missing_ok=True)
+            path.with_suffix('.txt').unlink(missing_ok=True)
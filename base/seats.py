@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .cache import TTLCache
+from .models import Order
+from .serializers import dumps, elements, elements_mapping, get_field
+
+seats_cache = TTLCache('seats', ttl=settings.SEATS_CACHE_TTL, maxsize=settings.SEATS_CACHE_MAXSIZE)
+
+# Заказ → поездка (TripId, Departure, Destination), чтобы изменения билетов заказа сбрасывали карту мест его поездки.
+_order_trips = OrderedDict()
+_order_trips_lock = threading.Lock()
+ORDER_TRIPS_MAXSIZE = 10000
+
+
+class SeatMap:
+    """
+    Карта мест поездки в кэше: занятые места битовой маской и готовый JSON-ответ GetOccupiedSeats.
+    """
+    __slots__ = ('occupied', 'payload')
+
+    def __init__(self, occupied, payload):
+        self.occupied = occupied
+        self.payload = payload
+
+    @classmethod
+    def from_result(cls, bus_results):
+        """
+        Строит карту мест из ответа GetOccupiedSeats.
+
+        Args:
+            bus_results (object): Ответ GetOccupiedSeats (объект zeep или словарь).
+
+        Returns:
+            SeatMap: Карта мест. Ответ в виде списка мест приводится к объекту с полем Elements.
+        """
+        occupied = 0
+        for seat in elements(bus_results):
+            try:
+                occupied |= 1 << int(get_field(seat, 'SeatNum'))
+            except (TypeError, ValueError):
+                continue
+        return cls(occupied, dumps(elements_mapping(bus_results)))
+
+    def is_occupied(self, seat_num):
+        return bool(self.occupied >> int(seat_num) & 1)
+
+    def occupied_seats(self):
+        return [seat for seat in range(self.occupied.bit_length()) if self.occupied >> seat & 1]
+
+
+def trip_key(trip_id, departure, destination):
+    return trip_id, departure, destination
+
+
+def remember_order(order_id, key):
+    """
+    Запоминает поездку заказа, чтобы последующие изменения билетов сбрасывали ее карту мест.
+
+    Args:
+        order_id (str): Номер заказа.
+        key (tuple): Ключ поездки из trip_key.
+    """
+    if not order_id:
+        return
+    with _order_trips_lock:
+        _order_trips[order_id] = key
+        _order_trips.move_to_end(order_id)
+        while len(_order_trips) > ORDER_TRIPS_MAXSIZE:
+            _order_trips.popitem(last=False)
+
+
+def invalidate_trip(key):
+    seats_cache.invalidate(key)
+
+
+def invalidate_order(order_id):
+    """
+    Сбрасывает карту мест поездки, к которой относится заказ. Поездку заказа, начатого в другом воркере
+    или до перезапуска, дает локальное хранилище заказов (Order.trip_id).
+
+    Args:
+        order_id (str): Номер заказа.
+    """
+    key = _order_trips.get(order_id)
+    if key is None:
+        trip = Order.objects.filter(number=order_id).values_list('trip_id', 'departure_id', 'destination_id').first()
+        if trip is None or not trip[0]:
+            return
+        key = trip_key(*trip)
+        remember_order(order_id, key)
+    invalidate_trip(key)
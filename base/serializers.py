@@ -0,0 +1,272 @@
+import datetime
+import sys
+import time
+from decimal import Decimal
+
+import orjson
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.duration import duration_iso_string
+
+from . import metrics
+
+JSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+# Сколько элементов списка кодируется в один фрагмент потокового ответа.
+STREAM_CHUNK_SIZE = 100
+
+
+def is_compound(value):
+    """
+    Проверяет, является ли значение составным объектом zeep. Сам zeep не импортируется:
+    пока он не загружен (base.soap загружает его при первом вызове Avibus), таких объектов быть не может.
+
+    Args:
+        value (object): Значение.
+
+    Returns:
+        bool: True для zeep.xsd.valueobjects.CompoundValue.
+    """
+    valueobjects = sys.modules.get('zeep.xsd.valueobjects')
+    return valueobjects is not None and isinstance(value, valueobjects.CompoundValue)
+
+
+def get_field(value, name):
+    """
+    Возвращает поле объекта zeep или ключ словаря.
+
+    Args:
+        value (object): Объект zeep или словарь.
+        name (str): Имя поля.
+
+    Returns:
+        object | None: Значение поля или None, если его нет.
+    """
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
+
+
+def as_mapping(value):
+    """
+    Возвращает поля объекта zeep как словарь без копирования вложенных объектов.
+
+    Args:
+        value (object): Объект zeep или словарь.
+
+    Returns:
+        dict: Поля объекта.
+    """
+    return value.__values__ if is_compound(value) else value
+
+
+def elements(value):
+    """
+    Возвращает элементы списка Avibus в любой из двух форм ответа: zeep разворачивает тип-обертку
+    с единственным полем Elements в список, а обертку с другими полями оставляет объектом с полем Elements.
+
+    Args:
+        value (object): Список, объект zeep или словарь с полем Elements или None.
+
+    Returns:
+        list: Элементы.
+
+    Raises:
+        TypeError: Если значение не список и не объект с полем Elements.
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict) or is_compound(value):
+        values = as_mapping(value)
+        if 'Elements' in values:
+            return values['Elements'] or []
+    raise TypeError(f'Ожидался список Avibus или объект с полем Elements, получено {type(value).__name__}')
+
+
+def elements_mapping(value):
+    """
+    Приводит список Avibus к форме объекта с полем Elements, чтобы ответ клиенту, наборы полей
+    (Elements.Id и т.п.) и потоковая выдача не зависели от того, развернул ли zeep обертку.
+
+    Args:
+        value (object): Список, объект zeep или словарь с полем Elements или None.
+
+    Returns:
+        object: Объект с полем Elements как есть или {'Elements': список}.
+
+    Raises:
+        TypeError: Если значение не список и не объект с полем Elements.
+    """
+    items = elements(value)
+    if isinstance(value, dict) or is_compound(value):
+        return value
+    return {'Elements': items}
+
+
+def parse_fields(fields):
+    """
+    Разбирает параметр fields вида "Elements.Id,Elements.Bus.Name" в дерево проекции.
+
+    Args:
+        fields (str | None): Пути полей через запятую.
+
+    Returns:
+        dict | None: Дерево {поле: поддерево или None для поля целиком}; None, если выбирать нужно все.
+    """
+    tree = {}
+    for path in (fields or '').split(','):
+        parts = [part for part in path.strip().split('.') if part]
+        if not parts:
+            continue
+        node = tree
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree or None
+
+
+def project(value, tree):
+    """
+    Оставляет в ответе только поля из дерева проекции. Списки проецируются поэлементно,
+    невыбранные поддеревья не обходятся и не кодируются.
+
+    Args:
+        value (object): Объект zeep или обычные структуры Python.
+        tree (dict | None): Дерево из parse_fields; None означает весь объект.
+
+    Returns:
+        object: Проекция значения.
+    """
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if not isinstance(value, dict) and not is_compound(value):
+        return value
+    values = as_mapping(value)
+    return {key: project(values[key], subtree) for key, subtree in tree.items() if key in values}
+
+
+def _default(value):
+    # orjson сам обходит словари, списки, строки, числа и даты, а сюда попадают только объекты zeep и прочие типы.
+    if is_compound(value):
+        return value.__values__
+    if isinstance(value, Decimal):
+        return str(value)
+    # xs:duration: zeep возвращает timedelta, а при годах или месяцах — isodate.Duration.
+    if isinstance(value, datetime.timedelta):
+        return duration_iso_string(value)
+    isodate = sys.modules.get('isodate')
+    if isodate is not None and isinstance(value, isodate.Duration):
+        return isodate.duration_isoformat(value)
+    valueobjects = sys.modules.get('zeep.xsd.valueobjects')
+    if valueobjects is not None and isinstance(value, valueobjects.AnyObject):
+        return value.value
+    etree = sys.modules.get('lxml.etree')
+    if etree is not None and isinstance(value, etree._Element):
+        return etree.tostring(value, encoding='unicode')
+    raise TypeError(f'Type is not JSON serializable: {type(value).__name__}')
+
+
+def dumps(value):
+    """
+    Кодирует ответ Avibus в JSON без промежуточного serialize_object.
+    Объекты zeep обходятся напрямую, десятичные числа и длительности кодируются строками, как в DjangoJSONEncoder.
+
+    Args:
+        value (object): Объект zeep или обычные структуры Python.
+
+    Returns:
+        bytes: JSON в UTF-8.
+    """
+    return orjson.dumps(value, default=_default, option=JSON_OPTIONS)
+
+
+def json_response(value, status=200, fields=None):
+    """
+    Возвращает HTTP-ответ с JSON, закодированным через dumps.
+
+    Args:
+        value (object): Объект zeep или обычные структуры Python.
+        status (int): HTTP-статус ответа.
+        fields (dict | None): Дерево проекции из parse_fields.
+
+    Returns:
+        HttpResponse: JSON-ответ.
+    """
+    started = time.perf_counter()
+    content = dumps(project(value, fields))
+    metrics.add_serialize(time.perf_counter() - started)
+    return HttpResponse(content, content_type='application/json', status=status)
+
+
+def iter_json(value, list_key, fields=None):
+    """
+    Кодирует ответ в JSON по частям: список list_key выдается фрагментами по STREAM_CHUNK_SIZE элементов,
+    остальные поля целиком; ответ-список выдается фрагментами целиком. Результат совпадает
+    с dumps(project(value, fields)).
+
+    Args:
+        value (object): Объект zeep, словарь или список.
+        list_key (str): Поле со списком, который нужно выдавать по частям.
+        fields (dict | None): Дерево проекции из parse_fields.
+
+    Yields:
+        bytes: Фрагменты JSON.
+    """
+    if isinstance(value, list):
+        yield from iter_list(value, fields)
+        return
+    if not isinstance(value, dict) and not is_compound(value):
+        yield dumps(project(value, fields))
+        return
+
+    values = as_mapping(value)
+    keys = values.keys() if fields is None else [key for key in fields if key in values]
+    yield b'{'
+    for index, key in enumerate(keys):
+        subtree = None if fields is None else fields[key]
+        item = values[key]
+        yield (b',' if index else b'') + dumps(key) + b':'
+        if key != list_key or not isinstance(item, list):
+            yield dumps(project(item, subtree))
+            continue
+
+        yield from iter_list(item, subtree)
+    yield b'}'
+
+
+def iter_list(items, fields=None):
+    """
+    Кодирует список в JSON фрагментами по STREAM_CHUNK_SIZE элементов.
+
+    Args:
+        items (list): Список.
+        fields (dict | None): Дерево проекции каждого элемента.
+
+    Yields:
+        bytes: Фрагменты JSON.
+    """
+    yield b'['
+    for start in range(0, len(items), STREAM_CHUNK_SIZE):
+        chunk = dumps([project(element, fields) for element in items[start:start + STREAM_CHUNK_SIZE]])
+        yield (b',' if start else b'') + chunk[1:-1]
+    yield b']'
+
+
+def stream_response(value, list_key, fields=None):
+    """
+    Возвращает потоковый HTTP-ответ с JSON, который кодируется по мере отправки клиенту.
+
+    Args:
+        value (object): Объект zeep или словарь.
+        list_key (str): Поле со списком, который нужно выдавать по частям.
+        fields (dict | None): Дерево проекции из parse_fields.
+
+    Returns:
+        StreamingHttpResponse: Потоковый JSON-ответ.
+    """
+    return StreamingHttpResponse(iter_json(value, list_key, fields), content_type='application/json')
@@ -0,0 +1,443 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urljoin, urlparse
+
+from django.conf import settings
+
+from . import metrics
+
+# zeep, lxml, requests и httpx импортируются при первом создании транспорта или клиента
+# (или при прогреве warm_clients), чтобы не замедлять запуск воркера.
+
+# Адрес публикации веб-сервисов Avibus; для нагрузочных тестов указывает на подменный сервис (base.standin).
+AVIBUS_URL = os.getenv('AVIBUS_URL', 'http://dev.avibus.pro/UEEDev/ws/')
+WSDL_SCHEDULE = f"{AVIBUS_URL}SchedulePort?wsdl"
+WSDL_SALE = f"{AVIBUS_URL}SalePort?wsdl"
+USERNAME = os.getenv('USER_NAME')
+PASSWORD = os.getenv('PASSWORD')
+
+logger = logging.getLogger(__name__)
+
+# Клиенты SOAP, уже разобравшие WSDL, по одному на URL в пределах процесса.
+_clients = {}
+_clients_lock = threading.Lock()
+# Время создания клиента (загрузка и разбор WSDL) в секундах, по URL WSDL.
+_build_times = {}
+_schema_cache = None
+# Общий транспорт с пулом keep-alive соединений, по одному на процесс.
+_transport = None
+_transport_lock = threading.Lock()
+_adapter = None
+# Асинхронные клиенты привязаны к циклу событий, в котором созданы их соединения.
+_async_clients = weakref.WeakKeyDictionary()
+# Таймаут текущего вызова операции в этом потоке (бюджет из base.upstream.call).
+_call_local = threading.local()
+
+
+@contextmanager
+def operation_timeout(seconds, operation=None):
+    """
+    Ограничивает время чтения ответа на запросы SOAP, отправленные из текущего потока внутри блока with.
+
+    Args:
+        seconds (float): Таймаут чтения в секундах.
+        operation (str | None): Имя операции для метрик размера запроса и ответа.
+    """
+    previous = getattr(_call_local, 'timeout', None), getattr(_call_local, 'operation', None)
+    _call_local.timeout = (min(settings.SOAP_CONNECT_TIMEOUT, seconds), seconds)
+    _call_local.operation = operation
+    try:
+        yield
+    finally:
+        _call_local.timeout, _call_local.operation = previous
+
+
+def get_schema_cache():
+    """
+    Возвращает общий дисковый кэш WSDL/XSD документов.
+
+    Returns:
+        zeep.cache.SqliteCache: Кэш схем.
+    """
+    global _schema_cache
+    if _schema_cache is None:
+        from zeep.cache import SqliteCache
+
+        _schema_cache = SqliteCache(path=str(settings.SOAP_SCHEMA_CACHE_PATH),
+                                    timeout=settings.SOAP_SCHEMA_CACHE_TIMEOUT)
+    return _schema_cache
+
+
+def build_transport():
+    """
+    Создает транспорт с пулом HTTP-соединений, параметры которого задаются в настройках.
+    Повторы делаются только для ошибок установки соединения, чтобы не отправить запрос дважды.
+
+    Returns:
+        zeep.transports.Transport: Транспорт для клиентов SOAP.
+    """
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from requests.auth import HTTPBasicAuth
+    from urllib3.util.retry import Retry
+
+    from .transport import BudgetTransport
+
+    global _adapter
+    retries = Retry(total=settings.SOAP_MAX_RETRIES, read=0, status=0, redirect=0,
+                    backoff_factor=settings.SOAP_RETRY_BACKOFF)
+    adapter = HTTPAdapter(pool_connections=settings.SOAP_POOL_CONNECTIONS,
+                          pool_maxsize=settings.SOAP_POOL_MAXSIZE,
+                          max_retries=retries)
+    session = Session()
+    session.auth = HTTPBasicAuth(USERNAME, PASSWORD)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _adapter = adapter
+
+    timeout = (settings.SOAP_CONNECT_TIMEOUT, settings.SOAP_READ_TIMEOUT)
+    return BudgetTransport(session=session, cache=get_schema_cache(),
+                           timeout=timeout, operation_timeout=timeout)
+
+
+def get_transport():
+    """
+    Возвращает общий для всех клиентов транспорт процесса.
+
+    Returns:
+        zeep.transports.Transport: Транспорт для клиентов SOAP.
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = build_transport()
+    return _transport
+
+
+def transport_stats():
+    """
+    Возвращает счетчики пула соединений: сколько запросов ушло по уже открытым
+    соединениям и сколько соединений пришлось открыть заново.
+
+    Returns:
+        dict: Счетчики по каждому хосту и суммарно.
+    """
+    pools = []
+    if _adapter is not None:
+        manager = _adapter.poolmanager
+        for key in manager.pools.keys():
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                'host': pool.host,
+                'port': pool.port,
+                'requests': pool.num_requests,
+                'new_connections': pool.num_connections,
+                'pool_hits': pool.num_requests - pool.num_connections,
+            })
+
+    return {
+        'pool_size': settings.SOAP_POOL_MAXSIZE,
+        'requests': sum(p['requests'] for p in pools),
+        'new_connections': sum(p['new_connections'] for p in pools),
+        'pool_hits': sum(p['pool_hits'] for p in pools),
+        'pools': pools,
+    }
+
+
+def port_name(wsdl):
+    """
+    Возвращает имя порта по URL WSDL, например SalePort.
+
+    Args:
+        wsdl (str): URL WSDL.
+
+    Returns:
+        str: Имя порта.
+    """
+    return urlparse(wsdl).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def local_wsdl_path(wsdl):
+    """
+    Возвращает путь к сохраненной в проекте копии WSDL, если она есть.
+
+    Args:
+        wsdl (str): URL WSDL.
+
+    Returns:
+        Path | None: Путь к локальному файлу WSDL.
+    """
+    path = Path(settings.SOAP_WSDL_DIR) / f'{port_name(wsdl)}.wsdl'
+    return path if path.exists() else None
+
+
+def recording_path(directory, port, operation):
+    """
+    Возвращает путь к записанному ответу операции Avibus для подменного сервиса.
+
+    Args:
+        directory (str | Path): Каталог записей.
+        port (str): Имя порта, например SalePort.
+        operation (str): Имя операции.
+
+    Returns:
+        Path: Путь к файлу с конвертом SOAP.
+    """
+    return Path(directory) / port / f'{operation}.xml'
+
+
+def save_recording(directory, port, operation, content):
+    """
+    Сохраняет ответ Avibus как запись для подменного сервиса; более поздний ответ заменяет прежний.
+
+    Args:
+        directory (str | Path): Каталог записей.
+        port (str): Имя порта.
+        operation (str): Имя операции.
+        content (bytes): Конверт SOAP ответа.
+    """
+    path = recording_path(directory, port, operation)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    except OSError:
+        logger.exception('Failed to record %s response', operation)
+
+
+def download_wsdl(wsdl, directory=None):
+    """
+    Сохраняет WSDL и все импортируемые им XSD в локальный каталог.
+    Ссылки импорта переписываются на локальные файлы, адреса сервисов остаются прежними.
+
+    Args:
+        wsdl (str): URL WSDL.
+        directory (str | Path | None): Каталог для файлов, по умолчанию SOAP_WSDL_DIR.
+
+    Returns:
+        list[Path]: Сохраненные файлы.
+    """
+    from lxml import etree
+
+    directory = Path(directory or settings.SOAP_WSDL_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = port_name(wsdl)
+    session = get_transport().session
+
+    file_names = {wsdl: f'{name}.wsdl'}
+    queue = [wsdl]
+    saved = []
+    while queue:
+        url = queue.pop()
+        response = session.get(url, timeout=(settings.SOAP_CONNECT_TIMEOUT, settings.SOAP_READ_TIMEOUT))
+        response.raise_for_status()
+        document = etree.fromstring(response.content)
+
+        for element in document.iter():
+            if not isinstance(element.tag, str) or etree.QName(element).localname not in ('import', 'include'):
+                continue
+            for attr in ('schemaLocation', 'location'):
+                location = element.get(attr)
+                if not location:
+                    continue
+                location = urljoin(url, location)
+                if location not in file_names:
+                    file_names[location] = f'{name}_{len(file_names)}.xsd'
+                    queue.append(location)
+                element.set(attr, file_names[location])
+
+        path = directory / file_names[url]
+        path.write_bytes(etree.tostring(document, xml_declaration=True, encoding='utf-8'))
+        saved.append(path)
+    return saved
+
+
+def build_client(wsdl):
+    """
+    Создает новый клиент SOAP, разбирая WSDL. Если WSDL сохранен в проекте, сеть не используется,
+    иначе документы берутся из дискового кэша или загружаются с сервера Avibus.
+    Адрес сервиса у локальной копии заменяется адресом из URL WSDL, чтобы AVIBUS_URL
+    действовал и на сохраненные WSDL.
+
+    Args:
+        wsdl (str): URL WSDL.
+
+    Returns:
+        zeep.Client: Клиент SOAP.
+    """
+    from zeep import Client
+
+    source = local_wsdl_path(wsdl)
+    if source is None:
+        return Client(wsdl=wsdl, transport=get_transport())
+
+    client = Client(wsdl=str(source), transport=get_transport())
+    address = wsdl.split('?', 1)[0]
+    for service in client.wsdl.services.values():
+        for port in service.ports.values():
+            port.binding_options['address'] = address
+    return client
+
+
+def get_client(wsdl):
+    """
+    Возвращает клиент SOAP для взаимодействия с API.
+    WSDL разбирается один раз на процесс, дальше используется готовый клиент.
+
+    Args:
+        wsdl (str): URL WSDL.
+
+    Returns:
+        zeep.Client: Клиент SOAP.
+    """
+    client = _clients.get(wsdl)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(wsdl)
+            if client is None:
+                started = time.perf_counter()
+                client = build_client(wsdl)
+                _build_times[wsdl] = time.perf_counter() - started
+                _clients[wsdl] = client
+    return client
+
+
+def warm_clients():
+    """
+    Заранее создает клиенты для всех портов Avibus, чтобы первый запрос к воркеру не ждал разбора WSDL.
+
+    Returns:
+        dict: Время создания каждого клиента в секундах, по URL WSDL.
+    """
+    started = time.perf_counter()
+    for wsdl in (WSDL_SCHEDULE, WSDL_SALE):
+        get_client(wsdl)
+    logger.info('SOAP clients are ready in %.3fs', time.perf_counter() - started)
+    return client_stats()
+
+
+def warm_clients_in_background():
+    """
+    Прогревает клиенты в фоновом потоке: воркер сразу принимает запросы, а первый вызов Avibus
+    дождется уже начатой загрузки WSDL (get_client ждет ту же блокировку).
+
+    Returns:
+        threading.Thread: Поток прогрева.
+    """
+    def warm():
+        try:
+            warm_clients()
+        except Exception:
+            logger.exception('SOAP warm-up failed')
+
+    thread = threading.Thread(target=warm, name='soap-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def client_stats():
+    """
+    Возвращает сведения о созданных клиентах: откуда взят WSDL и сколько занял его разбор.
+
+    Returns:
+        dict: Сведения по URL WSDL.
+    """
+    return {
+        wsdl: {
+            'source': 'local' if local_wsdl_path(wsdl) else 'remote',
+            'build_seconds': round(seconds, 4),
+        }
+        for wsdl, seconds in _build_times.items()
+    }
+
+
+def invalidate_client(wsdl=None):
+    """
+    Сбрасывает закэшированные клиенты и документы WSDL/XSD, например после изменения WSDL на стороне Avibus.
+    Следующий вызов get_client заново загрузит и разберет WSDL.
+
+    Args:
+        wsdl (str | None): URL WSDL. Если не указан, сбрасываются все клиенты и весь кэш схем.
+    """
+    with _clients_lock:
+        if wsdl is None:
+            _clients.clear()
+            _build_times.clear()
+        else:
+            _clients.pop(wsdl, None)
+            _build_times.pop(wsdl, None)
+
+    cache = get_schema_cache()
+    with cache.db_connection() as conn:
+        cursor = conn.cursor()
+        if wsdl is None:
+            cursor.execute("DELETE FROM request")
+        else:
+            # Импортированные XSD лежат рядом с WSDL, поэтому сбрасываем все документы того же порта.
+            prefix = wsdl.split('?', 1)[0]
+            cursor.execute("DELETE FROM request WHERE url LIKE ?", (prefix + '%',))
+        conn.commit()
+
+
+def build_async_transport():
+    """
+    Создает асинхронный транспорт на httpx с пулом соединений для текущего цикла событий.
+
+    Returns:
+        zeep.transports.AsyncTransport: Асинхронный транспорт для клиентов SOAP.
+    """
+    import httpx
+    from zeep.transports import AsyncTransport
+
+    client = httpx.AsyncClient(
+        auth=(USERNAME or '', PASSWORD or ''),
+        limits=httpx.Limits(max_connections=settings.SOAP_ASYNC_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.SOAP_POOL_MAXSIZE),
+        timeout=httpx.Timeout(settings.SOAP_READ_TIMEOUT, connect=settings.SOAP_CONNECT_TIMEOUT),
+        transport=httpx.AsyncHTTPTransport(retries=settings.SOAP_MAX_RETRIES),
+    )
+    return AsyncTransport(client=client, cache=get_schema_cache())
+
+
+async def get_async_client(wsdl):
+    """
+    Возвращает асинхронный клиент SOAP для текущего цикла событий.
+    Разобранный WSDL берется у синхронного клиента, поэтому повторно не загружается. Если синхронного клиента
+    еще нет, WSDL загружается и разбирается в отдельном потоке, не блокируя цикл событий.
+
+    Args:
+        wsdl (str): URL WSDL.
+
+    Returns:
+        zeep.AsyncClient: Асинхронный клиент SOAP.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(wsdl)
+    if client is None:
+        sync_client = _clients.get(wsdl) or await asyncio.to_thread(get_client, wsdl)
+        # Пока WSDL разбирался, клиент могла создать другая корутина этого цикла.
+        client = clients.get(wsdl)
+        if client is None:
+            from zeep import AsyncClient
+
+            transport = clients.get(None)
+            if transport is None:
+                transport = clients[None] = build_async_transport()
+            client = clients[wsdl] = AsyncClient(wsdl=sync_client.wsdl, transport=transport)
+    return client
+
+
+metrics.Counter('avibus_pool_requests_total', 'Запросы к Avibus через пул соединений.', ('host',),
+                collect=lambda: [({'host': pool['host']}, pool['requests']) for pool in transport_stats()['pools']])
+metrics.Counter('avibus_pool_new_connections_total', 'Новые соединения к Avibus, открытые пулом.', ('host',),
+                collect=lambda: [({'host': pool['host']}, pool['new_connections'])
+                                 for pool in transport_stats()['pools']])
@@ -0,0 +1,357 @@
+import io
+import logging
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote, urljoin, urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.conf import settings
+from lxml import etree
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .soap import WSDL_SALE, get_transport, invalidate_client, recording_path
+
+logger = logging.getLogger(__name__)
+
+SOAP_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+XML_CONTENT_TYPE = 'text/xml; charset=utf-8'
+
+STATUS_REASONS = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error',
+                  503: 'Service Unavailable'}
+
+
+def soap_fault(message):
+    envelope = etree.Element(f'{{{SOAP_ENV}}}Envelope', nsmap={'soap': SOAP_ENV})
+    fault = etree.SubElement(etree.SubElement(envelope, f'{{{SOAP_ENV}}}Body'), f'{{{SOAP_ENV}}}Fault')
+    etree.SubElement(fault, 'faultcode').text = 'soap:Server'
+    etree.SubElement(fault, 'faultstring').text = message
+    return etree.tostring(envelope, xml_declaration=True, encoding='utf-8')
+
+
+def request_operation(body):
+    """
+    Возвращает имя операции SOAP по первому элементу тела конверта (document/literal wrapped).
+
+    Args:
+        body (bytes): Конверт SOAP запроса.
+
+    Returns:
+        str | None: Имя операции или None, если конверт не разобран.
+    """
+    try:
+        envelope = etree.fromstring(body)
+    except etree.XMLSyntaxError:
+        return None
+    for element in envelope:
+        if isinstance(element.tag, str) and etree.QName(element).localname == 'Body':
+            for child in element:
+                if isinstance(child.tag, str):
+                    return etree.QName(child).localname
+    return None
+
+
+class AvibusStandin:
+    """
+    Подменный сервис Avibus (WSGI-приложение) для нагрузочных тестов без dev.avibus.pro.
+    Отдает WSDL портов из каталога записей с адресом сервиса, указывающим на себя, и на каждый вызов
+    операции возвращает ее записанный ответ <каталог>/<порт>/<операция>.xml с заданной задержкой.
+    Часть вызовов можно завершать ответом 503 (сбой сервиса) или SOAP Fault.
+    """
+
+    def __init__(self, directory=None, latency=0.0, jitter=0.0, operation_latency=None,
+                 error_rate=0.0, fault_rate=0.0, seed=None):
+        """
+        Args:
+            directory (str | Path | None): Каталог с WSDL и записями, по умолчанию AVIBUS_RECORDINGS_DIR.
+            latency (float): Задержка ответа в секундах.
+            jitter (float): Случайная добавка к задержке, от 0 до jitter секунд.
+            operation_latency (dict | None): Задержка отдельных операций вместо latency, по имени операции.
+            error_rate (float): Доля вызовов, на которые отвечается 503.
+            fault_rate (float): Доля вызовов, на которые отвечается SOAP Fault.
+            seed (int | None): Начальное значение генератора случайных чисел для воспроизводимых прогонов.
+        """
+        self.directory = Path(directory or settings.AVIBUS_RECORDINGS_DIR)
+        self.latency = latency
+        self.jitter = jitter
+        self.operation_latency = operation_latency or {}
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        self._recordings = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        status, headers, body = self.handle(environ)
+        start_response(f'{status} {STATUS_REASONS.get(status, "")}'.rstrip(),
+                       headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+    def handle(self, environ):
+        path = environ.get('PATH_INFO', '')
+        name = path.rstrip('/').rsplit('/', 1)[-1]
+        method = environ['REQUEST_METHOD']
+        if method == 'GET':
+            if name.endswith('.xsd'):
+                return self.serve_file(self.directory / name)
+            if 'wsdl' in environ.get('QUERY_STRING', '').lower():
+                return self.serve_wsdl(name, environ)
+            return 404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not found'
+        if method != 'POST':
+            return 405, [('Content-Type', 'text/plain; charset=utf-8')], b'Method not allowed'
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        operation = request_operation(environ['wsgi.input'].read(length)) or 'unknown'
+        return self.reply(name, operation)
+
+    def reply(self, port, operation):
+        """
+        Отвечает на вызов операции после задержки: записью, 503 или SOAP Fault.
+
+        Args:
+            port (str): Имя порта.
+            operation (str): Имя операции.
+
+        Returns:
+            tuple: Код ответа, заголовки и тело.
+        """
+        delay = self.operation_latency.get(operation, self.latency)
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.count(operation, 'error')
+            return 503, [('Content-Type', 'text/plain; charset=utf-8')], b'Service unavailable'
+        if roll < self.error_rate + self.fault_rate:
+            self.count(operation, 'fault')
+            return 500, [('Content-Type', XML_CONTENT_TYPE)], soap_fault('Сбой, внесенный подменным сервисом')
+
+        recording = self.load(port, operation)
+        if recording is None:
+            self.count(operation, 'missing')
+            return 500, [('Content-Type', XML_CONTENT_TYPE)], soap_fault(
+                f'Нет записанного ответа операции {operation} порта {port}')
+        self.count(operation, 'ok')
+        return 200, [('Content-Type', XML_CONTENT_TYPE)], recording
+
+    def load(self, port, operation):
+        key = port, operation
+        if key not in self._recordings:
+            path = recording_path(self.directory, port, operation)
+            self._recordings[key] = path.read_bytes() if path.exists() else None
+        return self._recordings[key]
+
+    def serve_file(self, path):
+        if not path.is_file():
+            return 404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not found'
+        return 200, [('Content-Type', XML_CONTENT_TYPE)], path.read_bytes()
+
+    def serve_wsdl(self, port, environ):
+        """
+        Отдает WSDL порта, заменяя адрес сервиса адресом этого запроса.
+
+        Args:
+            port (str): Имя порта.
+            environ (dict): Окружение WSGI.
+
+        Returns:
+            tuple: Код ответа, заголовки и тело.
+        """
+        path = self.directory / f'{port}.wsdl'
+        if not path.is_file():
+            return 404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not found'
+        document = etree.fromstring(path.read_bytes())
+        host = environ.get('HTTP_HOST') or f"{environ['SERVER_NAME']}:{environ['SERVER_PORT']}"
+        address = f"{environ.get('wsgi.url_scheme', 'http')}://{host}{environ.get('PATH_INFO', '')}"
+        for element in document.iter():
+            if (isinstance(element.tag, str) and etree.QName(element).localname == 'address'
+                    and element.get('location')):
+                element.set('location', address)
+        return 200, [('Content-Type', XML_CONTENT_TYPE)], etree.tostring(document, xml_declaration=True,
+                                                                          encoding='utf-8')
+
+    def count(self, operation, outcome):
+        with self._lock:
+            self._calls[operation, outcome] = self._calls.get((operation, outcome), 0) + 1
+
+    def stats(self):
+        """
+        Возвращает число вызовов операций по исходу: ok, error (503), fault, missing (нет записи).
+
+        Returns:
+            dict: Счетчики по имени операции.
+        """
+        with self._lock:
+            calls = dict(self._calls)
+        result = {}
+        for (operation, outcome), count in sorted(calls.items()):
+            result.setdefault(operation, {})[outcome] = count
+        return result
+
+
+class WSGIAdapter(BaseAdapter):
+    """
+    Адаптер requests, передающий запросы прямо в WSGI-приложение без сокета.
+    Таймауты запроса не действуют: задержка приложения выполняется в вызывающем потоке.
+    """
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'PATH_INFO': unquote(url.path),
+            'QUERY_STRING': url.query,
+            'SERVER_NAME': url.hostname or 'localhost',
+            'SERVER_PORT': str(url.port or (443 if url.scheme == 'https' else 80)),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': url.netloc,
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': url.scheme,
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = status
+            started['headers'] = headers
+
+        content = b''.join(self.app(environ, start_response))
+        code, _, reason = started['status'].partition(' ')
+
+        response = Response()
+        response.status_code = int(code)
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(started['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = content
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def install(app=None):
+    """
+    Направляет запросы общего транспорта SOAP к хосту Avibus в подменный сервис внутри процесса.
+    Клиенты и кэш схем сбрасываются, чтобы WSDL загрузился из подменного сервиса, а не из кэша.
+    Асинхронный клиент (ASGI) так не подменяется, для него нужен сервер manage.py avibus_standin.
+
+    Args:
+        app (AvibusStandin | None): Подменный сервис, по умолчанию с записями из AVIBUS_RECORDINGS_DIR.
+
+    Returns:
+        AvibusStandin: Установленный сервис.
+    """
+    app = app or AvibusStandin()
+    get_transport().session.mount(urljoin(WSDL_SALE, '/'), WSGIAdapter(app))
+    invalidate_client()
+    return app
+
+
+def uninstall():
+    get_transport().session.adapters.pop(urljoin(WSDL_SALE, '/'), None)
+    invalidate_client()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # Очередь соединений побольше стандартной: сервер принимает сотни одновременных запросов нагрузочного теста.
+    request_queue_size = 256
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def make_standin_server(app=None, host='127.0.0.1', port=8765):
+    """
+    Создает многопоточный HTTP-сервер с подменным сервисом: каждый запрос обрабатывается в своем потоке,
+    чтобы задержка одного ответа не задерживала остальные.
+
+    Args:
+        app (AvibusStandin | None): Подменный сервис, по умолчанию с записями из AVIBUS_RECORDINGS_DIR.
+        host (str): Адрес прослушивания.
+        port (int): Порт; 0 — любой свободный.
+
+    Returns:
+        ThreadingWSGIServer: Сервер; адрес публикации для AVIBUS_URL — standin_url(server).
+    """
+    return make_server(host, port, app or AvibusStandin(), server_class=ThreadingWSGIServer,
+                       handler_class=QuietRequestHandler)
+
+
+def standin_url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}{urlsplit(WSDL_SALE).path.rsplit("/", 1)[0]}/'
+
+
+def start_standin_server(app=None, host='127.0.0.1', port=0):
+    """
+    Запускает подменный сервис в фоновом потоке текущего процесса.
+
+    Args:
+        app (AvibusStandin | None): Подменный сервис.
+        host (str): Адрес прослушивания.
+        port (int): Порт; 0 — любой свободный.
+
+    Returns:
+        ThreadingWSGIServer: Запущенный сервер; остановка — server.shutdown().
+    """
+    server = make_standin_server(app, host, port)
+    threading.Thread(target=server.serve_forever, name='avibus-standin', daemon=True).start()
+    return server
+
+
+def parse_operation_latency(items):
+    """
+    Разбирает задержки операций вида ["GetTrips=0.5", "Payment=2"].
+
+    Args:
+        items (list[str]): Пары операция=секунды.
+
+    Returns:
+        dict: Задержка по имени операции.
+
+    Raises:
+        ValueError: Если пара записана неверно.
+    """
+    result = {}
+    for item in items or []:
+        name, _, seconds = item.partition('=')
+        if not name or not seconds:
+            raise ValueError(f'Ожидается операция=секунды: {item}')
+        result[name.strip()] = float(seconds)
+    return result
+
@@ -1,3 +1,1029 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import pstats
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import urlsplit
 
-# Create your tests here.
+import orjson
+import requests
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError, OperationalError, connection
+from django.db.models.query import QuerySet
+from django.test import AsyncClient, Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import metrics, standin
+from .admission import PAYMENT, SEARCH, AdmissionController, AdmissionRejectedError
+from .booking import BookingPipeline
+from .cache import TTLCache
+from .directory import DestinationIndex, LocalDirectory
+from .http import choose_encoding
+from .jobs import JobWorker, claim_job, enqueue, reconcile_stale, run_job
+from .management.commands.bench_views import check_body
+from .middleware import MetricsMiddleware, ProfilingMiddleware, UpstreamErrorMiddleware
+from .models import Destination, Job, Order, Ticket
+from .orders import lost_writes, record_order_status, record_sale_session, record_tickets, recorder
+from .seats import SeatMap, invalidate_order, seats_cache, trip_key
+from .serializers import dumps, iter_json
+from .soap import WSDL_SALE, client_stats, get_async_client, get_client, invalidate_client, transport_stats
+from .upstream import CircuitBreaker, CircuitOpenError, call
+from .views import TRIP_FIELD_PRESETS, ticket_status_cache, trip_elements, trips_cache
+
+
+class FailingDirectory(LocalDirectory):
+    ttl_setting = 'BUS_STOPS_TTL'
+
+    def __init__(self):
+        super().__init__()
+        self.refreshes = 0
+
+    def refresh(self):
+        self.refreshes += 1
+        raise ConnectionError('Avibus недоступен')
+
+    def _load(self):
+        pass
+
+
+class LocalDirectoryTests(SimpleTestCase):
+
+    @override_settings(DIRECTORY_REFRESH_BACKOFF=60)
+    def test_failed_refresh_backs_off(self):
+        directory = FailingDirectory()
+        with self.assertLogs('base.directory', 'ERROR'):
+            directory._background_refresh()
+        self.assertEqual(directory.refreshes, 1)
+
+        with mock.patch.object(threading, 'Thread') as thread:
+            directory.refresh_in_background()
+        thread.assert_not_called()
+        self.assertFalse(directory._refreshing)
+
+    @override_settings(DIRECTORY_REFRESH_BACKOFF=0)
+    def test_refresh_retried_after_backoff(self):
+        directory = FailingDirectory()
+        with self.assertLogs('base.directory', 'ERROR'):
+            directory._background_refresh()
+
+        with mock.patch.object(threading, 'Thread') as thread:
+            directory.refresh_in_background()
+        thread.assert_called_once()
+
+
+class DestinationIndexTests(TestCase):
+
+    def setUp(self):
+        Destination.objects.create(departure_id='B', destination_id='old', name='Старый пункт', updated_at=timezone.now())
+        self.index = DestinationIndex()
+        patcher = mock.patch('base.directory.bus_stops.travel_directions',
+                             return_value=[{'id': 'A', 'name': 'A'}, {'id': 'B', 'name': 'B'}])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_stop_keeps_previous_destinations(self):
+        def call(wsdl, operation, Departure, Substring):
+            if Departure == 'B':
+                raise ConnectionError('timeout')
+            return [SimpleNamespace(Id='new', Name='Новый пункт')]
+
+        with mock.patch('base.directory.call', side_effect=call), self.assertLogs('base.directory', 'WARNING') as logs:
+            self.assertEqual(self.index.refresh(), 1)
+
+        self.assertIn('B (timeout)', logs.output[0])
+        self.assertEqual(set(Destination.objects.values_list('departure_id', 'destination_id')),
+                         {('A', 'new'), ('B', 'old')})
+        self.assertEqual(self.index.destinations('B'), [{'id': 'old', 'name': 'Старый пункт'}])
+        self.assertEqual(self.index.destinations('A'), [{'id': 'new', 'name': 'Новый пункт'}])
+
+    def test_all_stops_failed_keeps_index(self):
+        with mock.patch('base.directory.call', side_effect=ConnectionError('down')), \
+                self.assertLogs('base.directory', 'WARNING'), self.assertRaises(ConnectionError):
+            self.index.refresh()
+        self.assertEqual(Destination.objects.count(), 1)
+
+
+class TTLCacheTests(SimpleTestCase):
+
+    def test_eviction_is_least_recently_used(self):
+        cache = TTLCache('test_lru', ttl=60, maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get_or_load('a', lambda: 0), 1)
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual((cache.get('a'), cache.get('d')), (1, 4))
+
+    def test_load_started_before_invalidate_is_not_cached(self):
+        cache = TTLCache('test_invalidate', ttl=60)
+
+        def loader():
+            cache.invalidate('a')
+            return 'stale'
+
+        self.assertEqual(cache.get_or_load('a', loader), 'stale')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_or_load('a', lambda: 'fresh'), 'fresh')
+        self.assertEqual(cache.get('a'), 'fresh')
+
+    def test_async_load_started_before_invalidate_is_not_cached(self):
+        cache = TTLCache('test_ainvalidate', ttl=60)
+
+        async def loader():
+            cache.invalidate('a')
+            return 'stale'
+
+        self.assertEqual(async_to_sync(cache.aget_or_load)('a', loader), 'stale')
+        self.assertIsNone(cache.get('a'))
+
+    def test_load_error_reaches_waiting_callers(self):
+        cache = TTLCache('test_single_flight_error', ttl=60)
+        release = threading.Event()
+        errors = []
+
+        def loader():
+            release.wait(5)
+            raise ConnectionError('Avibus недоступен')
+
+        def follower():
+            try:
+                cache.get_or_load('a', lambda: 'unexpected')
+            except ConnectionError as exc:
+                errors.append(exc)
+
+        leader = threading.Thread(target=lambda: self.assertRaises(ConnectionError, cache.get_or_load, 'a', loader))
+        leader.start()
+        while not cache._flights:
+            time.sleep(0.001)
+        waiting = threading.Thread(target=follower)
+        waiting.start()
+        while not cache.coalesced:
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        waiting.join(5)
+
+        self.assertEqual([str(exc) for exc in errors], ['Avibus недоступен'])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_or_load('a', lambda: 'fresh'), 'fresh')
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Условие не выполнено за 5 секунд')
+        time.sleep(0.001)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+
+    def test_priority_share_and_queue_timeout(self):
+        limiter = AdmissionController(4, {'search': 0.5}, {'search': 0.05}, {'search': 5})
+        deadline = time.monotonic() + 5
+        limiter.acquire(SEARCH, deadline)
+        limiter.acquire(SEARCH, deadline)
+
+        with self.assertRaises(AdmissionRejectedError) as rejected:
+            limiter.acquire(SEARCH, deadline)
+        self.assertEqual(rejected.exception.reason, 'timeout')
+
+        limiter.acquire(PAYMENT, deadline)
+        limiter.acquire(PAYMENT, deadline)
+        stats = limiter.stats()
+        self.assertEqual(stats['in_flight'], 4)
+        self.assertEqual(stats['priorities'][SEARCH]['capacity'], 2)
+        self.assertEqual(stats['priorities'][SEARCH]['queued'], 0)
+        self.assertEqual(stats['priorities'][SEARCH]['rejected'], {'timeout': 1})
+
+    def test_full_queue_rejected_without_waiting(self):
+        limiter = AdmissionController(1, {}, {'search': 5}, {'search': 0})
+        limiter.acquire(SEARCH, time.monotonic() + 5)
+
+        started = time.monotonic()
+        with self.assertRaises(AdmissionRejectedError) as rejected:
+            limiter.acquire(SEARCH, time.monotonic() + 5)
+        self.assertEqual(rejected.exception.reason, 'queue_full')
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_release_prefers_more_important_waiter(self):
+        limiter = AdmissionController(1, {}, {'payment': 5, 'search': 5}, {'payment': 5, 'search': 5})
+        limiter.acquire(SEARCH, time.monotonic() + 5)
+        order = []
+
+        def waiter(priority):
+            limiter.acquire(priority, time.monotonic() + 5)
+            order.append(priority)
+
+        threads = [threading.Thread(target=waiter, args=(SEARCH,)), threading.Thread(target=waiter, args=(PAYMENT,))]
+        threads[0].start()
+        wait_until(lambda: limiter.stats()['priorities'][SEARCH]['queued'] == 1)
+        threads[1].start()
+        wait_until(lambda: limiter.stats()['priorities'][PAYMENT]['queued'] == 1)
+
+        limiter.release()
+        wait_until(lambda: order)
+        self.assertEqual(order, [PAYMENT])
+        self.assertEqual(limiter.stats()['priorities'][SEARCH]['queued'], 1)
+        limiter.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [PAYMENT, SEARCH])
+        self.assertEqual(limiter.stats()['in_flight'], 1)
+
+
+@override_settings(SOAP_BREAKER_WINDOW=2, SOAP_BREAKER_MIN_CALLS=2, SOAP_BREAKER_ERROR_RATE=0.5,
+                   SOAP_BREAKER_OPEN_SECONDS=0)
+class CircuitBreakerTests(SimpleTestCase):
+
+    def open_breaker(self):
+        breaker = CircuitBreaker('TestPort')
+        with self.assertLogs('base.upstream', 'WARNING'):
+            breaker.record(False)
+            breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        return breaker
+
+    def test_single_probe_in_half_open(self):
+        breaker = self.open_breaker()
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+
+    def test_interrupted_probe_released(self):
+        breaker = self.open_breaker()
+
+        def get_trips(**kwargs):
+            raise KeyboardInterrupt
+
+        client = SimpleNamespace(service=SimpleNamespace(GetTrips=get_trips))
+        with mock.patch.dict('base.upstream.breakers', {'SalePort': breaker}), \
+                mock.patch('base.upstream.get_client', return_value=client), self.assertRaises(KeyboardInterrupt):
+            call(WSDL_SALE, 'GetTrips', Departure='a')
+
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.rejected, 0)
+
+    def test_cancelled_probe_released(self):
+        breaker = self.open_breaker()
+        breaker.before_call()
+        breaker.release()
+
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.rejected, 0)
+
+
+@override_settings(SOAP_ADMISSION_LIMIT=1, SOAP_SAFE_RETRIES=1, SOAP_SAFE_RETRY_BACKOFF=0)
+class UpstreamRetryTests(SimpleTestCase):
+
+    def test_admission_slot_released_before_retry_pause(self):
+        limiter = AdmissionController(1, {}, {}, {})
+        attempts = []
+
+        def get_trips(**kwargs):
+            attempts.append(limiter.in_flight)
+            if len(attempts) == 1:
+                raise requests.ConnectionError('reset')
+            return 'trips'
+
+        def pause(seconds):
+            self.assertEqual(limiter.in_flight, 0)
+
+        client = SimpleNamespace(service=SimpleNamespace(GetTrips=get_trips))
+        with mock.patch('base.admission.controller', limiter), mock.patch.dict('base.upstream.breakers', clear=True), \
+                mock.patch('base.upstream.get_client', return_value=client), \
+                mock.patch('base.upstream.time.sleep', side_effect=pause) as sleep:
+            self.assertEqual(call(WSDL_SALE, 'GetTrips', Departure='a'), 'trips')
+
+        sleep.assert_called_once()
+        self.assertEqual(attempts, [1, 1])
+        self.assertEqual(limiter.in_flight, 0)
+
+
+def trip(trip_id, hour, price, free_seats):
+    return {
+        'Id': trip_id,
+        'RouteNum': '101',
+        'RouteName': 'Тюмень - Ишим',
+        'Carrier': 'ООО Автовокзал',
+        'DepartureTime': datetime.datetime(2023, 6, 9, hour, 30),
+        'ArrivalTime': datetime.datetime(2023, 6, 9, hour + 4, 0),
+        'Duration': 210,
+        'FreeSeatsAmount': free_seats,
+        'PassengerFareCost': Decimal(price),
+        'Departure': {'Id': '862fd93e-e633-11e7-80e7-00175d776a07', 'Name': 'Тюмень АВ'},
+        'Destination': {'Id': 'cb654d84-f487-11ed-83c7-d00da3a6c886', 'Name': 'Ишим АС'},
+        'Status': 'OnSale',
+    }
+
+
+class PeakProbe:
+    """
+    Подмена вызова Avibus, которая запоминает наибольшее число одновременных вызовов.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.01)
+        with self._lock:
+            self.running -= 1
+        return self.result
+
+
+TRIPS = [trip('trip-1', 8, '850.00', 12), trip('trip-2', 14, '790.50', 3)]
+# GetTrips приходит от zeep либо объектом с полем Elements, либо развернутым списком поездок.
+GET_TRIPS_SHAPES = {'mapping': {'Elements': TRIPS}, 'list': TRIPS}
+
+
+class TripShapeTests(SimpleTestCase):
+
+    def setUp(self):
+        trips_cache.clear()
+        self.addCleanup(trips_cache.clear)
+
+    def test_trip_elements(self):
+        for shape, bus_results in GET_TRIPS_SHAPES.items():
+            with self.subTest(shape=shape):
+                self.assertEqual(trip_elements(bus_results), TRIPS)
+        self.assertEqual(trip_elements(None), [])
+        with self.assertRaises(TypeError):
+            trip_elements('unexpected')
+
+    def test_search_trips_list_preset(self):
+        for shape, bus_results in GET_TRIPS_SHAPES.items():
+            with self.subTest(shape=shape), mock.patch('base.views.get_trips', return_value=bus_results):
+                response = self.client.get('/search_trips/', {'fields': 'list'})
+                self.assertEqual(response.status_code, 200)
+                trips = orjson.loads(response.content)['Elements']
+                self.assertEqual([item['Id'] for item in trips], ['trip-1', 'trip-2'])
+                self.assertEqual(trips[1]['Destination'], {'Id': 'cb654d84-f487-11ed-83c7-d00da3a6c886',
+                                                           'Name': 'Ишим АС'})
+                self.assertNotIn('Status', trips[0])
+
+    def test_search_trips_stream(self):
+        for shape, bus_results in GET_TRIPS_SHAPES.items():
+            with self.subTest(shape=shape), mock.patch('base.views.get_trips', return_value=bus_results):
+                streamed = self.client.get('/search_trips/', {'fields': 'list', 'stream': '1'})
+                plain = self.client.get('/search_trips/', {'fields': 'list'})
+                self.assertEqual(b''.join(streamed.streaming_content), plain.content)
+
+    def test_iter_json_streams_list(self):
+        with mock.patch('base.serializers.STREAM_CHUNK_SIZE', 1):
+            chunks = list(iter_json(TRIPS, 'Elements', TRIP_FIELD_PRESETS['list']['Elements']))
+        self.assertEqual([item['Id'] for item in orjson.loads(b''.join(chunks))], ['trip-1', 'trip-2'])
+        self.assertGreater(len(chunks), 2)
+
+    def test_search_trips_range(self):
+        for shape, bus_results in GET_TRIPS_SHAPES.items():
+            with self.subTest(shape=shape), mock.patch('base.views.get_trips', return_value=bus_results):
+                response = self.client.get('/search_trips_range/', {'date_from': '2023-06-09',
+                                                                    'date_to': '2023-06-10'})
+                body = orjson.loads(response.content)
+                self.assertEqual(body['errors'], {})
+                self.assertEqual([(item['date'], item['Id']) for item in body['trips']],
+                                 [('2023-06-09', 'trip-1'), ('2023-06-09', 'trip-2'),
+                                  ('2023-06-10', 'trip-1'), ('2023-06-10', 'trip-2')])
+
+    @override_settings(TRIPS_RANGE_CONCURRENCY=2)
+    def test_search_trips_range_limits_in_flight_days(self):
+        probe = PeakProbe({'Elements': TRIPS})
+        with mock.patch('base.views.get_trips', side_effect=probe):
+            response = self.client.get('/search_trips_range/', {'date_from': '2023-06-01', 'date_to': '2023-06-10'})
+        self.assertEqual(len(orjson.loads(response.content)['trips']), 20)
+        self.assertEqual(probe.calls, 10)
+        self.assertLessEqual(probe.peak, 2)
+
+    def test_search_anywhere(self):
+        end_directions = [{'id': 'cb654d84-f487-11ed-83c7-d00da3a6c886', 'name': 'Ишим АС'}]
+        for shape, bus_results in GET_TRIPS_SHAPES.items():
+            with self.subTest(shape=shape), mock.patch('base.views.get_trips', return_value=bus_results), \
+                    mock.patch('base.views.find_destinations', return_value=end_directions):
+                body = orjson.loads(self.client.get('/search_anywhere/').content)
+                self.assertEqual(body['errors'], {})
+                self.assertEqual(body['destinations'], [{
+                    'id': 'cb654d84-f487-11ed-83c7-d00da3a6c886', 'name': 'Ишим АС', 'trips': 2,
+                    'earliest_departure': '2023-06-09T08:30:00', 'min_price': '790.50', 'free_seats': 15,
+                }])
+
+    @override_settings(SEARCH_ANYWHERE_CONCURRENCY=3)
+    def test_search_anywhere_limits_in_flight_destinations(self):
+        end_directions = [{'id': f'destination-{index}', 'name': f'Пункт {index}'} for index in range(12)]
+        probe = PeakProbe({'Elements': TRIPS})
+        with mock.patch('base.views.get_trips', side_effect=probe), \
+                mock.patch('base.views.find_destinations', return_value=end_directions):
+            body = orjson.loads(self.client.get('/search_anywhere/').content)
+        self.assertEqual(len(body['destinations']), 12)
+        self.assertEqual(probe.calls, 12)
+        self.assertLessEqual(probe.peak, 3)
+
+    def test_search_anywhere_reports_unknown_shape(self):
+        end_directions = [{'id': 'cb654d84-f487-11ed-83c7-d00da3a6c886', 'name': 'Ишим АС'}]
+        with mock.patch('base.views.get_trips', return_value='unexpected'), \
+                mock.patch('base.views.find_destinations', return_value=end_directions):
+            body = orjson.loads(self.client.get('/search_anywhere/').content)
+        self.assertEqual(body['destinations'], [])
+        self.assertIn('cb654d84-f487-11ed-83c7-d00da3a6c886', body['errors'])
+
+
+class ChooseEncodingTests(SimpleTestCase):
+
+    def test_quality_values(self):
+        cases = {
+            '': None,
+            'gzip': 'gzip',
+            'gzip, br': 'br',
+            'gzip, br;q=0': 'gzip',
+            'br;q=0, gzip;q=0': None,
+            'br;q=0.5, gzip': 'gzip',
+            'gzip;q=0.8, br;q=0.8': 'br',
+            'GZIP; Q=0.3': 'gzip',
+            'identity, *;q=0': None,
+            '*': 'br',
+            'br;q=0, *': 'gzip',
+            'br;q=abc, gzip;q=0.1': 'gzip',
+            'brotli, xgzip': None,
+        }
+        factory = RequestFactory()
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(choose_encoding(factory.get('/', HTTP_ACCEPT_ENCODING=header)), expected)
+
+
+BOOKING = {
+    'trip_id': '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041',
+    'departure': '862fd93e-e633-11e7-80e7-00175d776a07',
+    'destination': 'cb654d84-f487-11ed-83c7-d00da3a6c886',
+    'ticket_seats': [{'SeatNum': '5', 'FareName': 'Пассажирский'}],
+    'tickets': [{'SeatNum': '5', 'FareName': 'Пассажирский', 'PersonalData': []}],
+    'customer': {'Name': 'Иванов', 'Email': 'ivanov@example.com'},
+}
+
+
+class BookOrderTests(TestCase):
+
+    def post(self, booking):
+        return self.client.post('/book_order/', orjson.dumps(booking), content_type='application/json')
+
+    def test_invalid_payload_rejected_before_upstream(self):
+        invalid = [
+            {'tickets': ['bad']},
+            {'ticket_seats': {'SeatNum': '5'}},
+            {'customer': 'ivanov@example.com'},
+            {'cheque_settings': [48]},
+            {'trip_id': 42},
+            {'reserve_kind': ['Reserve']},
+        ]
+        with mock.patch('base.booking.call') as call:
+            for change in invalid:
+                with self.subTest(change=change):
+                    response = self.post({**BOOKING, **change})
+                    self.assertEqual(response.status_code, 400)
+                    self.assertIn(next(iter(change)), orjson.loads(response.content)['error'])
+            call.assert_not_called()
+        self.assertFalse(Order.objects.exists())
+
+    def test_missing_fields(self):
+        response = self.post({'tickets': []})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('trip_id, departure, destination', orjson.loads(response.content)['error'])
+
+    def test_circuit_open_is_not_a_booking_error(self):
+        with mock.patch('base.booking.call', side_effect=CircuitOpenError('SaleEx', 7)):
+            with self.assertRaises(CircuitOpenError):
+                BookingPipeline().run(BOOKING)
+            response = self.post(BOOKING)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+
+    def test_circuit_open_after_order_created_keeps_order(self):
+        def call(wsdl, operation, **kwargs):
+            if operation == 'StartSaleSession':
+                return {'Number': 'S-1', 'Status': 'SaleSession', 'Tickets': None}
+            raise CircuitOpenError('SaleEx', 7)
+
+        with mock.patch('base.booking.call', side_effect=call):
+            response = self.post(BOOKING)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        body = orjson.loads(response.content)
+        self.assertEqual(body['order_id'], 'S-1')
+        self.assertEqual(body['failed_step'], 'AddTickets')
+        self.assertEqual([(step['step'], step['ok']) for step in body['steps']],
+                         [('StartSaleSession', True), ('AddTickets', False)])
+
+
+@override_settings(ORDERS_WRITE_RETRIES=2, ORDERS_WRITE_RETRY_BACKOFF=0)
+class RecorderTests(TransactionTestCase):
+
+    def flaky_recorder(self, failures, error='database is locked'):
+        calls = []
+
+        def store_flaky(number):
+            calls.append(number)
+            if len(calls) <= failures:
+                raise OperationalError(error)
+            Order.objects.create(number=number)
+
+        return recorder(store_flaky), calls
+
+    def test_locked_write_is_retried(self):
+        store, calls = self.flaky_recorder(failures=2)
+        store('A-1')
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(Order.objects.filter(number='A-1').exists())
+
+    def test_lost_write_is_counted(self):
+        store, calls = self.flaky_recorder(failures=3)
+        lost_before = lost_writes._values.get(('store_flaky',), 0)
+        with self.assertLogs('base.orders', 'ERROR'):
+            store('A-2')
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(lost_writes._values[('store_flaky',)], lost_before + 1)
+
+    def test_other_errors_are_not_retried(self):
+        store, calls = self.flaky_recorder(failures=1, error='no such table: base_order')
+        with self.assertLogs('base.orders', 'ERROR'):
+            store('A-3')
+        self.assertEqual(len(calls), 1)
+
+
+@override_settings(ORDERS_WRITE_RETRIES=0)
+class ConcurrentRecorderTests(TransactionTestCase):
+
+    def test_concurrent_writes_are_not_lost(self):
+        threads_count, rounds = 8, 10
+        functions = ('record_sale_session', 'record_tickets', 'record_order_status')
+        lost_before = {name: lost_writes._values.get((name,), 0) for name in functions}
+        barrier = threading.Barrier(threads_count)
+        errors = []
+
+        def order(number, seats):
+            tickets = [{'Number': f'{number}-{seat}', 'SeatNum': str(seat), 'Status': 'Reserved'} for seat in seats]
+            return {'Number': number, 'Status': 'Reserved', 'Tickets': {'Elements': tickets}}
+
+        def write(index):
+            try:
+                barrier.wait(5)
+                for round_ in range(rounds):
+                    number = f'T-{index}-{round_}'
+                    record_sale_session(order(number, [1]), 'trip', 'departure', 'destination')
+                    record_tickets(number, order(number, [1, 2]))
+                    record_order_status(number, Order.STATUS_RESERVED, order(number, [2]))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=(index,)) for index in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+
+        self.assertEqual(errors, [])
+        self.assertEqual({name: lost_writes._values.get((name,), 0) for name in functions}, lost_before)
+        self.assertEqual(Order.objects.filter(status=Order.STATUS_RESERVED, trip_id='trip').count(),
+                         threads_count * rounds)
+        self.assertEqual(Ticket.objects.count(), threads_count * rounds)
+
+
+class SeatInvalidationTests(TestCase):
+
+    def setUp(self):
+        seats_cache.clear()
+        self.addCleanup(seats_cache.clear)
+
+    def test_order_from_another_worker_invalidates_its_trip(self):
+        Order.objects.create(number='O-1', trip_id='trip', departure_id='departure', destination_id='destination')
+        key = trip_key('trip', 'departure', 'destination')
+        seats_cache.set(key, SeatMap(0, b'{}'))
+        seats_cache.set(trip_key('other', 'departure', 'destination'), SeatMap(0, b'{}'))
+
+        with mock.patch.dict('base.seats._order_trips', clear=True):
+            invalidate_order('O-1')
+            invalidate_order('unknown')
+
+        self.assertIsNone(seats_cache.get(key))
+        self.assertIsNotNone(seats_cache.get(trip_key('other', 'departure', 'destination')))
+
+
+class BulkTicketStatusTests(TestCase):
+
+    def setUp(self):
+        ticket_status_cache.clear()
+        self.addCleanup(ticket_status_cache.clear)
+
+    @override_settings(TICKET_STATUS_BULK_CONCURRENCY=2)
+    def test_in_flight_calls_limited_per_request(self):
+        probe = PeakProbe('Sold')
+        tickets = [{'departure': 'D', 'ticket': str(number)} for number in range(10)]
+        with mock.patch('base.views.fetch_ticket_status', side_effect=probe):
+            response = self.client.post('/bulk_ticket_status/', orjson.dumps({'tickets': tickets}),
+                                        content_type='application/json')
+        body = orjson.loads(response.content)
+        self.assertEqual(body['fetched'], 10)
+        self.assertEqual([item['status'] for item in body['tickets']], ['Sold'] * 10)
+        self.assertLessEqual(probe.peak, 2)
+
+
+class JobQueueTests(TestCase):
+
+    def stale_job(self, operation, attempts=1):
+        started_at = timezone.now() - datetime.timedelta(hours=1)
+        return Job.objects.create(operation=operation, key='A-1', params={'OrderId': 'A-1'}, status=Job.STATUS_RUNNING,
+                                  attempts=attempts, run_after=started_at, started_at=started_at)
+
+    def test_stale_payment_needs_reconciliation(self):
+        job = self.stale_job('payment')
+        with self.assertLogs('base.jobs', 'ERROR'):
+            self.assertEqual(reconcile_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_RECONCILE)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(enqueue('payment', {'OrderId': 'A-1'}), job)
+
+    def test_sweep_reads_only_without_stale_jobs(self):
+        enqueue('payment', {'OrderId': 'A-1'})
+        with self.assertNumQueries(1):
+            self.assertEqual(reconcile_stale(), 0)
+
+    @override_settings(JOBS_STALE_AFTER=300)
+    def test_sweep_runs_on_slow_timer_in_first_worker(self):
+        first, second = JobWorker(0), JobWorker(1)
+        with mock.patch('base.jobs.reconcile_stale') as sweep:
+            for _ in range(3):
+                first.sweep_if_due()
+                second.sweep_if_due()
+            self.assertEqual(sweep.call_count, 1)
+            first.next_sweep = time.monotonic()
+            first.sweep_if_due()
+            self.assertEqual(sweep.call_count, 2)
+
+    def test_payment_retried_only_if_never_sent(self):
+        from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+        from zeep.exceptions import Fault, TransportError
+
+        refused = requests.ConnectionError(MaxRetryError(None, '/SaleEx', NewConnectionError(None, 'refused')))
+        reset = requests.ConnectionError(ProtocolError('Connection aborted.', ConnectionResetError()))
+        cases = [
+            (refused, Job.STATUS_QUEUED),
+            (requests.ConnectTimeout('connect timeout'), Job.STATUS_QUEUED),
+            (CircuitOpenError('SaleEx', 7), Job.STATUS_QUEUED),
+            (reset, Job.STATUS_RECONCILE),
+            (requests.ReadTimeout('read timeout'), Job.STATUS_RECONCILE),
+            (TransportError(status_code=504), Job.STATUS_RECONCILE),
+            (Fault('Заказ не найден'), Job.STATUS_FAILED),
+        ]
+        for index, (exc, status) in enumerate(cases):
+            with self.subTest(error=repr(exc)):
+                enqueue('payment', {'OrderId': f'R-{index}'})
+                job = claim_job('test')
+                with mock.patch('base.jobs.call', side_effect=exc), self.assertLogs('base.jobs', 'WARNING'):
+                    run_job(job)
+                job.refresh_from_db()
+                self.assertEqual(job.status, status)
+
+    def test_unresolved_job_unique_per_key(self):
+        self.stale_job('payment')
+        with self.assertRaises(IntegrityError):
+            self.stale_job('payment')
+
+    def test_enqueue_race_returns_existing_job(self):
+        existing = enqueue('payment', {'OrderId': 'A-1'})
+        # Проверка перед вставкой не видит задачу, поставленную параллельным запросом.
+        with mock.patch.object(QuerySet, 'first', autospec=True, side_effect=[None, existing]):
+            self.assertEqual(enqueue('payment', {'OrderId': 'A-1'}), existing)
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_done_payment_not_enqueued_again(self):
+        first = enqueue('payment', {'OrderId': 'A-1'})
+        Job.objects.filter(pk=first.pk).update(status=Job.STATUS_DONE)
+        self.assertEqual(enqueue('payment', {'OrderId': 'A-1'}), first)
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_new_job_after_previous_failed(self):
+        first = enqueue('payment', {'OrderId': 'A-1'})
+        Job.objects.filter(pk=first.pk).update(status=Job.STATUS_FAILED)
+        self.assertNotEqual(enqueue('payment', {'OrderId': 'A-1'}), first)
+
+    def test_job_status_validates_job_id(self):
+        job = enqueue('payment', {'OrderId': 'A-1'})
+        cases = {'': 400, 'abc': 400, '1.5': 400, '0': 404, '-1': 404, str(2 ** 70): 404, str(job.pk + 1): 404,
+                 str(job.pk): 202}
+        for job_id, status in cases.items():
+            with self.subTest(job_id=job_id):
+                self.assertEqual(self.client.get('/job_status/', {'job_id': job_id}).status_code, status)
+
+
+class AsgiConcurrencyTests(SimpleTestCase):
+
+    def setUp(self):
+        trips_cache.clear()
+        self.addCleanup(trips_cache.clear)
+
+    def test_middleware_is_async_capable(self):
+        async def get_response(request):
+            return None
+
+        for middleware_class in (MetricsMiddleware, ProfilingMiddleware, UpstreamErrorMiddleware):
+            with self.subTest(middleware=middleware_class.__name__):
+                self.assertTrue(middleware_class.async_capable)
+                self.assertTrue(asyncio.iscoroutinefunction(middleware_class(get_response)))
+
+    @override_settings(SERVER_TIMING_HEADER=True, PROFILING_SAMPLE_RATE=0)
+    async def test_async_views_run_concurrently_through_middleware(self):
+        async def slow_get_trips(wsdl, operation, **params):
+            await asyncio.sleep(0.2)
+            return {'Elements': TRIPS}
+
+        loop_thread = threading.current_thread()
+        middleware_threads = []
+
+        def start_request():
+            middleware_threads.append(threading.current_thread())
+            return start_request.original()
+
+        start_request.original = metrics.start_request
+        client = AsyncClient()
+        dates = [f'2023-06-{day:02d}' for day in range(1, 6)]
+        started = time.perf_counter()
+        with mock.patch('base.async_views.acall', side_effect=slow_get_trips), \
+                mock.patch('base.metrics.start_request', side_effect=start_request):
+            responses = await asyncio.gather(*(client.get('/async/search_trips/', {'date': date, 'fields': 'list'})
+                                               for date in dates))
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual([response.status_code for response in responses], [200] * len(dates))
+        self.assertTrue(all(response.has_header('Server-Timing') for response in responses))
+        # Синхронный middleware Django выполнил бы в отдельном потоке, по одному запросу за раз.
+        self.assertEqual(middleware_threads, [loop_thread] * len(dates))
+        self.assertLess(elapsed, 0.2 * len(dates) / 2)
+
+
+class StandinTests(SimpleTestCase):
+
+    def setUp(self):
+        standin.install()
+        self.addCleanup(standin.uninstall)
+        for cache in (trips_cache, seats_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def test_list_responses_keep_wrapper(self):
+        trips = call(WSDL_SALE, 'GetTrips', Departure='a', Destination='b', TripsDate='2023-06-09')
+        seats = call(WSDL_SALE, 'GetOccupiedSeats', TripId='t', Departure='a', Destination='b', OrderId='')
+        self.assertEqual((len(trips.Elements), trips.Total), (4, 4))
+        self.assertEqual((len(seats.Elements), seats.Total), (4, 4))
+
+    def test_search_trips_through_standin(self):
+        response = self.client.get('/search_trips/', {'fields': 'list'})
+        self.assertEqual(response.status_code, 200)
+        trips = orjson.loads(response.content)['Elements']
+        self.assertEqual(len(trips), 4)
+        self.assertTrue(all(trip['Id'] and trip['Departure']['Name'] for trip in trips))
+
+    def test_occupied_seats_through_standin(self):
+        response = self.client.get('/get_occupied_seats/', {'trip_id': 'standin-trip'})
+        self.assertEqual([seat['SeatNum'] for seat in orjson.loads(response.content)['Elements']], [3, 4, 7, 12])
+
+    def test_seat_map_bitmap(self):
+        seat_map = SeatMap.from_result(call(WSDL_SALE, 'GetOccupiedSeats', TripId='t', Departure='a',
+                                            Destination='b', OrderId=''))
+        self.assertEqual(seat_map.occupied_seats(), [3, 4, 7, 12])
+        self.assertTrue(seat_map.is_occupied('7'))
+        self.assertFalse(seat_map.is_occupied(5))
+
+
+class SoapClientTests(SimpleTestCase):
+
+    def setUp(self):
+        server = standin.start_standin_server()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.wsdl = f'{standin.standin_url(server)}SalePort?wsdl'
+        self.addCleanup(invalidate_client, self.wsdl)
+
+    def test_client_reused_until_invalidated(self):
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(get_client(self.wsdl))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(clients), 4)
+        self.assertTrue(all(client is clients[0] for client in clients))
+        self.assertIs(get_client(self.wsdl), clients[0])
+
+        invalidate_client(self.wsdl)
+        rebuilt = get_client(self.wsdl)
+        self.assertIsNot(rebuilt, clients[0])
+        self.assertIs(get_client(self.wsdl), rebuilt)
+
+    def test_transport_stats_count_pool_requests(self):
+        call(self.wsdl, 'GetTrips', Departure='a', Destination='b', TripsDate='2023-06-09')
+        call(self.wsdl, 'GetTrips', Departure='a', Destination='b', TripsDate='2023-06-10')
+        stats = transport_stats()
+
+        # Пул соединений у каждого хоста свой, а порт подменного сервера новый в каждом тесте.
+        pool, = [pool for pool in stats['pools'] if pool['port'] == urlsplit(self.wsdl).port]
+        self.assertGreaterEqual(pool['requests'], 2)
+        self.assertGreaterEqual(pool['new_connections'], 1)
+        self.assertEqual(pool['pool_hits'], pool['requests'] - pool['new_connections'])
+        self.assertEqual(stats['requests'], sum(pool['requests'] for pool in stats['pools']))
+
+    def test_client_build_stats(self):
+        self.assertNotIn(self.wsdl, client_stats())
+        get_client(self.wsdl)
+        stats = client_stats()[self.wsdl]
+        self.assertEqual(stats['source'], 'remote')
+        self.assertGreater(stats['build_seconds'], 0)
+
+        invalidate_client(self.wsdl)
+        self.assertNotIn(self.wsdl, client_stats())
+
+
+class AsyncClientTests(SimpleTestCase):
+
+    async def test_wsdl_parsed_outside_event_loop(self):
+        loop_thread = threading.get_ident()
+        build_threads = []
+
+        def build_client(wsdl):
+            time.sleep(0.05)
+            build_threads.append(threading.get_ident())
+            return SimpleNamespace(wsdl='document')
+
+        wsdl = 'http://avibus.test/ws/SalePort?wsdl'
+        with mock.patch.dict('base.soap._clients', clear=True), mock.patch.dict('base.soap._build_times', clear=True), \
+                mock.patch('base.soap.build_client', side_effect=build_client), \
+                mock.patch('base.soap.build_async_transport', return_value='transport'), \
+                mock.patch('zeep.AsyncClient') as async_client:
+            clients = await asyncio.gather(get_async_client(wsdl), get_async_client(wsdl))
+            self.assertIs(await get_async_client(wsdl), clients[0])
+
+        self.assertIs(clients[0], clients[1])
+        self.assertEqual(len(build_threads), 1)
+        self.assertNotEqual(build_threads[0], loop_thread)
+        async_client.assert_called_once_with(wsdl='document', transport='transport')
+
+
+class SerializerParityTests(SimpleTestCase):
+
+    def setUp(self):
+        standin.install()
+        self.addCleanup(standin.uninstall)
+
+    def assert_same_as_serialize_object(self, value):
+        from django.http import JsonResponse
+        from zeep.helpers import serialize_object
+
+        expected = JsonResponse(serialize_object(value), safe=False).content
+        self.assertEqual(orjson.loads(dumps(value)), orjson.loads(expected))
+
+    def test_avibus_responses(self):
+        trips = call(WSDL_SALE, 'GetTrips', Departure='a', Destination='b', TripsDate='2023-06-09')
+        seats = call(WSDL_SALE, 'GetOccupiedSeats', TripId='t', Departure='a', Destination='b', OrderId='')
+        for value in (trips, seats, trips.Elements):
+            self.assert_same_as_serialize_object(value)
+
+    def test_durations(self):
+        from zeep.xsd.types.builtins import Duration
+
+        trips = call(WSDL_SALE, 'GetTrips', Departure='a', Destination='b', TripsDate='2023-06-09')
+        trip = trips.Elements[0]
+        trip.TravelTime = Duration().pythonvalue('PT3H30M')
+        self.assert_same_as_serialize_object(trips)
+        self.assertEqual(orjson.loads(dumps(trip))['TravelTime'], 'P0DT03H30M00S')
+
+        trip.TravelTime = Duration().pythonvalue('P1M2DT3H')
+        self.assertEqual(orjson.loads(dumps(trip))['TravelTime'], 'P1M2DT3H')
+
+
+class PrometheusMetricsTests(SimpleTestCase):
+
+    def metric(self, metric):
+        self.addCleanup(metrics.registry.pop, metric.name)
+        return metric
+
+    def test_scrape(self):
+        counter = self.metric(metrics.Counter('test_scrape_total', 'Тестовый счетчик.', ('view',)))
+        histogram = self.metric(metrics.Histogram('test_scrape_seconds', 'Тестовая гистограмма.', ('view',),
+                                                  buckets=(0.1, 1)))
+        counter.inc(view='a"b\\c\nd')
+        counter.inc(view='a"b\\c\nd')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, view='trips')
+
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        for line in [
+            '# HELP test_scrape_total Тестовый счетчик.',
+            '# TYPE test_scrape_total counter',
+            r'test_scrape_total{view="a\"b\\c\nd"} 2',
+            '# TYPE test_scrape_seconds histogram',
+            'test_scrape_seconds_bucket{view="trips",le="0.1"} 1',
+            'test_scrape_seconds_bucket{view="trips",le="1"} 2',
+            'test_scrape_seconds_bucket{view="trips",le="+Inf"} 3',
+            'test_scrape_seconds_sum{view="trips"} 5.55',
+            'test_scrape_seconds_count{view="trips"} 3',
+            '# TYPE avibus_call_seconds histogram',
+        ]:
+            self.assertIn(line, lines)
+
+
+class ProfilingTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        settings_override = override_settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=1,
+                                              PROFILING_MAX_FILES=100, PROFILING_TOKEN='secret')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def reports(self):
+        return sorted(path.name for path in self.directory.iterdir())
+
+    def test_sampled_request_writes_report(self):
+        response = self.client.get('/api/metrics/')
+        name = response['X-Profile-Id']
+        self.assertEqual(self.reports(), [f'{name}.prof', f'{name}.txt'])
+        report = (self.directory / f'{name}.txt').read_text(encoding='utf-8')
+        self.assertIn('view: api:metrics\n', report)
+        self.assertIn('trigger: sample\n', report)
+        self.assertIn('status: 200\n', report)
+        self.assertGreater(pstats.Stats(str(self.directory / f'{name}.prof')).total_calls, 0)
+
+    def test_trigger(self):
+        with override_settings(PROFILING_SAMPLE_RATE=0):
+            self.assertNotIn('X-Profile-Id', self.client.get('/api/metrics/'))
+            self.assertNotIn('X-Profile-Id', self.client.get('/api/metrics/', HTTP_X_PROFILE='wrong'))
+            self.assertEqual(self.reports(), [])
+            name = self.client.get('/api/metrics/', HTTP_X_PROFILE='secret')['X-Profile-Id']
+        self.assertIn('trigger: header\n', (self.directory / f'{name}.txt').read_text(encoding='utf-8'))
+
+    def test_old_reports_pruned(self):
+        with override_settings(PROFILING_MAX_FILES=2):
+            names = [self.client.get('/api/metrics/')['X-Profile-Id'] for _ in range(4)]
+        self.assertEqual(self.reports(), sorted(f'{name}.{suffix}' for name in names[2:] for suffix in ('prof', 'txt')))
+
+
+class BenchCheckTests(SimpleTestCase):
+
+    def test_check_body(self):
+        trips = dumps({'Elements': TRIPS})
+        self.assertIsNone(check_body('search_trips', 200, trips))
+        self.assertIsNone(check_body('async_search_trips', 200, trips))
+        self.assertEqual(check_body('search_trips', 503, trips), 'HTTP 503')
+        self.assertEqual(check_body('search_trips', 200, b'{"Elements": []}'), 'пустой список Elements')
+        self.assertIn('без полей', check_body('async_search_trips', 200, b'{"Elements": [{}, {}]}'))
+        self.assertEqual(check_body('search_trips', 200, b'[]'), 'ожидался объект, получено list')
+        self.assertEqual(check_body('get_directions', 200, b'<html>'), 'тело не JSON')
+        self.assertIn('errors', check_body('search_anywhere', 200, orjson.dumps(
+            {'destinations': [{'id': '1', 'name': 'A', 'trips': 1, 'min_price': '1'}], 'errors': {'2': 'timeout'}})))
+        self.assertEqual(check_body('book_order', 200, b'{"order_id": "1"}'), 'нет полей order, steps')
+
+
+class CsrfTests(TestCase):
+
+    def test_json_post_views_exempt_from_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post('/bulk_ticket_status/', orjson.dumps({'tickets': []}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = client.post('/book_order/', orjson.dumps({}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_admin_keeps_csrf_and_frame_protection(self):
+        client = Client(enforce_csrf_checks=True)
+        self.assertEqual(client.post('/admin/login/', {'username': 'a', 'password': 'b'}).status_code, 403)
+        self.assertEqual(client.get('/admin/login/')['X-Frame-Options'], 'DENY')
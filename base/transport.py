@@ -0,0 +1,30 @@
+from django.conf import settings
+from zeep.transports import Transport
+
+from . import metrics
+from .soap import _call_local, port_name, save_recording
+
+
+class BudgetTransport(Transport):
+    """
+    Транспорт, таймаут операций которого можно сузить для текущего потока через operation_timeout.
+    Транспорт общий для всех потоков, поэтому сам таймаут в нем не меняется.
+    """
+
+    @property
+    def operation_timeout(self):
+        return getattr(_call_local, 'timeout', None) or self._operation_timeout
+
+    @operation_timeout.setter
+    def operation_timeout(self, value):
+        self._operation_timeout = value
+
+    def post(self, address, message, headers):
+        response = super().post(address, message, headers)
+        operation = getattr(_call_local, 'operation', None) or 'unknown'
+        metrics.upstream_request_bytes.observe(len(message), operation=operation)
+        metrics.upstream_response_bytes.observe(len(response.content), operation=operation)
+        if settings.AVIBUS_RECORD_DIR and response.status_code == 200 and operation != 'unknown':
+            save_recording(settings.AVIBUS_RECORD_DIR, port_name(address), operation, response.content)
+        return response
+
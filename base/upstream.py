@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics
+from .admission import aadmitted, admitted
+from .soap import get_async_client, get_client, operation_timeout, port_name
+
+logger = logging.getLogger(__name__)
+
+# Операции только на чтение: их можно повторить после сбоя, не рискуя изменить заказ дважды.
+SAFE_OPERATIONS = frozenset({
+    'GetBusStops',
+    'GetDestinations',
+    'GetTrips',
+    'GetTripSegment',
+    'GetOccupiedSeats',
+    'GetTicketStatus',
+})
+# Если от бюджета осталось меньше, повтор не запускается.
+MIN_ATTEMPT_SECONDS = 0.5
+
+# Автоматы отключения по имени порта Avibus.
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """
+    Порт Avibus временно отключен автоматом после серии сбоев; запрос не отправлялся.
+    """
+
+    def __init__(self, port, retry_after):
+        super().__init__(f'Сервис Avibus {port} временно недоступен')
+        self.port = port
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(exc):
+    """
+    Проверяет, является ли ошибка сбоем Avibus: сеть, таймаут или ответ 5xx без SOAP Fault.
+    SOAP Fault означает, что сервис ответил, и автомат отключения его не учитывает.
+
+    Args:
+        exc (Exception): Ошибка вызова.
+
+    Returns:
+        bool: True для сбоя сервиса.
+    """
+    # Ошибку вернул уже загруженный транспорт, поэтому импорт здесь ничего не стоит; httpx
+    # загружается только асинхронным клиентом, и без него ошибка httpx появиться не может.
+    import requests
+    from zeep.exceptions import TransportError
+
+    if isinstance(exc, TransportError):
+        return exc.status_code == 0 or exc.status_code >= 500
+    if isinstance(exc, (requests.RequestException, asyncio.TimeoutError)):
+        return True
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(exc, httpx.TransportError)
+
+
+class CircuitBreaker:
+    """
+    Автомат отключения порта Avibus. В закрытом состоянии считает сбои среди последних вызовов
+    и открывается, когда их доля превышает порог. Открытый автомат сразу отклоняет вызовы,
+    а через SOAP_BREAKER_OPEN_SECONDS пропускает один пробный: успех закрывает автомат, сбой снова открывает.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=settings.SOAP_BREAKER_WINDOW)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opens = 0
+        self.rejected = 0
+
+    def before_call(self):
+        """
+        Пропускает вызов или отклоняет его, если автомат открыт.
+
+        Raises:
+            CircuitOpenError: Если автомат открыт или пробный вызов уже выполняется.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_after = self._opened_at + settings.SOAP_BREAKER_OPEN_SECONDS - time.monotonic()
+                if retry_after > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, retry_after)
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, settings.SOAP_BREAKER_OPEN_SECONDS)
+                self._probing = True
+
+    def record(self, ok):
+        """
+        Учитывает результат вызова.
+
+        Args:
+            ok (bool): False, если вызов завершился сбоем сервиса.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(ok)
+            calls = len(self._outcomes)
+            if (calls >= settings.SOAP_BREAKER_MIN_CALLS
+                    and self._outcomes.count(False) / calls >= settings.SOAP_BREAKER_ERROR_RATE):
+                self._open()
+
+    def release(self):
+        """
+        Освобождает место пробного вызова, который был отменен и не дал результата.
+        """
+        with self._lock:
+            self._probing = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.opens += 1
+        logger.warning('Circuit breaker for %s is open for %ss', self.name, settings.SOAP_BREAKER_OPEN_SECONDS)
+
+    def stats(self):
+        """
+        Возвращает состояние автомата.
+
+        Returns:
+            dict: Состояние, доля сбоев в окне, число открытий и отклоненных вызовов.
+        """
+        with self._lock:
+            calls = len(self._outcomes)
+            failures = self._outcomes.count(False)
+            retry_after = self._opened_at + settings.SOAP_BREAKER_OPEN_SECONDS - time.monotonic()
+            return {
+                'state': self.state,
+                'calls': calls,
+                'failures': failures,
+                'error_rate': round(failures / calls, 3) if calls else 0.0,
+                'opens': self.opens,
+                'rejected': self.rejected,
+                'retry_after': round(max(retry_after, 0), 1) if self.state == self.OPEN else 0,
+            }
+
+
+def get_breaker(wsdl):
+    name = port_name(wsdl)
+    breaker = breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def breaker_stats():
+    """
+    Возвращает состояние автоматов отключения всех портов.
+
+    Returns:
+        dict: Состояние по имени порта.
+    """
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+
+def operation_budget(operation):
+    return settings.SOAP_OPERATION_TIMEOUTS.get(operation, settings.SOAP_READ_TIMEOUT)
+
+
+def retry_delay(attempt):
+    """
+    Задержка перед повтором: экспоненциальная с полным случайным разбросом,
+    чтобы повторы многих воркеров не приходили в Avibus одновременно.
+
+    Args:
+        attempt (int): Номер неудачной попытки, начиная с 0.
+
+    Returns:
+        float: Задержка в секундах.
+    """
+    backoff = min(settings.SOAP_SAFE_RETRY_MAX_BACKOFF, settings.SOAP_SAFE_RETRY_BACKOFF * 2 ** attempt)
+    return random.uniform(0, backoff)
+
+
+@contextmanager
+def measured_call(port, operation):
+    """
+    Записывает в метрики длительность и исход вызова операции (со всеми повторами)
+    и добавляет его ко времени ожидания Avibus текущего запроса.
+
+    Args:
+        port (str): Имя порта.
+        operation (str): Имя операции.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as exc:
+        seconds = time.perf_counter() - started
+        metrics.upstream_seconds.observe(seconds, port=port, operation=operation, outcome='error')
+        metrics.upstream_errors.inc(port=port, operation=operation, error=type(exc).__name__)
+        metrics.add_upstream(operation, seconds)
+        raise
+    seconds = time.perf_counter() - started
+    metrics.upstream_seconds.observe(seconds, port=port, operation=operation, outcome='ok')
+    metrics.add_upstream(operation, seconds)
+
+
+def call(wsdl, operation, **kwargs):
+    """
+    Вызывает операцию Avibus в пределах ее бюджета времени через ограничитель вызовов процесса (base.admission)
+    и автомат отключения порта. Ожидание места в ограничителе расходует бюджет операции; место занимается
+    на каждую попытку и освобождается на время паузы перед повтором.
+    Операции чтения при сбое сервиса повторяются, пока позволяет бюджет; операции продажи и оплаты не повторяются.
+
+    Args:
+        wsdl (str): URL WSDL порта.
+        operation (str): Имя операции, например GetTrips.
+        **kwargs: Параметры операции.
+
+    Returns:
+        object: Ответ Avibus.
+
+    Raises:
+        AdmissionRejectedError: Если воркер перегружен и вызов не допущен ограничителем.
+        CircuitOpenError: Если порт отключен автоматом.
+    """
+    deadline = time.monotonic() + operation_budget(operation)
+    retries = settings.SOAP_SAFE_RETRIES if operation in SAFE_OPERATIONS else 0
+    breaker = get_breaker(wsdl)
+    method = getattr(get_client(wsdl).service, operation)
+
+    attempt = 0
+    with measured_call(breaker.name, operation):
+        while True:
+            with admitted(operation, deadline - MIN_ATTEMPT_SECONDS):
+                breaker.before_call()
+                ok = None
+                try:
+                    with operation_timeout(max(deadline - time.monotonic(), MIN_ATTEMPT_SECONDS), operation):
+                        result = method(**kwargs)
+                    ok = True
+                except Exception as exc:
+                    ok = not is_upstream_failure(exc)
+                    delay = retry_delay(attempt)
+                    if ok or attempt >= retries or time.monotonic() + delay + MIN_ATTEMPT_SECONDS > deadline:
+                        raise
+                    logger.info('Retrying %s after %s in %.2fs', operation, exc, delay)
+                    metrics.upstream_retries.inc(port=breaker.name, operation=operation)
+                else:
+                    return result
+                finally:
+                    # Вызов, прерванный без результата (SystemExit, KeyboardInterrupt), только освобождает пробный.
+                    if ok is None:
+                        breaker.release()
+                    else:
+                        breaker.record(ok)
+            # Место в ограничителе уже освобождено: пауза перед повтором не занимает его.
+            attempt += 1
+            time.sleep(delay)
+
+
+async def acall(wsdl, operation, **kwargs):
+    """
+    Асинхронная версия call для представлений под ASGI.
+
+    Args:
+        wsdl (str): URL WSDL порта.
+        operation (str): Имя операции, например GetTrips.
+        **kwargs: Параметры операции.
+
+    Returns:
+        object: Ответ Avibus.
+
+    Raises:
+        AdmissionRejectedError: Если воркер перегружен и вызов не допущен ограничителем.
+        CircuitOpenError: Если порт отключен автоматом.
+    """
+    deadline = time.monotonic() + operation_budget(operation)
+    retries = settings.SOAP_SAFE_RETRIES if operation in SAFE_OPERATIONS else 0
+    breaker = get_breaker(wsdl)
+    method = getattr((await get_async_client(wsdl)).service, operation)
+
+    attempt = 0
+    with measured_call(breaker.name, operation):
+        while True:
+            async with aadmitted(operation, deadline - MIN_ATTEMPT_SECONDS):
+                breaker.before_call()
+                ok = None
+                try:
+                    result = await asyncio.wait_for(method(**kwargs),
+                                                    timeout=max(deadline - time.monotonic(), MIN_ATTEMPT_SECONDS))
+                    ok = True
+                except Exception as exc:
+                    ok = not is_upstream_failure(exc)
+                    delay = retry_delay(attempt)
+                    if ok or attempt >= retries or time.monotonic() + delay + MIN_ATTEMPT_SECONDS > deadline:
+                        raise
+                    logger.info('Retrying %s after %s in %.2fs', operation, exc, delay)
+                    metrics.upstream_retries.inc(port=breaker.name, operation=operation)
+                else:
+                    return result
+                finally:
+                    # Отмененный вызов (CancelledError) результата не дал и только освобождает пробный.
+                    if ok is None:
+                        breaker.release()
+                    else:
+                        breaker.record(ok)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+BREAKER_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+metrics.Gauge('avibus_breaker_state', 'Состояние автомата отключения порта: 0 закрыт, 1 пробный вызов, 2 открыт.',
+              ('port',), collect=lambda: [({'port': name}, BREAKER_STATES[breaker.state])
+                                          for name, breaker in list(breakers.items())])
+metrics.Counter('avibus_breaker_rejected_total', 'Вызовы, отклоненные открытым автоматом отключения.',
+                ('port',), collect=lambda: [({'port': name}, breaker.rejected)
+                                            for name, breaker in list(breakers.items())])
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 
 app_name = 'base'
 
@@ -9,6 +9,10 @@ urlpatterns = [
          name='get_destinations'),
     path('search_trips/', views.search_trips,
          name='search_trips'),
+    path('search_trips_range/', views.search_trips_range,
+         name='search_trips_range'),
+    path('search_anywhere/', views.search_anywhere,
+         name='search_anywhere'),
     path('search_trip_segment/', views.search_trip_segment,
          name='search_trip_segment'),
     path('get_occupied_seats/', views.get_occupied_seats,
@@ -27,6 +31,8 @@ urlpatterns = [
          name='set_ticket_data'),
     path('reserve_order/', views.reserve_order,
          name='reserve_order'),
+    path('book_order/', views.book_order,
+         name='book_order'),
     path('make_payment/', views.make_payment,
          name='make_payment'),
     path('cancel_payment/', views.cancel_payment,
@@ -43,4 +49,28 @@ urlpatterns = [
          name='cancel_return_payment'),
     path('get_ticket_status/', views.get_ticket_status,
          name='get_ticket_status'),
+    path('bulk_ticket_status/', views.bulk_ticket_status,
+         name='bulk_ticket_status'),
+    path('job_status/', views.job_status,
+         name='job_status'),
+    path('order_status/', views.order_status,
+         name='order_status'),
+    path('ticket_info/', views.ticket_info,
+         name='ticket_info'),
+    path('trip_tickets/', views.trip_tickets,
+         name='trip_tickets'),
+
+    # Асинхронные версии представлений для запуска под ASGI
+    path('async/', async_views.get_directions,
+         name='async_get_directions'),
+    path('async/get_destinations/', async_views.get_destinations,
+         name='async_get_destinations'),
+    path('async/search_trips/', async_views.search_trips,
+         name='async_search_trips'),
+    path('async/search_trip_segment/', async_views.search_trip_segment,
+         name='async_search_trip_segment'),
+    path('async/get_occupied_seats/', async_views.get_occupied_seats,
+         name='async_get_occupied_seats'),
+    path('async/get_ticket_status/', async_views.get_ticket_status,
+         name='async_get_ticket_status'),
 ]
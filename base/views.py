@@ -1,69 +1,185 @@
-import os
-from django.http import JsonResponse
-from zeep import Client
-from zeep.helpers import serialize_object
-from requests import Session
-from requests.auth import HTTPBasicAuth
-from zeep.transports import Transport
-from dotenv import load_dotenv
+import datetime
+import functools
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .booking import BookingError, BookingPipeline, validate_booking
+from .cache import TTLCache
+from .directory import bus_stops, destinations
+from .http import conditional_json
+from .jobs import enqueue, job_to_dict, wait_for_job
+from .models import Job, Order, Ticket
+from .orders import (order_to_dict, record_order_status, record_sale_session, record_ticket_return,
+                     record_ticket_status, record_ticket_statuses, record_tickets, remove_ticket_return,
+                     ticket_to_dict)
+from .seats import SeatMap, invalidate_order, invalidate_trip, remember_order, seats_cache, trip_key
+from .serializers import (as_mapping, elements, elements_mapping, get_field, json_response, parse_fields,
+                          stream_response)
+from .soap import WSDL_SALE
+from .upstream import call
+
+# Общий пул потоков для параллельных запросов к Avibus внутри одного запроса к представлению.
+fanout_pool = ThreadPoolExecutor(max_workers=settings.SOAP_FANOUT_WORKERS, thread_name_prefix='soap-fanout')
+trips_cache = TTLCache('trips', ttl=settings.TRIPS_CACHE_TTL, maxsize=settings.TRIPS_CACHE_MAXSIZE)
+ticket_status_cache = TTLCache('ticket_status', ttl=settings.TICKET_STATUS_CACHE_TTL,
+                               maxsize=settings.TICKET_STATUS_CACHE_MAXSIZE)
+
+
+def submit_limited(calls, limit):
+    """
+    Отправляет вызовы в общий пул, держа в нем не больше limit задач этого запроса одновременно,
+    чтобы один большой запрос не занимал весь пул и не задерживал другие представления.
+    Следующий вызов отправляется, когда завершается один из предыдущих; поток запроса ждет этого сам.
 
-load_dotenv()
+    Args:
+        calls (dict): Ключ → функция без аргументов.
+        limit (int): Сколько задач запроса может быть в пуле одновременно.
 
-WSDL_SCHEDULE = "http://dev.avibus.pro/UEEDev/ws/SchedulePort?wsdl"
-WSDL_SALE = "http://dev.avibus.pro/UEEDev/ws/SalePort?wsdl"
-USERNAME = os.getenv('USER_NAME')
-PASSWORD = os.getenv('PASSWORD')
+    Returns:
+        dict: Ключ → Future.
+    """
+    slots = threading.BoundedSemaphore(max(limit, 1))
+    futures = {}
+    for key, func in calls.items():
+        slots.acquire()
+        future = fanout_pool.submit(func)
+        future.add_done_callback(lambda _: slots.release())
+        futures[key] = future
+    return futures
+
+
+# Наборы полей для параметра fields: list — то, что нужно списку поездок на фронтенде, detail — ответ целиком.
+TRIP_FIELD_PRESETS = {
+    'list': parse_fields('Elements.Id,Elements.RouteNum,Elements.RouteName,Elements.Carrier,'
+                         'Elements.DepartureTime,Elements.ArrivalTime,Elements.Duration,'
+                         'Elements.FreeSeatsAmount,Elements.PassengerFareCost,'
+                         'Elements.Departure.Id,Elements.Departure.Name,'
+                         'Elements.Destination.Id,Elements.Destination.Name'),
+    'detail': None,
+}
+SEGMENT_FIELD_PRESETS = {
+    'list': parse_fields('Id,RouteNum,RouteName,Carrier,DepartureTime,ArrivalTime,Duration,'
+                         'FreeSeatsAmount,PassengerFareCost,Departure.Id,Departure.Name,'
+                         'Destination.Id,Destination.Name'),
+    'detail': None,
+}
+
+
+def response_fields(request, presets):
+    """
+    Возвращает дерево проекции ответа из параметра fields: имя набора из presets
+    или список полей через запятую, например fields=Elements.Id,Elements.DepartureTime.
 
+    Args:
+        request (HttpRequest): Запрос Django.
+        presets (dict): Наборы полей по имени.
 
-def get_client(wsdl):
+    Returns:
+        dict | None: Дерево проекции или None, если нужен весь ответ.
     """
-      Возвращает клиент SOAP для взаимодействия с API.
+    fields = request.GET.get('fields', '')
+    if fields in presets:
+        return presets[fields]
+    return parse_fields(fields)
 
-      Args:
-          wsdl (str): URL WSDL.
 
-      Returns:
-          zeep.Client: Клиент SOAP.
-      """
-    session = Session()
-    session.auth = HTTPBasicAuth(USERNAME, PASSWORD)
-    client = Client(wsdl=wsdl, transport=Transport(session=session))
-    return client
+def is_streaming(request):
+    """
+    Проверяет, запросил ли клиент потоковый ответ (stream=1).
 
+    Args:
+        request (HttpRequest): Запрос Django.
 
+    Returns:
+        bool: True, если ответ нужно отдавать потоком.
+    """
+    return request.GET.get('stream') in ('1', 'true')
+
+
+@conditional_json(max_age=settings.DIRECTIONS_MAX_AGE)
 def get_directions(request):
     """
-     Получает список доступных направлений из системы Avibus.
+     Получает список доступных направлений из локального справочника остановок Avibus.
+     Справочник обновляется в фоне, запрос не ждет SOAP.
 
      Args:
-         request (HttpRequest): Запрос Django.
+         request (HttpRequest): Запрос Django. Параметр stream=1 включает потоковый ответ.
 
      Returns:
-         JsonResponse: JSON-ответ с направлениями.
+         HttpResponse: JSON-ответ с направлениями.
      """
-    client = get_client(WSDL_SCHEDULE)
-    bus_stops = client.service.GetBusStops()
-    travel_directions = [{'id': td.Id, 'name': td.Name} for td in bus_stops if td.Automated]
-    return JsonResponse({'travel_directions': travel_directions})
+    travel_directions = bus_stops.travel_directions()
+    if is_streaming(request):
+        return stream_response({'travel_directions': travel_directions}, 'travel_directions')
+    return json_response({'travel_directions': travel_directions})
 
 
+def find_destinations(departure_id, substring=''):
+    """
+    Ищет пункты назначения в локальном индексе направлений, а если он еще не построен или
+    не знает пункт отправления, запрашивает их в системе Avibus.
+
+    Args:
+        departure_id (str): Идентификатор пункта отправления.
+        substring (str): Подстрока названия пункта назначения.
+
+    Returns:
+        list[dict] | None: Пункты назначения с ключами id и name или None, если их нет.
+    """
+    end_directions = destinations.destinations(departure_id, substring)
+    if end_directions is None:
+        found = call(WSDL_SALE, 'GetDestinations', Departure=departure_id, Substring=substring)
+        end_directions = [{'id': dis.Id, 'name': dis.Name} for dis in found] if found else None
+    return end_directions or None
+
+
+@conditional_json(max_age=settings.DESTINATIONS_MAX_AGE)
 def get_destinations(request):
     """
-    Получает список пунктов назначения для выбранного направления из системы Avibus.
+    Получает список пунктов назначения для выбранного направления.
+    Ответ берется из локального индекса направлений, а если он еще не построен или
+    не знает пункт отправления, запрашивается в системе Avibus.
 
     Args:
-        request (HttpRequest): Запрос Django.
+        request (HttpRequest): Запрос Django. Параметры departure и substring (подстрока названия).
 
     Returns:
-        JsonResponse: JSON-ответ с пунктами назначения.
+        HttpResponse: JSON-ответ с пунктами назначения.
     """
-    client = get_client(WSDL_SALE)
-    departure_id = '862fd93e-e633-11e7-80e7-00175d776a07'  # request.POST.get('travel_direction')
-    destinations = client.service.GetDestinations(Departure=departure_id, Substring='')
+    departure_id = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    substring = request.GET.get('substring', '')
 
-    end_directions = [{'id': dis.Id, 'name': dis.Name} for dis in destinations] if destinations else None
+    end_directions = find_destinations(departure_id, substring)
 
-    return JsonResponse({'end_directions': end_directions, 'departure': departure_id})
+    return json_response({'end_directions': end_directions, 'departure': departure_id})
+
+
+def get_trips(departure, destination, date):
+    """
+    Возвращает результат GetTrips, используя кэш поиска поездок.
+    Одновременные одинаковые запросы выполняют один вызов Avibus. В кэше лежат объекты zeep
+    как есть, их нельзя изменять.
+
+    Args:
+        departure (str): Идентификатор пункта отправления.
+        destination (str): Идентификатор пункта назначения.
+        date (str): Дата поездки в формате ГГГГ-ММ-ДД.
+
+    Returns:
+        object: Результат поиска поездок.
+    """
+    def load():
+        return call(WSDL_SALE, 'GetTrips', Departure=departure, Destination=destination, TripsDate=date)
+
+    return trips_cache.get_or_load((departure, destination, date), load)
 
 
 def search_trips(request):
@@ -71,20 +187,139 @@ def search_trips(request):
      Выполняет поиск поездок на основе выбранного направления и пункта назначения в системе Avibus.
 
      Args:
-         request (HttpRequest): Запрос Django.
+         request (HttpRequest): Запрос Django. Параметры departure, destination, date, fields
+             (список полей через запятую или набор list/detail) и stream=1 для потокового ответа.
 
      Returns:
-         JsonResponse: JSON-ответ с результатами поиска.
+         HttpResponse: JSON-ответ с результатами поиска.
      """
-    departure = '862fd93e-e633-11e7-80e7-00175d776a07'  # request.POST.get('start_direction')
-    destination = 'cb654d84-f487-11ed-83c7-d00da3a6c886'  # request.POST.get('end_direction')
-    date = '2023-06-09'
+    departure = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    destination = request.GET.get('destination', 'cb654d84-f487-11ed-83c7-d00da3a6c886')
+    date = request.GET.get('date', '2023-06-09')
+    fields = response_fields(request, TRIP_FIELD_PRESETS)
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.GetTrips(Departure=departure, Destination=destination, TripsDate=date)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = elements_mapping(get_trips(departure, destination, date))
 
-    return JsonResponse(bus_results_ser)
+    if is_streaming(request):
+        return stream_response(bus_results, 'Elements', fields=fields)
+    return json_response(bus_results, fields=fields)
+
+
+def trip_elements(bus_results):
+    """
+    Возвращает список поездок из результата GetTrips в любой из двух форм (см. serializers.elements).
+
+    Args:
+        bus_results (object): Результат get_trips.
+
+    Returns:
+        list: Поездки.
+
+    Raises:
+        TypeError: Если у результата неизвестная форма.
+    """
+    return elements(bus_results)
+
+
+def search_trips_range(request):
+    """
+    Выполняет поиск поездок сразу на несколько дней. Запросы GetTrips по дням выполняются
+    параллельно в общем пуле потоков, но не больше TRIPS_RANGE_CONCURRENCY одновременно,
+    чтобы широкий диапазон дат не занимал весь пул и не задерживал другие запросы.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметры departure, destination, date_from и date_to.
+
+    Returns:
+        HttpResponse: JSON-ответ с поездками за все дни, упорядоченными по дате.
+    """
+    departure = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    destination = request.GET.get('destination', 'cb654d84-f487-11ed-83c7-d00da3a6c886')
+    try:
+        date_from = datetime.date.fromisoformat(request.GET.get('date_from', '2023-06-09'))
+        date_to = datetime.date.fromisoformat(request.GET.get('date_to', date_from.isoformat()))
+    except ValueError:
+        return json_response({'error': 'Даты должны быть в формате ГГГГ-ММ-ДД'}, status=400)
+
+    days = (date_to - date_from).days + 1
+    if not 0 < days <= settings.TRIPS_RANGE_MAX_DAYS:
+        return json_response({'error': f'Диапазон должен содержать от 1 до {settings.TRIPS_RANGE_MAX_DAYS} дней'},
+                            status=400)
+
+    dates = [(date_from + datetime.timedelta(days=i)).isoformat() for i in range(days)]
+    futures = submit_limited({date: functools.partial(get_trips, departure, destination, date) for date in dates},
+                             settings.TRIPS_RANGE_CONCURRENCY)
+
+    trips = []
+    errors = {}
+    for date in dates:
+        try:
+            day_trips = trip_elements(futures[date].result())
+        except Exception as exc:
+            errors[date] = str(exc)
+            continue
+        trips.extend({'date': date, **as_mapping(trip)} for trip in day_trips)
+
+    return json_response({'departure': departure, 'destination': destination,
+                         'date_from': dates[0], 'date_to': dates[-1],
+                         'trips': trips, 'errors': errors})
+
+
+def summarize_trips(trips):
+    """
+    Сводка по поездкам в один пункт назначения: ближайшее отправление, минимальная цена и свободные места.
+
+    Args:
+        trips (list): Поездки из результата GetTrips.
+
+    Returns:
+        dict: Сводка по поездкам.
+    """
+    departure_times = [get_field(trip, 'DepartureTime') for trip in trips if get_field(trip, 'DepartureTime')]
+    prices = [get_field(trip, 'PassengerFareCost') for trip in trips
+              if get_field(trip, 'PassengerFareCost') is not None]
+    return {
+        'trips': len(trips),
+        'earliest_departure': min(departure_times) if departure_times else None,
+        'min_price': min(prices) if prices else None,
+        'free_seats': sum(get_field(trip, 'FreeSeatsAmount') or 0 for trip in trips),
+    }
+
+
+def search_anywhere(request):
+    """
+    Ищет поездки из пункта отправления во все доступные пункты назначения на выбранную дату.
+    Запросы GetTrips выполняются параллельно в общем пуле потоков, но не больше SEARCH_ANYWHERE_CONCURRENCY
+    одновременно: пунктов назначения бывают сотни.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметры departure и date.
+
+    Returns:
+        HttpResponse: JSON-ответ со сводкой по каждому пункту назначения, где есть поездки.
+    """
+    departure = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    date = request.GET.get('date', '2023-06-09')
+
+    end_directions = find_destinations(departure) or []
+    futures = submit_limited({index: functools.partial(get_trips, departure, dis['id'], date)
+                              for index, dis in enumerate(end_directions)},
+                             settings.SEARCH_ANYWHERE_CONCURRENCY)
+
+    results = []
+    errors = {}
+    for index, dis in enumerate(end_directions):
+        try:
+            trips = trip_elements(futures[index].result())
+        except Exception as exc:
+            errors[dis['id']] = str(exc)
+            continue
+        if trips:
+            results.append({'id': dis['id'], 'name': dis['name'], **summarize_trips(trips)})
+
+    results.sort(key=lambda item: (item['earliest_departure'] is None, item['earliest_departure'] or 0))
+
+    return json_response({'departure': departure, 'date': date, 'destinations': results, 'errors': errors})
 
 
 def search_trip_segment(request):
@@ -92,43 +327,49 @@ def search_trip_segment(request):
     Получает информацию о выбранной поездке и сегментах поездки из системы Avibus.
 
     Args:
-        request (HttpRequest): Запрос Django.
+        request (HttpRequest): Запрос Django. Параметр fields (список полей через запятую или набор list/detail).
 
     Returns:
-        JsonResponse: JSON-ответ с информацией о поездке и сегментах.
+        HttpResponse: JSON-ответ с информацией о поездке и сегментах.
     """
     departure = '862fd93e-e633-11e7-80e7-00175d776a07'
     destination = 'cb654d84-f487-11ed-83c7-d00da3a6c886'
     trip_id = '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041'
+    fields = response_fields(request, SEGMENT_FIELD_PRESETS)
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.GetTripSegment(TripId=trip_id, Departure=departure, Destination=destination)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'GetTripSegment', TripId=trip_id, Departure=departure, Destination=destination)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results, fields=fields)
 
 
 def get_occupied_seats(request):
     """
       Получает информацию о занятых и свободных местах на выбранной поездке в системе Avibus.
+      Карта мест без привязки к заказу кэшируется на SEATS_CACHE_TTL и сбрасывается
+      при изменении билетов этой поездки.
 
       Args:
-          request (HttpRequest): Запрос Django.
+          request (HttpRequest): Запрос Django. Параметры trip_id, departure, destination и order_id.
 
       Returns:
-          JsonResponse: JSON-ответ с информацией о местах.
+          HttpResponse: JSON-ответ с информацией о местах.
       """
-    departure = '862fd93e-e633-11e7-80e7-00175d776a07'
-    destination = 'cb654d84-f487-11ed-83c7-d00da3a6c886'
-    trip_id = '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041'
-    order_id = ''
+    departure = request.GET.get('departure', '862fd93e-e633-11e7-80e7-00175d776a07')
+    destination = request.GET.get('destination', 'cb654d84-f487-11ed-83c7-d00da3a6c886')
+    trip_id = request.GET.get('trip_id', '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041')
+    order_id = request.GET.get('order_id', '')
+
+    def load():
+        bus_results = call(WSDL_SALE, 'GetOccupiedSeats', TripId=trip_id, Departure=departure,
+                           Destination=destination, OrderId=order_id)
+        return SeatMap.from_result(bus_results)
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.GetOccupiedSeats(TripId=trip_id, Departure=departure,
-                                                  Destination=destination, OrderId=order_id)
-    bus_results_ser = serialize_object(bus_results)
+    if order_id:
+        seat_map = load()
+    else:
+        seat_map = seats_cache.get_or_load(trip_key(trip_id, departure, destination), load)
 
-    return JsonResponse(bus_results_ser)
+    return HttpResponse(seat_map.payload, content_type='application/json')
 
 
 def start_sale_session(request):
@@ -139,19 +380,22 @@ def start_sale_session(request):
            request (HttpRequest): Запрос Django.
 
        Returns:
-           JsonResponse: JSON-ответ с результатом начала сессии продажи.
+           HttpResponse: JSON-ответ с результатом начала сессии продажи.
        """
     departure = '862fd93e-e633-11e7-80e7-00175d776a07'
     destination = 'cb654d84-f487-11ed-83c7-d00da3a6c886'
     trip_id = '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041'
     order_id = ''
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.StartSaleSession(TripId=trip_id, Departure=departure,
-                                                  Destination=destination, OrderId=order_id)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'StartSaleSession', TripId=trip_id, Departure=departure,
+                       Destination=destination, OrderId=order_id)
 
-    return JsonResponse(bus_results_ser)
+    key = trip_key(trip_id, departure, destination)
+    invalidate_trip(key)
+    remember_order(getattr(bus_results, 'Number', None), key)
+    record_sale_session(bus_results, trip_id, departure, destination)
+
+    return json_response(bus_results)
 
 
 def add_tickets(request):
@@ -162,7 +406,7 @@ def add_tickets(request):
          request (HttpRequest): Запрос Django.
 
      Returns:
-         JsonResponse: JSON-ответ с результатом добавления билетов в заказ.
+         HttpResponse: JSON-ответ с результатом добавления билетов в заказ.
      """
     order_id = '00000026703'
 
@@ -174,11 +418,11 @@ def add_tickets(request):
         }
     }
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.AddTickets(OrderId=order_id, TicketSeats=ticket_seats)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'AddTickets', OrderId=order_id, TicketSeats=ticket_seats)
+    invalidate_order(order_id)
+    record_tickets(order_id, bus_results)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def add_tickets_baggage(request):
@@ -189,7 +433,7 @@ def add_tickets_baggage(request):
            request (HttpRequest): Запрос Django.
 
        Returns:
-           JsonResponse: JSON-ответ с результатом добавления билетов для багажа в заказ.
+           HttpResponse: JSON-ответ с результатом добавления билетов для багажа в заказ.
        """
     order_id = '00000026703'
 
@@ -201,11 +445,11 @@ def add_tickets_baggage(request):
         }
     }
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.AddTickets(OrderId=order_id, TicketSeats=ticket_seats)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'AddTickets', OrderId=order_id, TicketSeats=ticket_seats)
+    invalidate_order(order_id)
+    record_tickets(order_id, bus_results)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def del_tickets(request):
@@ -216,7 +460,7 @@ def del_tickets(request):
          request (HttpRequest): Запрос Django.
 
      Returns:
-         JsonResponse: JSON-ответ с результатом удаления билетов из заказа.
+         HttpResponse: JSON-ответ с результатом удаления билетов из заказа.
      """
     order_id = '00000026703'
 
@@ -227,11 +471,11 @@ def del_tickets(request):
         }
     }
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.DelTickets(OrderId=order_id, TicketSeats=ticket_seats)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'DelTickets', OrderId=order_id, TicketSeats=ticket_seats)
+    invalidate_order(order_id)
+    record_tickets(order_id, bus_results)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def change_fare_name(request):
@@ -242,7 +486,7 @@ def change_fare_name(request):
             request (HttpRequest): Запрос Django.
 
         Returns:
-            JsonResponse: JSON-ответ с результатом изменения тарифа в заказе.
+            HttpResponse: JSON-ответ с результатом изменения тарифа в заказе.
         """
     order_id = '00000026703'
 
@@ -255,11 +499,10 @@ def change_fare_name(request):
         }
     }
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.SetTicketData(OrderId=order_id, Tickets=tickets)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'SetTicketData', OrderId=order_id, Tickets=tickets)
+    record_tickets(order_id, bus_results)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 # def set_ticket_date(request):
@@ -350,7 +593,7 @@ def set_ticket_data(request):
             request (HttpRequest): Запрос Django.
 
         Returns:
-            JsonResponse: JSON-ответ с результатом добавления данных для поездки.
+            HttpResponse: JSON-ответ с результатом добавления данных для поездки.
         """
     order_id = '00000026703'
 
@@ -395,11 +638,10 @@ def set_ticket_data(request):
         ]
     }
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.SetTicketData(OrderId=order_id, Tickets=tickets)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'SetTicketData', OrderId=order_id, Tickets=tickets)
+    record_tickets(order_id, bus_results)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def reserve_order(request):
@@ -410,29 +652,90 @@ def reserve_order(request):
             request (HttpRequest): Запрос Django.
 
         Returns:
-            JsonResponse: JSON-ответ с результатом бронирования заказа.
+            HttpResponse: JSON-ответ с результатом бронирования заказа.
         """
     order_id = '00000026703'
     customer = {'Email': 'example@mail.com'}
     reserve_kind = None
     cheque_settings = {'ChequeWidth': '48'}
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.ReserveOrder(OrderId=order_id, Customer=customer,
-                                              ReserveKind=reserve_kind, ChequeSettings=cheque_settings)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'ReserveOrder', OrderId=order_id, Customer=customer,
+                       ReserveKind=reserve_kind, ChequeSettings=cheque_settings)
+    record_order_status(order_id, Order.STATUS_RESERVED, bus_results, customer_email=customer['Email'])
+
+    return json_response(bus_results)
+
+
+@csrf_exempt
+@require_POST
+def book_order(request):
+    """
+    Бронирует заказ за один запрос: начинает сессию продажи, добавляет билеты, заполняет данные
+    пассажиров и бронирует заказ в системе Avibus через один клиент SOAP.
+
+    Args:
+        request (HttpRequest): Запрос Django. Тело JSON с полями trip_id, departure, destination,
+            ticket_seats, tickets, customer, reserve_kind и cheque_settings.
+
+    Returns:
+        HttpResponse: JSON-ответ с номером заказа, результатом бронирования и временем каждого шага.
+    """
+    try:
+        booking = orjson.loads(request.body)
+    except orjson.JSONDecodeError:
+        booking = None
+    if not isinstance(booking, dict):
+        return json_response({'error': 'Тело запроса должно быть JSON-объектом'}, status=400)
+
+    errors = validate_booking(booking)
+    if errors:
+        return json_response({'error': '; '.join(errors)}, status=400)
+
+    try:
+        result = BookingPipeline().run(booking)
+    except BookingError as exc:
+        response = json_response({'error': exc.error, 'failed_step': exc.step, 'order_id': exc.order_id,
+                                  'steps': exc.steps}, status=502 if exc.retry_after is None else 503)
+        if exc.retry_after is not None:
+            response['Retry-After'] = str(math.ceil(exc.retry_after))
+        return response
+
+    return json_response(result)
+
+
+def job_response(request, job):
+    """
+    Возвращает состояние задачи очереди. С параметром wait ждет ее завершения не дольше
+    wait секунд (но не больше JOBS_LONG_POLL_MAX). Нечисловой wait игнорируется: задача уже поставлена.
+
+    Args:
+        request (HttpRequest): Запрос Django.
+        job (Job): Задача.
 
-    return JsonResponse(bus_results_ser)
+    Returns:
+        HttpResponse: JSON-ответ с задачей; 202, пока она не завершена.
+    """
+    try:
+        wait = min(float(request.GET.get('wait', 0)), settings.JOBS_LONG_POLL_MAX)
+    except ValueError:
+        wait = 0
+    if wait > 0:
+        job = wait_for_job(job.pk, wait)
+
+    result = job_to_dict(job)
+    result['status_url'] = f"{reverse('base:job_status')}?job_id={job.pk}"
+    return json_response(result, status=202 if job.status in Job.ACTIVE_STATUSES else 200)
 
 
 def make_payment(request):
     """
         Оплата заказа для выбранной поездки в системе Avibus.
+        Оплата выполняется воркером фоновой очереди, статус задачи отдает job_status.
 
         Args:
-            request (HttpRequest): Запрос Django.
+            request (HttpRequest): Запрос Django. Параметр wait - сколько секунд ждать результата.
 
         Returns:
-            JsonResponse: JSON-ответ с результатом оплаты заказа.
+            HttpResponse: JSON-ответ с задачей очереди; результат оплаты - в поле result.
         """
     order_id = '00000026703'
     terminal_id = ''
@@ -444,38 +747,35 @@ def make_payment(request):
         }
     }
     cheque_settings = {'ChequeWidth': '48'}
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.Payment(OrderId=order_id, TerminalId=terminal_id,
-                                         TerminalSessionId=terminal_session_id,
-                                         PaymentItems=payment_items,
-                                         ChequeSettings=cheque_settings)
-    bus_results_ser = serialize_object(bus_results)
+    job = enqueue('payment', {'OrderId': order_id, 'TerminalId': terminal_id,
+                              'TerminalSessionId': terminal_session_id,
+                              'PaymentItems': payment_items,
+                              'ChequeSettings': cheque_settings})
 
-    return JsonResponse(bus_results_ser)
+    return job_response(request, job)
 
 
 def cancel_payment(request):
     """
         Отмена оплата заказа для выбранной поездки в системе Avibus.
         Метод используется для отмены оплаты в случае технических проблем.
-        Вызвать его можно только в течение 10 минут после вызова метода Payment.
+        Вызвать его можно только в течение 10 минут после вызова метода Payment,
+        поэтому задача очереди после этого срока не выполняется.
 
         Args:
-            request (HttpRequest): Запрос Django.
+            request (HttpRequest): Запрос Django. Параметр wait - сколько секунд ждать результата.
 
         Returns:
-            JsonResponse: JSON-ответ с результатом отмены оплаты заказа.
+            HttpResponse: JSON-ответ с задачей очереди; результат отмены оплаты - в поле result.
         """
     order_id = '00000026703'
     ticket_seats = ''
     services = ''
     payment_items = ''
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.CancelPayment(OrderId=order_id, TicketSeats=ticket_seats,
-                                               Services=services, PaymentItems=payment_items)
-    bus_results_ser = serialize_object(bus_results)
+    job = enqueue('cancel_payment', {'OrderId': order_id, 'TicketSeats': ticket_seats,
+                                     'Services': services, 'PaymentItems': payment_items})
 
-    return JsonResponse(bus_results_ser)
+    return job_response(request, job)
 
 
 def create_return_order(request):
@@ -486,23 +786,23 @@ def create_return_order(request):
         request (HttpRequest): Запрос Django.
 
     Returns:
-        JsonResponse: JSON-ответ с результатом создания заказа на возврат.
+        HttpResponse: JSON-ответ с результатом создания заказа на возврат.
     """
     ticket_number = '00000005334032'
     seat_num = '2'
     departure = '862fd93e-e633-11e7-80e7-00175d776a07'
     return_order_id = ''
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.AddTicketReturn(
+    bus_results = call(
+        WSDL_SALE, 'AddTicketReturn',
         TicketNumber=ticket_number,
         SeatNum=seat_num,
         Departure=departure,
         ReturnOrderId=return_order_id
     )
-    bus_results_ser = serialize_object(bus_results)
+    record_ticket_return(bus_results, ticket_number, departure)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def add_ticket_return(request):
@@ -514,21 +814,20 @@ def add_ticket_return(request):
         request (HttpRequest): Запрос Django.
 
     Returns:
-        JsonResponse: JSON-ответ с результатом добавления билета для возврата в заказ.
+        HttpResponse: JSON-ответ с результатом добавления билета для возврата в заказ.
     """
     return_order_id = '00000011409'
     ticket_number = '00000005334032'
     seat_num = '2'
     departure = '862fd93e-e633-11e7-80e7-00175d776a07'
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.AddTicketReturn(TicketNumber=ticket_number,
-                                                 SeatNum=seat_num,
-                                                 Departure=departure,
-                                                 ReturnOrderId=return_order_id)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'AddTicketReturn', TicketNumber=ticket_number,
+                       SeatNum=seat_num,
+                       Departure=departure,
+                       ReturnOrderId=return_order_id)
+    record_ticket_return(bus_results, ticket_number, departure)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def delete_ticket_return(request):
@@ -539,28 +838,28 @@ def delete_ticket_return(request):
         request (HttpRequest): Запрос Django.
 
     Returns:
-        JsonResponse: JSON-ответ с результатом удаления билета из возврата в заказе.
+        HttpResponse: JSON-ответ с результатом удаления билета из возврата в заказе.
     """
     return_order_id = '00000011409'
     ticket_number = '00000005334032'
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.DelTicketReturn(ReturnOrderId=return_order_id,
-                                                 TicketNumber=ticket_number)
-    bus_results_ser = serialize_object(bus_results)
+    bus_results = call(WSDL_SALE, 'DelTicketReturn', ReturnOrderId=return_order_id,
+                       TicketNumber=ticket_number)
+    remove_ticket_return(return_order_id, ticket_number)
 
-    return JsonResponse(bus_results_ser)
+    return json_response(bus_results)
 
 
 def return_payment(request):
     """
-    Возвращает заказ в системе Avibus.
+    Возвращает заказ в системе Avibus. Возврат выполняется воркером фоновой очереди
+    и не позже 30 минут после создания заказа на возврат.
 
     Args:
-        request (HttpRequest): Запрос Django.
+        request (HttpRequest): Запрос Django. Параметр wait - сколько секунд ждать результата.
 
     Returns:
-        JsonResponse: JSON-ответ с результатом возврата заказа.
+        HttpResponse: JSON-ответ с задачей очереди; результат возврата - в поле result.
     """
     return_order_id = '00000011409'
     terminal_id = ''
@@ -575,37 +874,33 @@ def return_payment(request):
 
     cheque_settings = {'ChequeWidth': '48'}
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.ReturnPayment(ReturnOrderId=return_order_id,
-                                               TerminalId=terminal_id,
-                                               TerminalSessionId=terminal_session_id,
-                                               PaymentItems=payment_items,
-                                               ChequeSettings=cheque_settings)
-    bus_results_ser = serialize_object(bus_results)
+    job = enqueue('return_payment', {'ReturnOrderId': return_order_id,
+                                     'TerminalId': terminal_id,
+                                     'TerminalSessionId': terminal_session_id,
+                                     'PaymentItems': payment_items,
+                                     'ChequeSettings': cheque_settings})
 
-    return JsonResponse(bus_results_ser)
+    return job_response(request, job)
 
 
 def cancel_return_payment(request):
     """
-    Отменяет возврат заказа в системе Avibus.
+    Отменяет возврат заказа в системе Avibus через фоновую очередь.
 
     Args:
-        request (HttpRequest): Запрос Django.
+        request (HttpRequest): Запрос Django. Параметр wait - сколько секунд ждать результата.
 
     Returns:
-        JsonResponse: JSON-ответ с результатом отмены возврата заказа.
+        HttpResponse: JSON-ответ с задачей очереди; результат отмены возврата - в поле result.
     """
     return_order_id = '00000011409'
     ticket_seats = ''
     services = ''
     payment_items = ''
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.CancelReturnPayment(ReturnOrderId=return_order_id, TicketSeats=ticket_seats,
-                                                     Services=services, PaymentItems=payment_items)
-    bus_results_ser = serialize_object(bus_results)
+    job = enqueue('cancel_return_payment', {'ReturnOrderId': return_order_id, 'TicketSeats': ticket_seats,
+                                            'Services': services, 'PaymentItems': payment_items})
 
-    return JsonResponse(bus_results_ser)
+    return job_response(request, job)
 
 
 def get_ticket_status(request):
@@ -616,16 +911,182 @@ def get_ticket_status(request):
         request (HttpRequest): Запрос Django.
 
     Returns:
-        JsonResponse: JSON-ответ с информацией о статусе билета.
+        HttpResponse: JSON-ответ с информацией о статусе билета.
     """
     departure_id = '862fd93e-e633-11e7-80e7-00175d776a07'
     ticket_id = '00000005334018'
     vendor_id = ''
 
-    client = get_client(WSDL_SALE)
-    bus_results = client.service.GetTicketStatus(DepartureId=departure_id, TicketId=ticket_id, VendorId=vendor_id)
-    bus_results_ser = serialize_object(bus_results)
-    return JsonResponse(bus_results_ser, safe=False)
+    bus_results = call(WSDL_SALE, 'GetTicketStatus', DepartureId=departure_id, TicketId=ticket_id, VendorId=vendor_id)
+    ticket_status_cache.set((departure_id, ticket_id), bus_results)
+    record_ticket_status(ticket_id, departure_id, bus_results)
+
+    return json_response(bus_results)
+
+
+def fetch_ticket_status(departure_id, ticket_id):
+    return call(WSDL_SALE, 'GetTicketStatus', DepartureId=departure_id, TicketId=ticket_id, VendorId='')
+
+
+def parse_ticket_pairs(tickets):
+    """
+    Разбирает список билетов из запроса bulk_ticket_status и убирает повторы, сохраняя порядок.
+
+    Args:
+        tickets (list): Элементы вида {"departure": ..., "ticket": ...} или [departure, ticket].
+
+    Returns:
+        list[tuple] | None: Уникальные пары (departure, ticket) или None, если формат неверный.
+    """
+    pairs = {}
+    for item in tickets:
+        if isinstance(item, dict):
+            pair = (item.get('departure'), item.get('ticket'))
+        elif isinstance(item, list) and len(item) == 2:
+            pair = tuple(item)
+        else:
+            return None
+        if not all(isinstance(value, str) and value for value in pair):
+            return None
+        pairs.setdefault(pair, None)
+    return list(pairs)
+
+
+@csrf_exempt
+@require_POST
+def bulk_ticket_status(request):
+    """
+    Получает статусы нескольких билетов за один запрос. Повторяющиеся пары отбрасываются,
+    недавние ответы берутся из кэша, остальные запросы GetTicketStatus выполняются параллельно в общем пуле потоков,
+    не больше TICKET_STATUS_BULK_CONCURRENCY одновременно.
+
+    Args:
+        request (HttpRequest): Запрос Django. Тело JSON {"tickets": [{"departure": ..., "ticket": ...}, ...]}.
+
+    Returns:
+        HttpResponse: JSON-ответ со статусом или ошибкой по каждому билету в порядке запроса.
+    """
+    try:
+        body = orjson.loads(request.body)
+    except orjson.JSONDecodeError:
+        body = None
+    tickets = body.get('tickets') if isinstance(body, dict) else None
+    pairs = parse_ticket_pairs(tickets) if isinstance(tickets, list) else None
+    if pairs is None:
+        return json_response({'error': 'Тело запроса должно содержать список tickets из пар departure и ticket'},
+                             status=400)
+    if len(pairs) > settings.TICKET_STATUS_BULK_MAX:
+        return json_response({'error': f'Не больше {settings.TICKET_STATUS_BULK_MAX} билетов за запрос'}, status=400)
+
+    cached = {pair: ticket_status_cache.get(pair) for pair in pairs}
+    futures = submit_limited({
+        pair: lambda pair=pair: ticket_status_cache.get_or_load(pair, lambda: fetch_ticket_status(*pair))
+        for pair in pairs if cached[pair] is None
+    }, settings.TICKET_STATUS_BULK_CONCURRENCY)
+
+    results = []
+    fetched = []
+    for departure_id, ticket_id in pairs:
+        item = {'departure': departure_id, 'ticket': ticket_id}
+        status = cached[(departure_id, ticket_id)]
+        if status is not None:
+            results.append({**item, 'status': status, 'cached': True})
+            continue
+        try:
+            status = futures[(departure_id, ticket_id)].result()
+        except Exception as exc:
+            results.append({**item, 'error': str(exc)})
+            continue
+        fetched.append((departure_id, ticket_id, status))
+        results.append({**item, 'status': status, 'cached': False})
+
+    record_ticket_statuses(fetched)
+
+    return json_response({'requested': len(tickets), 'unique': len(pairs), 'cached': len(pairs) - len(futures),
+                          'fetched': len(fetched), 'tickets': results})
+
+
+def job_status(request):
+    """
+    Возвращает состояние задачи фоновой очереди (оплаты, возврата или их отмены).
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметры job_id и wait (long-poll, секунд).
+
+    Returns:
+        HttpResponse: JSON-ответ с задачей; 202, пока она не завершена.
+    """
+    try:
+        job_id = int(request.GET.get('job_id', ''))
+    except ValueError:
+        return json_response({'error': 'job_id должен быть числом'}, status=400)
+    # Идентификаторы вне диапазона BigAutoField не существуют, а SQLite на них падает с OverflowError.
+    job = Job.objects.filter(pk=job_id).first() if 0 < job_id < 2 ** 63 else None
+    if job is None:
+        return json_response({'error': 'Задача не найдена'}, status=404)
+
+    return job_response(request, job)
+
+
+def order_status(request):
+    """
+    Возвращает заказ с билетами из локального хранилища без запроса к Avibus.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметр order_id - номер заказа.
+
+    Returns:
+        HttpResponse: JSON-ответ с заказом, его билетами и заказами на возврат.
+    """
+    order_id = request.GET.get('order_id', '00000026703')
+    order = Order.objects.filter(number=order_id).prefetch_related('tickets__return_order').first()
+    if order is None:
+        return json_response({'error': f'Заказ {order_id} не найден'}, status=404)
+
+    result = order_to_dict(order)
+    return_orders = {ticket.return_order for ticket in order.tickets.all() if ticket.return_order_id}
+    result['return_orders'] = [
+        {'number': return_order.number, 'status': return_order.status,
+         'avibus_status': return_order.avibus_status, 'updated_at': return_order.updated_at,
+         'paid_at': return_order.paid_at}
+        for return_order in sorted(return_orders, key=lambda return_order: return_order.number)
+    ]
+    return json_response(result)
+
+
+def ticket_info(request):
+    """
+    Возвращает билет из локального хранилища без запроса GetTicketStatus.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметр ticket - номер билета.
+
+    Returns:
+        HttpResponse: JSON-ответ с билетом, номером заказа и заказа на возврат.
+    """
+    ticket_number = request.GET.get('ticket', '00000005334018')
+    ticket = Ticket.objects.filter(number=ticket_number).select_related('order', 'return_order').first()
+    if ticket is None:
+        return json_response({'error': f'Билет {ticket_number} не найден'}, status=404)
+
+    return json_response(ticket_to_dict(ticket))
+
+
+def trip_tickets(request):
+    """
+    Возвращает проданные через сервис билеты поездки из локального хранилища.
+
+    Args:
+        request (HttpRequest): Запрос Django. Параметр trip_id - идентификатор поездки.
+
+    Returns:
+        HttpResponse: JSON-ответ со списком билетов поездки.
+    """
+    trip_id = request.GET.get('trip_id', '38871dbb-dffe-11e7-80e7-00175d776a07e4f41fea-fe65-11ed-4382-d00d5ddf9041')
+    tickets = Ticket.objects.filter(trip_id=trip_id).select_related('order', 'return_order').order_by('number')
+
+    return json_response({'trip_id': trip_id, 'tickets': [ticket_to_dict(ticket) for ticket in tickets]})
+
 
 # def get_directions(request):
 #     url = "http://dev.avibus.pro/UEEDev/ws/SchedulePort?wsdl"
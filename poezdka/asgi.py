@@ -9,8 +9,23 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'poezdka.settings')
 
 application = get_asgi_application()
+
+if settings.SOAP_WARM_ON_STARTUP == 'background':
+    from base.soap import warm_clients_in_background
+
+    warm_clients_in_background()
+elif settings.SOAP_WARM_ON_STARTUP == '1':
+    from base.soap import warm_clients
+
+    warm_clients()
+
+if settings.JOBS_WORKERS:
+    from base.jobs import start_workers
+
+    start_workers()
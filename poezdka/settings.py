@@ -1,8 +1,17 @@
 import os
+import tempfile
 from pathlib import Path
-from dotenv import load_dotenv
 
-load_dotenv()
+# Профиль запуска: development (по умолчанию) или production. В production переменные окружения задает
+# окружение сервера, поэтому .env не читается, DEBUG выключен, соединения с БД переиспользуются,
+# а middleware, не нужные JSON API, не подключаются.
+DJANGO_ENV = os.getenv('DJANGO_ENV', 'development')
+PRODUCTION = DJANGO_ENV == 'production'
+
+if not PRODUCTION or os.getenv('LOAD_DOTENV') == '1':
+    from dotenv import load_dotenv
+
+    load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -15,9 +24,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.getenv('SECRET_KEY')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.getenv('DEBUG', '0' if PRODUCTION else '1') == '1'
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.getenv('ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -35,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'base.middleware.MetricsMiddleware',
+    'base.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -42,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'base.middleware.UpstreamErrorMiddleware',
 ]
 
 ROOT_URLCONF = 'poezdka.urls'
@@ -70,11 +82,27 @@ WSGI_APPLICATION = 'poezdka.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # SQLite с режимом начала транзакций (base.db).
+        'ENGINE': 'base.db',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Сколько секунд держать соединение с БД между запросами; 0 — новое соединение на каждый запрос.
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60 if PRODUCTION else 0)),
+        # Сколько секунд SQLite ждет снятия блокировки записи другим потоком, прежде чем ответить database is locked.
+        # Транзакции берут блокировку записи сразу (BEGIN IMMEDIATE): отложенная транзакция, начавшая с чтения,
+        # при записи получает database is locked без ожидания timeout.
+        'OPTIONS': {
+            'timeout': float(os.getenv('DB_TIMEOUT', 20)),
+            'transaction_mode': os.getenv('DB_TRANSACTION_MODE', 'IMMEDIATE'),
+        },
+        # Тестовая база в файле, а не в памяти: тесты одновременной записи проверяют настоящие блокировки SQLite.
+        'TEST': {'NAME': str(Path(tempfile.gettempdir()) / 'poezdka_test.sqlite3')},
     }
 }
 
+# Повторы записи в локальное хранилище заказов (base.orders), если SQLite все же ответил database is locked.
+ORDERS_WRITE_RETRIES = int(os.getenv('ORDERS_WRITE_RETRIES', 3))
+ORDERS_WRITE_RETRY_BACKOFF = float(os.getenv('ORDERS_WRITE_RETRY_BACKOFF', 0.05))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -118,3 +146,144 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# SOAP-клиенты Avibus
+
+# Дисковый кэш WSDL/XSD документов, общий для всех воркеров.
+SOAP_SCHEMA_CACHE_PATH = os.getenv('SOAP_SCHEMA_CACHE_PATH', BASE_DIR / 'soap_cache.sqlite3')
+SOAP_SCHEMA_CACHE_TIMEOUT = int(os.getenv('SOAP_SCHEMA_CACHE_TIMEOUT', 24 * 60 * 60))
+
+# Сохраненные в проекте WSDL/XSD (manage.py warm_soap --download) и прогрев клиентов при старте воркера:
+# 0 — стек SOAP загружается при первом вызове Avibus, 1 — до приема запросов,
+# background — в фоновом потоке, не задерживая запуск.
+SOAP_WSDL_DIR = os.getenv('SOAP_WSDL_DIR', BASE_DIR / 'base' / 'wsdl')
+SOAP_WARM_ON_STARTUP = os.getenv('SOAP_WARM_ON_STARTUP', '0')
+
+# Пул HTTP-соединений к Avibus, общий для всех представлений воркера.
+SOAP_POOL_CONNECTIONS = int(os.getenv('SOAP_POOL_CONNECTIONS', 2))
+SOAP_POOL_MAXSIZE = int(os.getenv('SOAP_POOL_MAXSIZE', 20))
+SOAP_MAX_RETRIES = int(os.getenv('SOAP_MAX_RETRIES', 2))
+SOAP_RETRY_BACKOFF = float(os.getenv('SOAP_RETRY_BACKOFF', 0.1))
+SOAP_CONNECT_TIMEOUT = float(os.getenv('SOAP_CONNECT_TIMEOUT', 5))
+SOAP_READ_TIMEOUT = float(os.getenv('SOAP_READ_TIMEOUT', 30))
+# Максимум одновременных соединений асинхронного клиента (ASGI) на воркер.
+SOAP_ASYNC_MAX_CONNECTIONS = int(os.getenv('SOAP_ASYNC_MAX_CONNECTIONS', 200))
+
+# Бюджет времени на вызов операции Avibus в секундах, включая повторы (base.upstream.call).
+# Переопределяется переменной окружения вида SOAP_OPERATION_TIMEOUTS="GetTrips=10,Payment=90".
+SOAP_OPERATION_TIMEOUTS = {
+    'GetBusStops': 60,
+    'GetDestinations': 15,
+    'GetTrips': 15,
+    'GetTripSegment': 10,
+    'GetOccupiedSeats': 10,
+    'GetTicketStatus': 10,
+    'StartSaleSession': 15,
+    'AddTickets': 15,
+    'DelTickets': 15,
+    'SetTicketData': 15,
+    'ReserveOrder': 20,
+    'Payment': 60,
+    'CancelPayment': 60,
+    'AddTicketReturn': 20,
+    'DelTicketReturn': 20,
+    'ReturnPayment': 60,
+    'CancelReturnPayment': 60,
+}
+SOAP_OPERATION_TIMEOUTS.update(
+    (name.strip(), float(seconds))
+    for name, seconds in (item.split('=', 1) for item in os.getenv('SOAP_OPERATION_TIMEOUTS', '').split(',') if item)
+)
+# Повторы операций чтения (GetTrips и т.п.) с экспоненциальной задержкой и случайным разбросом.
+SOAP_SAFE_RETRIES = int(os.getenv('SOAP_SAFE_RETRIES', 2))
+SOAP_SAFE_RETRY_BACKOFF = float(os.getenv('SOAP_SAFE_RETRY_BACKOFF', 0.2))
+SOAP_SAFE_RETRY_MAX_BACKOFF = float(os.getenv('SOAP_SAFE_RETRY_MAX_BACKOFF', 2))
+# Автомат отключения порта Avibus: открывается, когда среди последних SOAP_BREAKER_WINDOW вызовов
+# (но не меньше SOAP_BREAKER_MIN_CALLS) доля сбоев достигает SOAP_BREAKER_ERROR_RATE.
+SOAP_BREAKER_WINDOW = int(os.getenv('SOAP_BREAKER_WINDOW', 20))
+SOAP_BREAKER_MIN_CALLS = int(os.getenv('SOAP_BREAKER_MIN_CALLS', 10))
+SOAP_BREAKER_ERROR_RATE = float(os.getenv('SOAP_BREAKER_ERROR_RATE', 0.5))
+SOAP_BREAKER_OPEN_SECONDS = float(os.getenv('SOAP_BREAKER_OPEN_SECONDS', 30))
+# Ограничитель вызовов Avibus в каждом процессе (base.admission): не больше SOAP_ADMISSION_LIMIT одновременных
+# вызовов, 0 — без ограничения. Класс приоритета (payment > booking > search > directory) занимает не больше
+# своей доли лимита SOAP_ADMISSION_SHARES, ждет места не дольше SOAP_ADMISSION_QUEUE_TIMEOUTS секунд,
+# а при SOAP_ADMISSION_QUEUE_MAX ожидающих в очереди класса сразу получает 503.
+# Переопределяются строками вида payment=1,search=0.6.
+SOAP_ADMISSION_LIMIT = int(os.getenv('SOAP_ADMISSION_LIMIT', SOAP_POOL_MAXSIZE))
+SOAP_ADMISSION_SHARES = {'payment': 1.0, 'booking': 0.9, 'search': 0.75, 'directory': 0.5}
+SOAP_ADMISSION_QUEUE_TIMEOUTS = {'payment': 30, 'booking': 5, 'search': 2, 'directory': 1}
+SOAP_ADMISSION_QUEUE_MAX = {'payment': 500, 'booking': 100, 'search': 50, 'directory': 20}
+SOAP_ADMISSION_SHARES.update(
+    (name.strip(), float(value))
+    for name, value in (item.split('=', 1) for item in os.getenv('SOAP_ADMISSION_SHARES', '').split(',') if item)
+)
+SOAP_ADMISSION_QUEUE_TIMEOUTS.update(
+    (name.strip(), float(value))
+    for name, value in (item.split('=', 1) for item in os.getenv('SOAP_ADMISSION_QUEUE_TIMEOUTS', '').split(',') if item)
+)
+SOAP_ADMISSION_QUEUE_MAX.update(
+    (name.strip(), int(value))
+    for name, value in (item.split('=', 1) for item in os.getenv('SOAP_ADMISSION_QUEUE_MAX', '').split(',') if item)
+)
+# Подменный сервис Avibus для нагрузочных тестов (base.standin, manage.py avibus_standin): каталог с WSDL
+# и записанными ответами операций. Если задан AVIBUS_RECORD_DIR, транспорт сохраняет туда ответы Avibus.
+AVIBUS_RECORDINGS_DIR = os.getenv('AVIBUS_RECORDINGS_DIR', BASE_DIR / 'base' / 'recordings')
+AVIBUS_RECORD_DIR = os.getenv('AVIBUS_RECORD_DIR', '')
+# Заголовок Server-Timing с разбивкой времени запроса (Avibus, JSON, остальное); включать для отладки и замеров.
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', '0') == '1'
+# Профилирование отдельных запросов (base.middleware.ProfilingMiddleware): запрос с заголовком X-Profile,
+# равным PROFILING_TOKEN (без токена заголовок не действует), и доля PROFILING_SAMPLE_RATE остальных запросов.
+# Отчеты cProfile пишутся в PROFILING_DIR, хранятся последние PROFILING_MAX_FILES.
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_DIR = os.getenv('PROFILING_DIR', BASE_DIR / 'profiles')
+PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES', 100))
+if PRODUCTION and not PROFILING_TOKEN and not PROFILING_SAMPLE_RATE:
+    MIDDLEWARE.remove('base.middleware.ProfilingMiddleware')
+
+# Через сколько секунд локальный справочник остановок обновляется из Avibus в фоне.
+BUS_STOPS_TTL = int(os.getenv('BUS_STOPS_TTL', 6 * 60 * 60))
+# Период перестройки индекса пунктов назначения и число параллельных запросов GetDestinations при перестройке.
+DESTINATIONS_TTL = int(os.getenv('DESTINATIONS_TTL', 12 * 60 * 60))
+DESTINATIONS_REBUILD_WORKERS = int(os.getenv('DESTINATIONS_REBUILD_WORKERS', 8))
+# Пауза перед повторным фоновым обновлением справочника после неудачи (Avibus недоступен).
+DIRECTORY_REFRESH_BACKOFF = int(os.getenv('DIRECTORY_REFRESH_BACKOFF', 60))
+
+# Cache-Control max-age для справочных ответов и сжатие ответов с ETag (base.http.conditional_json).
+DIRECTIONS_MAX_AGE = int(os.getenv('DIRECTIONS_MAX_AGE', 60 * 60))
+DESTINATIONS_MAX_AGE = int(os.getenv('DESTINATIONS_MAX_AGE', 60 * 60))
+RESPONSE_COMPRESS_MIN_SIZE = int(os.getenv('RESPONSE_COMPRESS_MIN_SIZE', 1024))
+RESPONSE_GZIP_LEVEL = int(os.getenv('RESPONSE_GZIP_LEVEL', 6))
+RESPONSE_BROTLI_QUALITY = int(os.getenv('RESPONSE_BROTLI_QUALITY', 5))
+
+# Кэш результатов GetTrips по (отправление, назначение, дата).
+TRIPS_CACHE_TTL = int(os.getenv('TRIPS_CACHE_TTL', 30))
+TRIPS_CACHE_MAXSIZE = int(os.getenv('TRIPS_CACHE_MAXSIZE', 5000))
+# Кэш карт мест (GetOccupiedSeats) по поездке, сбрасывается при изменении билетов.
+SEATS_CACHE_TTL = int(os.getenv('SEATS_CACHE_TTL', 10))
+SEATS_CACHE_MAXSIZE = int(os.getenv('SEATS_CACHE_MAXSIZE', 5000))
+# Максимальная длина диапазона дат в search_trips_range.
+TRIPS_RANGE_MAX_DAYS = int(os.getenv('TRIPS_RANGE_MAX_DAYS', 14))
+# Сколько запросов GetTrips одного search_trips_range могут одновременно занимать общий пул потоков.
+TRIPS_RANGE_CONCURRENCY = int(os.getenv('TRIPS_RANGE_CONCURRENCY', 4))
+# Сколько запросов GetTrips одного search_anywhere (по одному на пункт назначения) могут одновременно занимать пул.
+SEARCH_ANYWHERE_CONCURRENCY = int(os.getenv('SEARCH_ANYWHERE_CONCURRENCY', 4))
+# Потоков на воркер для параллельных запросов к Avibus (поиск по диапазону дат и т.п.).
+SOAP_FANOUT_WORKERS = int(os.getenv('SOAP_FANOUT_WORKERS', 16))
+# Кэш статусов билетов для bulk_ticket_status и ограничение числа билетов в одном запросе.
+TICKET_STATUS_CACHE_TTL = int(os.getenv('TICKET_STATUS_CACHE_TTL', 30))
+TICKET_STATUS_CACHE_MAXSIZE = int(os.getenv('TICKET_STATUS_CACHE_MAXSIZE', 20000))
+TICKET_STATUS_BULK_MAX = int(os.getenv('TICKET_STATUS_BULK_MAX', 500))
+# Сколько запросов GetTicketStatus одного bulk_ticket_status могут одновременно занимать общий пул потоков.
+TICKET_STATUS_BULK_CONCURRENCY = int(os.getenv('TICKET_STATUS_BULK_CONCURRENCY', 4))
+
+# Очередь фоновых операций оплаты и возврата (base.jobs).
+# Потоков-воркеров в каждом процессе веб-сервера; 0 — задачи выполняет только manage.py run_jobs.
+JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', 2))
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 3))
+JOBS_RETRY_BACKOFF = float(os.getenv('JOBS_RETRY_BACKOFF', 5))
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 0.5))
+# Задача в статусе running дольше этого времени считается брошенной упавшим воркером.
+JOBS_STALE_AFTER = int(os.getenv('JOBS_STALE_AFTER', 300))
+JOBS_LONG_POLL_MAX = int(os.getenv('JOBS_LONG_POLL_MAX', 30))